@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+"""Benchmarks for the editor hot paths.
+
+    benchmarks/bench.py run [-o results.json] [--sizes 1K,100K,1M,10M,100M] [--repeat 3]
+    benchmarks/bench.py compare base.json new.json [--threshold 10]
+
+A run times startup to the first editable frame in a fresh process, then,
+for every document size: open, find (plain and regex), replace all, font
+size and font family over the whole document, paste of a payload of the
+same size, and save. The editor needs a display; in CI use a virtual one,
+e.g. `xvfb-run benchmarks/bench.py run`.
+
+Documents are generated from a fixed seed, and every run uses scratch XDG
+directories so journals, caches and config from the desktop session cannot
+affect the numbers. compare exits with status 1 when any median got slower
+by more than the threshold.
+"""
+
+import argparse, importlib.util, json, os, platform, random, re, shutil, statistics, subprocess
+import sys, tempfile, threading, time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SOURCE = os.path.join(ROOT, "src", "wiziwig.py")
+
+DEFAULT_SIZES = "1K,100K,1M,10M,100M"
+UNITS = {"": 1, "K": 1024, "M": 1024 * 1024}
+SEED = 20240601
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut "
+         "labore et dolore magna aliqua enim ad minim veniam quis nostrud exercitation ullamco").split()
+STARTUP_TIMEOUT = 60
+# Finishing an operation also waits for the next frame, or this long when
+# the window is not being drawn at all.
+FRAME_WAIT_MS = 1000
+
+def parse_size(text):
+    match = re.fullmatch(r"(\d+)([KM]?)", text.strip().upper())
+    if not match:
+        raise argparse.ArgumentTypeError(f"bad size: {text}")
+    return int(match.group(1)) * UNITS[match.group(2)]
+
+def size_label(size):
+    for unit in ("M", "K"):
+        if size >= UNITS[unit] and size % UNITS[unit] == 0:
+            return f"{size // UNITS[unit]}{unit}"
+    return str(size)
+
+def generate_body(size, seed):
+    # Paragraphs of filler text with some bold, italic and sized spans, the
+    # kind of markup the toolbar produces.
+    rng = random.Random(seed)
+    parts = []
+    total = 0
+    while total < size:
+        words = [rng.choice(WORDS) for _ in range(rng.randint(20, 80))]
+        for _ in range(rng.randint(0, 3)):
+            i = rng.randrange(len(words))
+            tag = rng.choice(("b", "i", "u"))
+            words[i] = f"<{tag}>{words[i]}</{tag}>"
+        if rng.random() < 0.2:
+            i = rng.randrange(len(words))
+            words[i] = f'<span style="font-size: {rng.choice((10, 12, 14, 18))}pt;">{words[i]}</span>'
+        paragraph = f"<p>{' '.join(words)}</p>\n"
+        parts.append(paragraph)
+        total += len(paragraph)
+    return "".join(parts)
+
+def generate_document(path, size, seed):
+    with open(path, "w") as f:
+        f.write("<!DOCTYPE html>\n<html>\n<head>\n<meta charset=\"utf-8\">\n<style>\n"
+                "body { font-family: sans-serif; font-size: 11pt; margin: 20px; line-height: 1.5; }\n"
+                "</style>\n</head>\n<body>\n")
+        f.write(generate_body(size, seed))
+        f.write("</body>\n</html>\n")
+
+def isolated_environment(work_dir):
+    env = dict(os.environ)
+    for name in ("XDG_CONFIG_HOME", "XDG_CACHE_HOME", "XDG_DATA_HOME", "XDG_STATE_HOME"):
+        env[name] = os.path.join(work_dir, name.lower())
+        os.makedirs(env[name], exist_ok=True)
+    return env
+
+def environment_info(wiziwig):
+    info = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "webkit": "{}.{}.{}".format(wiziwig.WebKit.get_major_version(), wiziwig.WebKit.get_minor_version(),
+                                    wiziwig.WebKit.get_micro_version()),
+        "gtk": "{}.{}.{}".format(wiziwig.Gtk.get_major_version(), wiziwig.Gtk.get_minor_version(),
+                                 wiziwig.Gtk.get_micro_version()),
+    }
+    try:
+        info["commit"] = subprocess.run(["git", "-C", ROOT, "rev-parse", "HEAD"], capture_output=True,
+                                        text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    return info
+
+def time_startup(env):
+    # A fresh process per sample; the session bus is disabled so it cannot
+    # hand off to an editor that is already running.
+    env = dict(env, DBUS_SESSION_BUS_ADDRESS="disabled:")
+    process = subprocess.Popen([sys.executable, SOURCE, "--trace-startup"], env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    milestones = {}
+    timer = threading.Timer(STARTUP_TIMEOUT, process.kill)
+    timer.start()
+    try:
+        for line in process.stderr:
+            match = re.match(r"\[startup\]\s+([\d.]+) ms\s+(.*)", line)
+            if match:
+                milestones[match.group(2).strip()] = float(match.group(1))
+                if match.group(2).strip() == "web view load finished":
+                    break
+    finally:
+        timer.cancel()
+        process.kill()
+        process.wait()
+    return milestones
+
+class Suite:
+    """Drives one EditorWindow through the scenarios.
+
+    Each scenario is a generator that yields waits, functions taking a
+    resume callback, so the steps read top to bottom while the main loop
+    keeps running underneath."""
+
+    def __init__(self, wiziwig, app, documents, repeat, work_dir, results):
+        self.wiziwig = wiziwig
+        self.app = app
+        self.documents = documents
+        self.repeat = repeat
+        self.work_dir = work_dir
+        self.results = results
+        self.window = None
+        self.steps = None
+        self.failure = None
+
+    def start(self):
+        self.window = self.app.get_active_window()
+        self.steps = self.run()
+        self.resume()
+        return False
+
+    def resume(self, value=None):
+        try:
+            wait = self.steps.send(value)
+        except StopIteration:
+            self.app.quit()
+            return
+        except Exception as e:
+            self.failure = e
+            self.app.quit()
+            return
+        wait(self.resume)
+
+    def record(self, scenario, size, started):
+        elapsed = (time.perf_counter() - started) * 1000
+        self.results.setdefault(f"{scenario}/{size_label(size)}", []).append(round(elapsed, 2))
+        print(f"  {scenario:<12} {size_label(size):>5} {elapsed:10.1f} ms", file=sys.stderr)
+
+    def js(self, body):
+        # Runs body as an async function in the page; resumes with its
+        # JSON-decoded result once it has settled.
+        def wait(resume):
+            def on_done(webview, result, user_data):
+                value = webview.call_async_javascript_function_finish(result)
+                resume(json.loads(value.to_json(0) or "null"))
+            self.window.webview.call_async_javascript_function(body, -1, None, None, None, None, on_done, None)
+        return wait
+
+    def frame(self):
+        return (f"await new Promise(resolve => {{ requestAnimationFrame(() => resolve()); "
+                f"setTimeout(resolve, {FRAME_WAIT_MS}); }});")
+
+    def open(self, path):
+        def wait(resume):
+            window = self.window
+            ready = window.on_document_ready
+            def on_ready(doc):
+                del window.on_document_ready
+                ready(doc)
+                resume(doc)
+            window.on_document_ready = on_ready
+            window.open_file(self.wiziwig.Gio.File.new_for_path(path))
+        return wait
+
+    def replace_all(self, text, replacement):
+        def wait(resume):
+            handlers = self.window.message_handlers
+            handler = handlers["replace"]
+            def on_replace(data):
+                if data.get("finished") or data.get("error"):
+                    handlers["replace"] = handler
+                    resume(data)
+            handlers["replace"] = on_replace
+            options = {"seq": 0, "text": text, "replacement": replacement, "regex": False, "caseSensitive": False}
+            self.window.webview.evaluate_javascript(f"wiziwig.replace.replaceAll({json.dumps(options)})",
+                                                    -1, None, None, None, None, None)
+        return wait
+
+    def paste(self, doc, markup):
+        # The sanitizing thread and the chunked insert, without the clipboard
+        wiziwig = self.wiziwig
+        def wait(resume):
+            def convert():
+                inline, chunks = wiziwig.sanitize_clipboard_html(markup)
+                wiziwig.GLib.idle_add(insert, inline, chunks)
+            def insert(inline, chunks):
+                wiziwig.PasteJob(doc.webview, inline, chunks, None, lambda job: resume(None)).start()
+                return False
+            threading.Thread(target=convert, daemon=True).start()
+        return wait
+
+    def save(self, doc, path):
+        def wait(resume):
+            doc.saver.save(self.wiziwig.Gio.File.new_for_path(path), lambda file, error, user_data: resume(error))
+        return wait
+
+    def run(self):
+        previous = None
+        for size, path in self.documents:
+            payload = generate_body(size, SEED + 1)
+            for _ in range(self.repeat):
+                started = time.perf_counter()
+                doc = yield self.open(path)
+                self.record("open", size, started)
+                if previous is not None and previous is not doc and previous.page:
+                    self.window.tab_view.close_page(previous.page)
+                previous = doc
+
+                find = {"text": "lorem", "caseSensitive": False, "regex": False, "budget": 60000}
+                started = time.perf_counter()
+                yield self.js("return await new Promise((resolve, reject) => "
+                              f"wiziwig.find.collect({json.dumps(find)}, found => resolve(found.length), reject));")
+                self.record("find", size, started)
+
+                find.update(text=r"\bd\w+r\b", regex=True)
+                started = time.perf_counter()
+                yield self.js("return await new Promise((resolve, reject) => "
+                              f"wiziwig.find.collect({json.dumps(find)}, found => resolve(found.length), reject));")
+                self.record("find-regex", size, started)
+
+                started = time.perf_counter()
+                result = yield self.replace_all("lorem", "LOREM")
+                if result.get("error"):
+                    raise RuntimeError(f"replace all failed: {result['error']}")
+                self.record("replace-all", size, started)
+
+                for scenario, call in (("font-size", "fontSize(14)"), ("font-family", "fontFamily('serif')")):
+                    started = time.perf_counter()
+                    yield self.js("wiziwig.virtual.disable(); document.execCommand('selectAll'); "
+                                  f"wiziwig.history.begin('{scenario}'); wiziwig.commands.{call}; "
+                                  f"wiziwig.flushMutations(); {self.frame()}")
+                    self.record(scenario, size, started)
+
+                yield self.js("window.getSelection().collapseToEnd();")
+                started = time.perf_counter()
+                yield self.paste(doc, payload)
+                yield self.js(self.frame())
+                self.record("paste", size, started)
+
+                started = time.perf_counter()
+                error = yield self.save(doc, os.path.join(self.work_dir, "saved.html"))
+                if error:
+                    raise RuntimeError(f"save failed: {error}")
+                self.record("save", size, started)
+
+def run(args):
+    work_dir = tempfile.mkdtemp(prefix="wiziwig-bench-")
+    try:
+        env = isolated_environment(work_dir)
+        os.environ.update(env)
+        # Imported only now, so GLib picks up the scratch XDG directories
+        spec = importlib.util.spec_from_file_location("wiziwig", SOURCE)
+        wiziwig = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(wiziwig)
+
+        results = {}
+        print("startup", file=sys.stderr)
+        for _ in range(args.repeat):
+            milestones = time_startup(env)
+            for milestone, key in (("first frame", "startup/first-frame"),
+                                   ("web view load finished", "startup/editable")):
+                if milestone in milestones:
+                    results.setdefault(key, []).append(milestones[milestone])
+                    print(f"  {milestone:<24} {milestones[milestone]:10.1f} ms", file=sys.stderr)
+
+        documents = []
+        for size in args.sizes:
+            path = os.path.join(work_dir, f"document-{size_label(size)}.html")
+            generate_document(path, size, SEED)
+            documents.append((size, path))
+
+        app = wiziwig.Wiziwig()
+        app.set_flags(app.get_flags() | wiziwig.Gio.ApplicationFlags.NON_UNIQUE)
+        suite = Suite(wiziwig, app, documents, args.repeat, work_dir, results)
+        app.connect("activate", lambda app: wiziwig.GLib.idle_add(suite.start))
+        app.run([sys.argv[0]])
+        if suite.failure:
+            raise suite.failure
+
+        report = {
+            "environment": environment_info(wiziwig),
+            "repeat": args.repeat,
+            "sizes": [size_label(size) for size in args.sizes],
+            "results": {key: {"runs": runs, "median_ms": round(statistics.median(runs), 2), "min_ms": min(runs)}
+                        for key, runs in results.items()},
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"wrote {args.output}", file=sys.stderr)
+        return 0
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def compare(args):
+    with open(args.base) as f:
+        base = json.load(f)["results"]
+    with open(args.new) as f:
+        new = json.load(f)["results"]
+    regressions = 0
+    print(f"{'benchmark':<24} {'base ms':>10} {'new ms':>10} {'change':>8}")
+    for key in sorted(set(base) & set(new)):
+        before = base[key]["median_ms"]
+        after = new[key]["median_ms"]
+        change = (after - before) / before * 100 if before else 0.0
+        regressed = change > args.threshold and after - before > args.min_delta
+        regressions += regressed
+        print(f"{key:<24} {before:10.1f} {after:10.1f} {change:+7.1f}%{'  REGRESSION' if regressed else ''}")
+    for key in sorted(set(base) ^ set(new)):
+        print(f"{key:<24} only in {'base' if key in base else 'new'}")
+    return 1 if regressions else 0
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the editor hot paths.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="run the benchmarks and write a JSON report")
+    run_parser.add_argument("-o", "--output", default="benchmark.json")
+    run_parser.add_argument("--sizes", default=DEFAULT_SIZES,
+                            type=lambda text: [parse_size(size) for size in text.split(",")],
+                            help=f"document sizes, default {DEFAULT_SIZES}")
+    run_parser.add_argument("--repeat", type=int, default=3, help="samples per benchmark, the median is compared")
+    compare_parser = commands.add_parser("compare", help="compare two reports")
+    compare_parser.add_argument("base")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=10.0,
+                                help="percent slowdown that counts as a regression")
+    compare_parser.add_argument("--min-delta", type=float, default=1.0, metavar="MS",
+                                help="ignore changes smaller than this many milliseconds")
+    args = parser.parse_args()
+    return run(args) if args.command == "run" else compare(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,24 +1,5592 @@
 #!/usr/bin/env python3
 
-import gi, json
+import gi, json, os, re, sys, threading, queue, hashlib, time, base64, shutil, argparse, subprocess, sqlite3
+import codecs, tempfile, zipfile, weakref, uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from html import escape
+from html.parser import HTMLParser
+
+# Set WIZIWIG_TRACE_STARTUP=1 or pass --trace-startup to log the time from
+# launch to each startup milestone on stderr.
+STARTUP_TRACE = bool(os.environ.get("WIZIWIG_TRACE_STARTUP")) or "--trace-startup" in sys.argv
+STARTUP_BEGIN = time.monotonic()
+startup_milestones = set()
+
+def trace_startup(milestone):
+    if STARTUP_TRACE and milestone not in startup_milestones:
+        startup_milestones.add(milestone)
+        print(f"[startup] {(time.monotonic() - STARTUP_BEGIN) * 1000:8.1f} ms  {milestone}", file=sys.stderr)
+
 gi.require_version('Gtk', '4.0')
 gi.require_version('Adw', '1')
 gi.require_version('WebKit', '6.0')
 gi.require_version('Pango', '1.0')
 gi.require_version('PangoCairo', '1.0')
-from gi.repository import Gtk, Adw, WebKit, Gio, GLib, Pango, PangoCairo, Gdk
+gi.require_version('GdkPixbuf', '2.0')
+from gi.repository import Gtk, Adw, WebKit, Gio, GLib, Pango, PangoCairo, Gdk, GdkPixbuf
+try:
+    gi.require_version('GioUnix', '2.0')
+    from gi.repository import GioUnix
+    UnixInputStream = GioUnix.InputStream
+except (ValueError, ImportError):
+    # Before GLib 2.80 the Unix streams are part of Gio
+    UnixInputStream = Gio.UnixInputStream
+trace_startup("imports")
+
+# Local documents are streamed into the web view through this scheme so the
+# file never has to be held in Python memory.
+DOCUMENT_SCHEME = "wiziwig-doc"
+# Besides the document itself, files beside it are only served as these
+DOCUMENT_RESOURCE_TYPES = ("image/", "font/", "audio/", "video/", "text/css")
+# Files above this size show a progress bar with a cancel button while loading.
+LARGE_FILE_THRESHOLD = 4 * 1024 * 1024
+# Page style of new documents, and of Markdown ones, which have none
+DOCUMENT_CSS = """
+        body { font-family: sans-serif; font-size: 11pt; margin: 20px; line-height: 1.5; }
+        @media (prefers-color-scheme: dark) { body { background-color: #121212; color: #e0e0e0; } }
+        @media (prefers-color-scheme: light) { body { background-color: #ffffff; color: #000000; } }
+        img { max-width: 100%; resize: both; }
+"""
+# Bursts of change events from another program's write settle for this long
+# before the open document is compared against the file.
+EXTERNAL_CHECK_DELAY_MS = 250
+
+# Inserted images live in a content-addressed store and are referenced from
+# documents as wiziwig-blob:///<sha256>.<ext> until the document is saved.
+BLOB_SCHEME = "wiziwig-blob"
+BLOB_NAME_RE = re.compile(r"[0-9a-f]{64}\.[a-z0-9]{1,8}")
+BLOB_REFERENCE_RE = re.compile(rb"wiziwig-blob:///([0-9a-f]{64}\.[a-z0-9]{1,8})")
+# Images wider than this are shown through a downscaled rendition
+BLOB_DISPLAY_WIDTH = 1600
+BLOB_RENDITION_WORKERS = 2
+
+# Upper bound for a single serialized chunk crossing the JS bridge on save.
+SAVE_CHUNK_CHARS = 1024 * 1024
+
+# Pasted content is inserted this many characters at a time, one main loop
+# iteration each, and pastes above the threshold show a progress bar.
+PASTE_CHUNK_CHARS = 256 * 1024
+PASTE_PROGRESS_THRESHOLD = 1024 * 1024
+
+# Preloaded into every page. A single MutationObserver feeds the editor
+# engines, which register through wiziwig.observe().
+EDITOR_RUNTIME_JS = r"""
+(function() {
+    if (window.wiziwig) return;
+    const subscribers = [];
+    const wiziwig = window.wiziwig = {
+        observe(callback) {
+            subscribers.push(callback);
+        },
+        // Top-level blocks in document order. The virtualized view swaps
+        // these for its block store, which also holds blocks outside the DOM.
+        blocks: () => document.body.childNodes,
+        isBlock: node => node.parentNode === document.body,
+        previousBlock: node => node.previousSibling,
+        // Returns the block containing node, or null when the node is outside
+        // the body or already detached.
+        topLevelNode(node) {
+            const body = document.body;
+            while (node && node.parentNode !== body) {
+                if (node === body) return null;
+                if (!node.parentNode) return wiziwig.isBlock(node) ? node : null;
+                node = node.parentNode;
+            }
+            return node;
+        },
+        flushMutations() {
+            const records = observer.takeRecords().concat(detachedRecords(detachedObserver.takeRecords()));
+            if (records.length) dispatch(records);
+        },
+        // Runs fn without reporting its mutations to any engine
+        quietly(fn) {
+            wiziwig.flushMutations();
+            try {
+                return fn();
+            } finally {
+                observer.takeRecords();
+                detachedObserver.takeRecords();
+            }
+        },
+        // Blocks kept out of the DOM are observed directly so that edits to
+        // them (replace all, undo) still reach the engines.
+        watchDetached(node) {
+            detachedObserver.observe(node, OPTIONS);
+        },
+        escapeText: text => text.replace(/&/g, '&amp;').replace(/</g, '&lt;').replace(/>/g, '&gt;'),
+        escapeAttr: text => text.replace(/&/g, '&amp;').replace(/"/g, '&quot;'),
+        serializeNode(node) {
+            switch (node.nodeType) {
+                case Node.ELEMENT_NODE: return node.outerHTML;
+                case Node.TEXT_NODE: return wiziwig.escapeText(node.data);
+                case Node.COMMENT_NODE: return '<!--' + node.data + '-->';
+                default: return '';
+            }
+        },
+        // Everything the page reports to Python goes through this channel.
+        post(type, message) {
+            const handlers = window.webkit && window.webkit.messageHandlers;
+            if (handlers && handlers.wiziwig) {
+                handlers.wiziwig.postMessage(JSON.stringify({type: type, data: message}));
+            }
+        },
+    };
+    function dispatch(records) {
+        for (const callback of subscribers) callback(records);
+    }
+    const OPTIONS = {
+        childList: true, subtree: true, characterData: true, attributes: true,
+        characterDataOldValue: true, attributeOldValue: true,
+    };
+    const observer = new MutationObserver(dispatch);
+    observer.observe(document.documentElement, OPTIONS);
+    // Attached nodes are reported by the document observer
+    const detachedRecords = records => records.filter(record => !record.target.isConnected);
+    const detachedObserver = new MutationObserver(records => {
+        records = detachedRecords(records);
+        if (records.length) dispatch(records);
+    });
+})();
+"""
+
+# Large documents keep only the blocks near the viewport in the DOM. The
+# others stay in an in-page block store as detached nodes, so every engine
+# keeps working with the same nodes; two spacers sized from the measured
+# block heights stand in for them and keep the scrollbar accurate.
+VIRTUAL_JS = r"""
+(function() {
+    const wiziwig = window.wiziwig;
+    if (!wiziwig || wiziwig.virtual) return;
+    // Viewport heights kept materialized above and below the visible area
+    const OVERSCAN = 1.5;
+    const REVEAL_MARGIN = 20;
+    const defaults = {blocks: wiziwig.blocks, isBlock: wiziwig.isBlock, previousBlock: wiziwig.previousBlock};
+    let blocks = [];
+    let members = new WeakSet();
+    let heights = [];
+    let tree = new Float64Array(1);
+    let estimate = 24;
+    let start = 0;
+    let end = 0;
+    let topSpacer = null;
+    let bottomSpacer = null;
+    let frame = 0;
+
+    // Fenwick tree over block heights: offsets and lookups in O(log n)
+    function build() {
+        const n = heights.length;
+        tree = new Float64Array(n + 1);
+        for (let i = 1; i <= n; i++) {
+            tree[i] += heights[i - 1];
+            const parent = i + (i & -i);
+            if (parent <= n) tree[parent] += tree[i];
+        }
+    }
+    function setHeight(i, height) {
+        const delta = height - heights[i];
+        heights[i] = height;
+        for (let k = i + 1; k < tree.length; k += k & -k) tree[k] += delta;
+    }
+    function offsetOf(i) {
+        let sum = 0;
+        for (; i > 0; i -= i & -i) sum += tree[i];
+        return sum;
+    }
+    function indexAt(offset) {
+        let pos = 0;
+        let step = 1;
+        while (step * 2 < tree.length) step *= 2;
+        for (; step; step >>= 1) {
+            if (pos + step < tree.length && tree[pos + step] <= offset) {
+                pos += step;
+                offset -= tree[pos];
+            }
+        }
+        return Math.min(pos, blocks.length - 1);
+    }
+
+    const isSpacer = node => node === topSpacer || node === bottomSpacer;
+    function spacer() {
+        const div = document.createElement('div');
+        div.contentEditable = 'false';
+        div.setAttribute('aria-hidden', 'true');
+        return div;
+    }
+    function sizeSpacers() {
+        topSpacer.style.height = offsetOf(start) + 'px';
+        bottomSpacer.style.height = (offsetOf(blocks.length) - offsetOf(end)) + 'px';
+    }
+    function live() {
+        return Array.from(document.body.childNodes).filter(node => !isSpacer(node));
+    }
+
+    // Heights are the distance between the tops of consecutive elements;
+    // text between blocks counts as part of the element before it.
+    function measure(from, to) {
+        let previous = -1;
+        let previousTop = 0;
+        for (let i = from; i < to; i++) {
+            const node = blocks[i];
+            if (node.nodeType !== Node.ELEMENT_NODE) {
+                if (heights[i]) setHeight(i, 0);
+                continue;
+            }
+            const top = node.getBoundingClientRect().top;
+            if (previous >= 0) setHeight(previous, top - previousTop);
+            previous = i;
+            previousTop = top;
+        }
+        if (previous >= 0) {
+            const bottom = to === end ? bottomSpacer.getBoundingClientRect().top
+                                      : blocks[previous].getBoundingClientRect().bottom;
+            setHeight(previous, bottom - previousTop);
+        }
+    }
+
+    // Moves the materialized range to [from, to), keeping the first visible
+    // block where it is on screen.
+    function setWindow(from, to) {
+        wiziwig.quietly(() => {
+            let anchor = null;
+            let anchorTop = 0;
+            for (let i = start; i < end; i++) {
+                const node = blocks[i];
+                if (i < from || i >= to || node.nodeType !== Node.ELEMENT_NODE) continue;
+                const top = node.getBoundingClientRect().top;
+                if (top >= 0) {
+                    anchor = node;
+                    anchorTop = top;
+                    break;
+                }
+            }
+            for (let i = start; i < end; i++) {
+                if (i >= from && i < to) continue;
+                blocks[i].remove();
+                wiziwig.watchDetached(blocks[i]);
+            }
+            const before = document.createDocumentFragment();
+            for (let i = from; i < Math.min(to, start); i++) before.appendChild(blocks[i]);
+            const after = document.createDocumentFragment();
+            for (let i = Math.max(from, end); i < to; i++) after.appendChild(blocks[i]);
+            topSpacer.after(before);
+            bottomSpacer.before(after);
+            start = from;
+            end = to;
+            sizeSpacers();
+            measure(start, end);
+            sizeSpacers();
+            if (anchor) window.scrollBy(0, anchor.getBoundingClientRect().top - anchorTop);
+        });
+        if (wiziwig.find) wiziwig.find.refreshRanges();
+    }
+
+    function update() {
+        frame = 0;
+        if (!virtual.active || !blocks.length) return;
+        const view = window.innerHeight;
+        const origin = topSpacer.getBoundingClientRect().top;
+        const top = -origin;
+        const covered = offsetOf(start) <= Math.max(0, top - view * OVERSCAN / 2) &&
+                        offsetOf(end) >= Math.min(offsetOf(blocks.length), top + view * (1 + OVERSCAN / 2));
+        if (covered) return;
+        const from = indexAt(Math.max(0, top - view * OVERSCAN));
+        const to = Math.min(blocks.length, indexAt(top + view * (1 + OVERSCAN)) + 1);
+        setWindow(from, to);
+    }
+    function schedule() {
+        if (!frame) frame = requestAnimationFrame(update);
+    }
+    function onResize() {
+        if (!virtual.active) return;
+        // Scale the remembered heights by how much the live blocks changed
+        const old = offsetOf(end) - offsetOf(start);
+        measure(start, end);
+        const now = offsetOf(end) - offsetOf(start);
+        if (old > 0 && Math.abs(now - old) > 1) {
+            const ratio = now / old;
+            for (let i = 0; i < blocks.length; i++) {
+                if (i < start || i >= end) heights[i] *= ratio;
+            }
+            estimate *= ratio;
+            build();
+        }
+        wiziwig.quietly(sizeSpacers);
+        schedule();
+    }
+
+    // Edits inside the window change the body's children; splice them
+    // into the store. Registered first, so other engines see a synced store.
+    wiziwig.observe(records => {
+        if (!virtual.active) return;
+        const body = document.body;
+        if (!records.some(record => record.target === body && record.type === 'childList')) return;
+        if (!topSpacer.isConnected || !bottomSpacer.isConnected) {
+            wiziwig.quietly(() => {
+                body.prepend(topSpacer);
+                body.append(bottomSpacer);
+            });
+        }
+        const nodes = live();
+        const known = new Map();
+        for (let i = start; i < end; i++) known.set(blocks[i], heights[i]);
+        for (const node of known.keys()) {
+            if (!nodes.includes(node)) members.delete(node);
+        }
+        for (const node of nodes) members.add(node);
+        blocks.splice(start, end - start, ...nodes);
+        heights.splice(start, end - start, ...nodes.map(node => known.has(node) ? known.get(node) : estimate));
+        end = start + nodes.length;
+        build();
+        requestAnimationFrame(() => {
+            if (!virtual.active) return;
+            measure(start, end);
+            wiziwig.quietly(sizeSpacers);
+        });
+    });
+
+    function indexOfBlock(node) {
+        const top = wiziwig.topLevelNode(node);
+        return top ? blocks.indexOf(top) : -1;
+    }
+
+    const virtual = wiziwig.virtual = {
+        active: false,
+        // Virtualizes the document when it has more blocks than threshold.
+        enable(threshold) {
+            const body = document.body;
+            if (virtual.active || body.childNodes.length <= threshold) return false;
+            wiziwig.flushMutations();
+            blocks = Array.from(body.childNodes);
+            members = new WeakSet(blocks);
+            topSpacer = spacer();
+            bottomSpacer = spacer();
+            wiziwig.quietly(() => {
+                body.prepend(topSpacer);
+                body.append(bottomSpacer);
+            });
+            // Everything is laid out once now, so every height starts exact
+            heights = blocks.map(() => 0);
+            build();
+            start = 0;
+            end = blocks.length;
+            measure(0, blocks.length);
+            const elements = blocks.filter(node => node.nodeType === Node.ELEMENT_NODE).length;
+            estimate = elements ? offsetOf(blocks.length) / elements : estimate;
+            wiziwig.blocks = () => blocks;
+            wiziwig.isBlock = node => members.has(node);
+            wiziwig.previousBlock = node => {
+                const i = blocks.indexOf(node);
+                return i > 0 ? blocks[i - 1] : null;
+            };
+            virtual.active = true;
+            const view = window.innerHeight;
+            const top = -topSpacer.getBoundingClientRect().top;
+            setWindow(indexAt(Math.max(0, top - view * OVERSCAN)),
+                      Math.min(blocks.length, indexAt(top + view * (1 + OVERSCAN)) + 1));
+            return true;
+        },
+        // Puts every block back into the DOM, e.g. for printing.
+        disable() {
+            if (!virtual.active) return false;
+            wiziwig.quietly(() => {
+                const before = document.createDocumentFragment();
+                for (let i = 0; i < start; i++) before.appendChild(blocks[i]);
+                const after = document.createDocumentFragment();
+                for (let i = end; i < blocks.length; i++) after.appendChild(blocks[i]);
+                topSpacer.replaceWith(before);
+                bottomSpacer.replaceWith(after);
+            });
+            Object.assign(wiziwig, defaults);
+            virtual.active = false;
+            blocks = [];
+            heights = [];
+            members = new WeakSet();
+            if (wiziwig.find) wiziwig.find.refreshRanges();
+            return true;
+        },
+        // Materializes the blocks around node and scrolls it into view.
+        reveal(node) {
+            if (!virtual.active) return;
+            const i = indexOfBlock(node);
+            if (i < 0) return;
+            if (i < start || i >= end) {
+                setWindow(Math.max(0, i - REVEAL_MARGIN), Math.min(blocks.length, i + REVEAL_MARGIN));
+            }
+            const rect = blocks[i].nodeType === Node.ELEMENT_NODE ? blocks[i].getBoundingClientRect() : null;
+            if (rect && (rect.top < 0 || rect.bottom > window.innerHeight)) {
+                window.scrollBy(0, rect.top - window.innerHeight / 3);
+            }
+        },
+        // History replays child list records against the store: these make
+        // sure the blocks involved are in the DOM first.
+        modelNext(node) {
+            if (node !== null && !isSpacer(node)) return node;
+            return node === topSpacer ? blocks[start] || null : blocks[end] || null;
+        },
+        ensureLive(nodes, next) {
+            const all = next ? [...nodes, next] : nodes;
+            const indices = [];
+            for (const node of all) {
+                if (!node.isConnected && members.has(node)) indices.push(blocks.indexOf(node));
+            }
+            if (!next && end < blocks.length) indices.push(blocks.length - 1);
+            if (!indices.length) return;
+            // Blocks already in the DOM must stay there
+            if (all.some(node => node.isConnected)) indices.push(start, end - 1);
+            setWindow(Math.max(0, Math.min(...indices) - REVEAL_MARGIN),
+                      Math.min(blocks.length, Math.max(...indices) + 1 + REVEAL_MARGIN));
+        },
+    };
+
+    window.addEventListener('scroll', schedule, {passive: true});
+    window.addEventListener('resize', onResize);
+    document.addEventListener('keydown', event => {
+        // Select all has to cover the whole document
+        if (virtual.active && (event.ctrlKey || event.metaKey) && event.key.toLowerCase() === 'a') {
+            virtual.disable();
+        }
+    }, true);
+})();
+"""
+
+# Tracks dirty top-level blocks so a save only re-serializes what changed.
+# Python keeps the serialized blocks; JS only tells it which ids to refresh.
+SAVE_ENGINE_JS = r"""
+(function() {
+    const wiziwig = window.wiziwig;
+    if (!wiziwig || wiziwig.save) return;
+    const ids = new WeakMap();
+    let nextId = 1;
+    let dirty = new Set();
+    let sent = new Set();
+    let structureChanged = false;
+    let headChanged = false;
+    let queue = [];
+    let queuePos = 0;
+
+    function idOf(node) {
+        let id = ids.get(node);
+        if (!id) {
+            id = nextId++;
+            ids.set(node, id);
+        }
+        return id;
+    }
+    const openTag = el => '<' + el.localName + Array.from(el.attributes,
+        a => ' ' + a.name + '="' + wiziwig.escapeAttr(a.value) + '"').join('') + '>';
+
+    wiziwig.observe(records => {
+        const body = document.body;
+        for (const record of records) {
+            const target = record.target;
+            if (target === body) {
+                if (record.type === 'childList') structureChanged = true;
+                else headChanged = true;
+            } else if (target === document.documentElement || document.head.contains(target)) {
+                headChanged = true;
+            } else {
+                const top = wiziwig.topLevelNode(target);
+                if (top && ids.has(top)) dirty.add(ids.get(top));
+            }
+        }
+    });
+
+    wiziwig.save = {
+        begin(needOrder) {
+            if (wiziwig.styleClasses) wiziwig.styleClasses.collect();
+            wiziwig.flushMutations();
+            const clean = !structureChanged && !headChanged && dirty.size === 0;
+            const order = [];
+            const live = new Set();
+            queue = [];
+            queuePos = 0;
+            for (const node of wiziwig.blocks()) {
+                const id = idOf(node);
+                order.push(id);
+                live.add(id);
+                if (!sent.has(id) || dirty.has(id)) queue.push(node);
+            }
+            for (const id of sent) {
+                if (!live.has(id)) sent.delete(id);
+            }
+            const state = {
+                clean: clean,
+                order: (needOrder || structureChanged) ? order : null,
+                pending: queue.length,
+                prologue: '<!DOCTYPE html>\n' + openTag(document.documentElement) +
+                    document.head.outerHTML + openTag(document.body),
+                epilogue: '</body></html>',
+            };
+            dirty.clear();
+            structureChanged = false;
+            headChanged = false;
+            return JSON.stringify(state);
+        },
+        next(maxChars) {
+            const blocks = [];
+            let size = 0;
+            while (queuePos < queue.length && size < maxChars) {
+                const node = queue[queuePos++];
+                const html = wiziwig.serializeNode(node);
+                const id = ids.get(node);
+                blocks.push([id, html]);
+                sent.add(id);
+                size += html.length;
+            }
+            if (queuePos >= queue.length) queue = [];
+            return JSON.stringify({blocks: blocks, done: queue.length === 0});
+        },
+        forget() {
+            sent.clear();
+            structureChanged = true;
+        },
+    };
+})();
+"""
+
+# Records top-level block deltas for crash recovery. Ids 1..n are the body
+# children of the base document in order; batches are posted to Python after
+# a short idle period so typing never waits on serialization or disk.
+JOURNAL_JS = r"""
+(function() {
+    const wiziwig = window.wiziwig;
+    if (!wiziwig || wiziwig.journal) return;
+    const FLUSH_DELAY = 1000;
+    const MAX_DELAY = 5000;
+    let ids = new WeakMap();
+    let nextId = 1;
+    let active = false;
+    let dirty = new Set();
+    let inserted = new Set();
+    let removed = [];
+    let headChanged = false;
+    let timer = 0;
+    let firstPending = 0;
+    // Whether anything was recorded since the journal started
+    let posted = false;
+
+    function schedule() {
+        const now = Date.now();
+        if (!timer) firstPending = now;
+        clearTimeout(timer);
+        timer = setTimeout(flush, Math.max(0, Math.min(FLUSH_DELAY, MAX_DELAY - (now - firstPending))));
+    }
+
+    function flush() {
+        clearTimeout(timer);
+        timer = 0;
+        if (!active) return;
+        wiziwig.flushMutations();
+        const batch = {};
+        if (removed.length) batch.d = removed;
+        const added = Array.from(inserted).filter(wiziwig.isBlock);
+        if (wiziwig.virtual.active && added.length > 1) {
+            const index = new Map();
+            for (const node of wiziwig.blocks()) index.set(node, index.size);
+            added.sort((a, b) => index.get(a) - index.get(b));
+        } else {
+            added.sort((a, b) => (a.compareDocumentPosition(b) & Node.DOCUMENT_POSITION_FOLLOWING) ? -1 : 1);
+        }
+        if (added.length) {
+            batch.i = added.map(node => {
+                const id = nextId++;
+                ids.set(node, id);
+                const prev = wiziwig.previousBlock(node);
+                return [id, prev ? ids.get(prev) || 0 : 0, wiziwig.serializeNode(node)];
+            });
+        }
+        const changed = [];
+        for (const node of dirty) {
+            if (wiziwig.isBlock(node) && ids.has(node)) changed.push([ids.get(node), wiziwig.serializeNode(node)]);
+        }
+        if (changed.length) batch.s = changed;
+        if (headChanged) batch.h = document.head.innerHTML;
+        removed = [];
+        inserted = new Set();
+        dirty = new Set();
+        headChanged = false;
+        if (Object.keys(batch).length) {
+            posted = true;
+            wiziwig.post('journal', batch);
+        }
+    }
+
+    wiziwig.observe(records => {
+        if (!active) return;
+        const body = document.body;
+        for (const record of records) {
+            const target = record.target;
+            if (target === body) {
+                if (record.type !== 'childList') continue;
+                for (const node of record.removedNodes) {
+                    if (inserted.delete(node)) continue;
+                    if (ids.has(node)) {
+                        removed.push(ids.get(node));
+                        ids.delete(node);
+                    }
+                }
+                for (const node of record.addedNodes) inserted.add(node);
+            } else if (document.head.contains(target)) {
+                headChanged = true;
+            } else {
+                const top = wiziwig.topLevelNode(target);
+                if (top && ids.has(top)) dirty.add(top);
+            }
+        }
+        schedule();
+    });
+    window.addEventListener('pagehide', flush);
+
+    wiziwig.journal = {
+        // Starts a fresh journal against the document as it is now. A full
+        // journal also records every block, for when the loaded file is no
+        // longer a usable base.
+        start(full) {
+            wiziwig.flushMutations();
+            ids = new WeakMap();
+            nextId = 1;
+            dirty = new Set();
+            for (const node of wiziwig.blocks()) {
+                ids.set(node, nextId++);
+                if (full) dirty.add(node);
+            }
+            inserted = new Set();
+            removed = [];
+            headChanged = !!full;
+            posted = false;
+            active = true;
+            if (full) schedule();
+            return nextId - 1;
+        },
+        stop() {
+            active = false;
+            clearTimeout(timer);
+            timer = 0;
+        },
+        flush: flush,
+        // True when the document changed since the journal started
+        modified() {
+            wiziwig.flushMutations();
+            return posted || dirty.size > 0 || inserted.size > 0 || removed.length > 0 || headChanged;
+        },
+        // Rebuilds the body from the base document plus a replayed model.
+        restore(model) {
+            const body = document.body;
+            const base = Array.from(wiziwig.blocks());
+            if (!model.full && base.length !== model.n) return false;
+            wiziwig.virtual.disable();
+            active = false;
+            const html = new Map(model.html);
+            const fragment = document.createDocumentFragment();
+            const range = document.createRange();
+            range.selectNodeContents(body);
+            ids = new WeakMap();
+            for (const id of model.order) {
+                let node;
+                if (html.has(id)) {
+                    node = range.createContextualFragment(html.get(id)).firstChild;
+                } else {
+                    node = base[id - 1];
+                }
+                if (!node) continue;
+                ids.set(node, id);
+                fragment.appendChild(node);
+            }
+            if (model.head !== null) document.head.innerHTML = model.head;
+            body.replaceChildren(fragment);
+            wiziwig.flushMutations();
+            wiziwig.history.clear();
+            nextId = model.next_id;
+            dirty = new Set();
+            inserted = new Set();
+            removed = [];
+            headChanged = false;
+            posted = true;
+            active = true;
+            return true;
+        },
+    };
+})();
+"""
+
+# Incremental per-block text index with non-mutating highlights. Plain text
+# is matched in the page; regular expressions run in a worker that is
+# terminated when it exceeds its time budget.
+FIND_ENGINE_JS = r"""
+(function() {
+    const wiziwig = window.wiziwig;
+    if (!wiziwig || wiziwig.find) return;
+    const SKIP = new Set(['script', 'style', 'template']);
+    const MATCH_LIMIT = 100000;
+    const WORKER_SOURCE = `
+        const texts = new Map();
+        onmessage = event => {
+            const {seq, order, updates, pattern, flags, limit} = event.data;
+            for (const [id, text] of updates) texts.set(id, text);
+            if (texts.size > order.length) {
+                const live = new Set(order);
+                for (const id of texts.keys()) if (!live.has(id)) texts.delete(id);
+            }
+            let regex;
+            try {
+                regex = new RegExp(pattern, flags);
+            } catch (err) {
+                postMessage({seq: seq, error: err.message});
+                return;
+            }
+            const matches = [];
+            outer: for (const id of order) {
+                const text = texts.get(id);
+                if (!text) continue;
+                regex.lastIndex = 0;
+                let m;
+                while ((m = regex.exec(text))) {
+                    if (!m[0].length) {
+                        regex.lastIndex++;
+                        continue;
+                    }
+                    matches.push(id, m.index, m.index + m[0].length);
+                    if (matches.length >= limit * 3) break outer;
+                }
+            }
+            postMessage({seq: seq, matches: matches});
+        };
+    `;
+    const supported = !!(window.CSS && CSS.highlights && window.Highlight);
+    let blocks = null;
+    let entries = new WeakMap();
+    let blockIds = new WeakMap();
+    let nextBlockId = 1;
+    let workerSynced = new WeakSet();
+    let worker = null;
+    let workerTimer = 0;
+    let workerSeq = 0;
+    let query = null;
+    let matches = [];
+    let current = -1;
+    let stale = false;
+    let researchTimer = 0;
+
+    wiziwig.observe(records => {
+        const body = document.body;
+        for (const record of records) {
+            if (record.target === body) {
+                if (record.type === 'childList') blocks = null;
+                continue;
+            }
+            const top = wiziwig.topLevelNode(record.target);
+            if (top) {
+                entries.delete(top);
+                workerSynced.delete(top);
+            }
+        }
+        if (query && !stale) {
+            stale = true;
+            clearTimeout(researchTimer);
+            researchTimer = setTimeout(() => run(false), 300);
+        }
+    });
+
+    function indexBlock(block) {
+        const nodes = [];
+        const starts = [];
+        let text = '';
+        if (block.nodeType === Node.TEXT_NODE) {
+            nodes.push(block);
+            starts.push(0);
+            text = block.data;
+        } else if (block.nodeType === Node.ELEMENT_NODE && !SKIP.has(block.localName)) {
+            const walker = document.createTreeWalker(block, NodeFilter.SHOW_TEXT, {
+                acceptNode: node => SKIP.has(node.parentNode.localName) ? NodeFilter.FILTER_REJECT : NodeFilter.FILTER_ACCEPT
+            });
+            let node;
+            while ((node = walker.nextNode())) {
+                nodes.push(node);
+                starts.push(text.length);
+                text += node.data;
+            }
+        }
+        return {text: text, lower: null, nodes: nodes, starts: starts};
+    }
+    function entryFor(block) {
+        let entry = entries.get(block);
+        if (!entry) {
+            entry = indexBlock(block);
+            entries.set(block, entry);
+        }
+        return entry;
+    }
+    function currentBlocks() {
+        if (!blocks) blocks = Array.from(wiziwig.blocks());
+        return blocks;
+    }
+    function idOf(block) {
+        let id = blockIds.get(block);
+        if (!id) {
+            id = nextBlockId++;
+            blockIds.set(block, id);
+        }
+        return id;
+    }
+    // Maps a text offset inside a block to a (text node, offset) position.
+    function locate(entry, offset, isEnd) {
+        const starts = entry.starts;
+        let lo = 0, hi = starts.length - 1;
+        while (lo < hi) {
+            const mid = (lo + hi + 1) >> 1;
+            if (starts[mid] < offset || (!isEnd && starts[mid] === offset)) lo = mid;
+            else hi = mid - 1;
+        }
+        return [entry.nodes[lo], offset - starts[lo], lo];
+    }
+    function makeRange(block, start, end) {
+        const entry = entryFor(block);
+        const range = document.createRange();
+        const [startNode, startOffset] = locate(entry, start, false);
+        const [endNode, endOffset] = locate(entry, end, true);
+        range.setStart(startNode, startOffset);
+        range.setEnd(endNode, endOffset);
+        return range;
+    }
+
+    function report(extra) {
+        wiziwig.post('find', Object.assign({
+            seq: query ? query.seq : 0,
+            count: matches.length,
+            current: current,
+            limited: matches.length >= MATCH_LIMIT,
+        }, extra || {}));
+    }
+    function paint() {
+        if (!supported) return;
+        // Added one by one: spreading up to MATCH_LIMIT ranges as arguments
+        // would exceed the engine's limit on call arguments.
+        const highlight = new Highlight();
+        for (const m of matches) highlight.add(m.range);
+        CSS.highlights.set('wiziwig-find', highlight);
+        if (current >= 0 && matches[current]) {
+            CSS.highlights.set('wiziwig-find-current', new Highlight(matches[current].range));
+        } else {
+            CSS.highlights.delete('wiziwig-find-current');
+        }
+    }
+    function reveal() {
+        const match = matches[current];
+        if (!match) return;
+        if (!match.block.isConnected) {
+            wiziwig.virtual.reveal(match.block);
+            match.range = makeRange(match.block, match.start, match.end);
+            paint();
+        }
+        const rect = match.range.getBoundingClientRect();
+        if (rect.top < 0 || rect.bottom > window.innerHeight) {
+            window.scrollBy(0, rect.top - window.innerHeight / 3);
+        }
+        const selection = window.getSelection();
+        selection.removeAllRanges();
+        selection.addRange(match.range.cloneRange());
+    }
+    function finish(found, moveToFirst) {
+        matches = found;
+        stale = false;
+        if (!matches.length) current = -1;
+        else if (moveToFirst || current < 0) current = 0;
+        else current = Math.min(current, matches.length - 1);
+        paint();
+        if (moveToFirst) reveal();
+        report();
+    }
+
+    function collectPlain(options) {
+        const limit = options.limit || MATCH_LIMIT;
+        const caseSensitive = options.caseSensitive;
+        const needle = caseSensitive ? options.text : options.text.toLowerCase();
+        const found = [];
+        for (const block of currentBlocks()) {
+            const entry = entryFor(block);
+            let haystack = entry.text;
+            if (!caseSensitive) {
+                if (entry.lower === null) entry.lower = entry.text.toLowerCase();
+                haystack = entry.lower;
+            }
+            let index = haystack.indexOf(needle);
+            while (index !== -1 && found.length < limit) {
+                found.push({block: block, text: entry.text, start: index, end: index + needle.length});
+                index = haystack.indexOf(needle, index + needle.length);
+            }
+        }
+        return found;
+    }
+
+    function resetWorker() {
+        if (worker) worker.terminate();
+        worker = null;
+        workerSynced = new WeakSet();
+        clearTimeout(workerTimer);
+    }
+    function collectRegex(options, done, fail) {
+        if (!worker) {
+            try {
+                worker = new Worker(URL.createObjectURL(new Blob([WORKER_SOURCE], {type: 'text/javascript'})));
+            } catch (err) {
+                fail('Regular expressions are unavailable: ' + err.message);
+                return;
+            }
+        }
+        const order = [];
+        const updates = [];
+        const byId = new Map();
+        const texts = new Map();
+        for (const block of currentBlocks()) {
+            const id = idOf(block);
+            const text = entryFor(block).text;
+            order.push(id);
+            byId.set(id, block);
+            texts.set(id, text);
+            if (!workerSynced.has(block)) {
+                updates.push([id, text]);
+                workerSynced.add(block);
+            }
+        }
+        const seq = ++workerSeq;
+        worker.onmessage = event => {
+            const data = event.data;
+            if (data.seq !== seq) return;
+            clearTimeout(workerTimer);
+            if (data.error) {
+                fail(data.error);
+                return;
+            }
+            const found = [];
+            const raw = data.matches;
+            for (let i = 0; i < raw.length; i += 3) {
+                const block = byId.get(raw[i]);
+                if (block && wiziwig.isBlock(block)) {
+                    found.push({block: block, text: texts.get(raw[i]), start: raw[i + 1], end: raw[i + 2]});
+                }
+            }
+            done(found);
+        };
+        clearTimeout(workerTimer);
+        workerTimer = setTimeout(() => {
+            if (seq !== workerSeq) return;
+            resetWorker();
+            fail('Search took too long and was stopped');
+        }, options.budget);
+        worker.postMessage({seq: seq, order: order, updates: updates, pattern: options.text,
+                            flags: options.caseSensitive ? 'g' : 'gi', limit: options.limit || MATCH_LIMIT});
+    }
+    // Calls done() with [{block, text, start, end}] in document order, where
+    // the offsets index into text, the block's text when it was searched.
+    function collect(options, done, fail) {
+        wiziwig.flushMutations();
+        if (options.regex) collectRegex(options, done, fail);
+        else done(collectPlain(options));
+    }
+
+    function run(moveToFirst) {
+        const searched = query;
+        if (!searched) return;
+        collect(searched, found => {
+            if (searched !== query) return;
+            for (const m of found) m.range = makeRange(m.block, m.start, m.end);
+            finish(found, moveToFirst);
+        }, error => {
+            if (searched !== query) return;
+            matches = [];
+            current = -1;
+            stale = false;
+            paint();
+            report({error: error});
+        });
+    }
+
+    wiziwig.find = {
+        supported: supported,
+        search(options) {
+            if (!supported) return false;
+            query = options;
+            clearTimeout(researchTimer);
+            run(true);
+            return true;
+        },
+        step(delta) {
+            if (!matches.length) return;
+            current = (current + delta + matches.length) % matches.length;
+            paint();
+            reveal();
+            report();
+        },
+        clear() {
+            query = null;
+            matches = [];
+            current = -1;
+            clearTimeout(researchTimer);
+            clearTimeout(workerTimer);
+            if (supported) {
+                CSS.highlights.delete('wiziwig-find');
+                CSS.highlights.delete('wiziwig-find-current');
+            }
+        },
+        // Ranges are live and collapse when a virtualized block leaves the
+        // DOM, so they are rebuilt for the blocks that came back.
+        refreshRanges() {
+            if (!matches.length) return;
+            for (const m of matches) {
+                if (m.block.isConnected) m.range = makeRange(m.block, m.start, m.end);
+            }
+            paint();
+        },
+        // Shared with replace: match collection and text offset mapping.
+        collect: collect,
+        entryFor: entryFor,
+        locate: locate,
+    };
+})();
+"""
+
+# Editor-owned undo history. Steps hold the raw mutation records of the body,
+# so undo and redo cost O(size of change) however large the document is.
+# Typing and deleting runs are grouped; the oldest steps are evicted once the
+# estimated memory use passes the limit.
+HISTORY_JS = r"""
+(function() {
+    const wiziwig = window.wiziwig;
+    if (!wiziwig || wiziwig.history) return;
+    const GROUP_MS = 1000;
+    const RECORD_BYTES = 48;
+    const GROUPED = {
+        insertText: 'typing', insertCompositionText: 'typing', insertReplacementText: 'typing',
+        deleteContentBackward: 'deleting', deleteContentForward: 'deleting',
+    };
+    const NAVIGATION_KEYS = new Set(['ArrowLeft', 'ArrowRight', 'ArrowUp', 'ArrowDown',
+                                     'Home', 'End', 'PageUp', 'PageDown']);
+    let limit = 64 * 1024 * 1024;
+    let undoStack = [];
+    let redoStack = [];
+    let bytes = 0;
+    // Kind of the step the next recorded mutations open, or null to extend
+    // the current one.
+    let nextKind = 'edit';
+    let held = false;
+    let ambient = 0;
+    let reportTimer = 0;
+
+    const textBytes = node => 2 * (node.nodeType === Node.ELEMENT_NODE ? node.outerHTML.length
+                                                                        : (node.data || '').length);
+    function recordBytes(record) {
+        let size = RECORD_BYTES;
+        for (const value of record) {
+            if (typeof value === 'string') size += 2 * value.length;
+            else if (Array.isArray(value)) for (const node of value) size += textBytes(node);
+        }
+        return size;
+    }
+
+    function report() {
+        if (reportTimer) return;
+        reportTimer = setTimeout(() => {
+            reportTimer = 0;
+            wiziwig.post('history', wiziwig.history.stats());
+        }, 500);
+    }
+    function evict() {
+        while (bytes > limit && undoStack.length > 1) bytes -= undoStack.shift().bytes;
+    }
+    function dropRedo() {
+        for (const step of redoStack) bytes -= step.bytes;
+        redoStack = [];
+    }
+
+    wiziwig.observe(records => {
+        if (wiziwig.history.applying) return;
+        const head = document.head;
+        let step = undoStack[undoStack.length - 1];
+        // Follow-up changes made by the editor itself join the last step;
+        // before the first step there is nothing they could be undone past.
+        if (ambient && !step) return;
+        let recorded = false;
+        // A text change is kept as the slice that differs. Its new value is
+        // the old value of the next change to the same node in this batch,
+        // or the node's current text.
+        const later = new Map();
+        const newValues = new Map();
+        for (let i = records.length - 1; i >= 0; i--) {
+            const record = records[i];
+            if (record.type !== 'characterData') continue;
+            newValues.set(record, later.has(record.target) ? later.get(record.target) : record.target.data);
+            later.set(record.target, record.oldValue);
+        }
+        for (const record of records) {
+            const target = record.target;
+            // Nodes detached later in the same batch still belong to the body
+            if (target === document.documentElement || head.contains(target)) continue;
+            let compact;
+            if (record.type === 'characterData') {
+                const before = record.oldValue || '';
+                const after = newValues.get(record) || '';
+                const prefix = commonPrefix(before, after);
+                const suffix = commonSuffix(before, after, prefix);
+                compact = ['c', target, prefix, before.slice(prefix, before.length - suffix),
+                           after.slice(prefix, after.length - suffix)];
+            } else if (record.type === 'attributes') {
+                compact = ['a', target, record.attributeName, record.oldValue, null];
+            } else {
+                let next = record.nextSibling;
+                if (target === document.body && wiziwig.virtual.active) next = wiziwig.virtual.modelNext(next);
+                compact = ['l', target, Array.from(record.removedNodes), Array.from(record.addedNodes), next];
+            }
+            if (!ambient && (!step || nextKind)) {
+                step = {kind: nextKind || 'edit', records: [], bytes: 0, time: 0};
+                undoStack.push(step);
+                nextKind = null;
+            }
+            const size = recordBytes(compact);
+            step.records.push(compact);
+            step.bytes += size;
+            step.time = Date.now();
+            bytes += size;
+            recorded = true;
+        }
+        if (recorded) {
+            dropRedo();
+            evict();
+            report();
+        }
+    });
+
+    function caretAt(node, offset) {
+        if (!node || !node.isConnected) return;
+        const selection = window.getSelection();
+        try {
+            selection.collapse(node, offset);
+        } catch (e) {
+            // Offsets past the end of a node that changed again
+        }
+    }
+    // Puts the caret just inside the end of node, or the start of next, or
+    // else the end of target. Positions come from the nodes themselves:
+    // looking up an index among the body's children is O(document).
+    function caretBeside(target, node, next) {
+        const at = node || next;
+        if (!at) {
+            if (!target.isConnected) return;
+            const range = document.createRange();
+            range.selectNodeContents(target);
+            range.collapse(false);
+            const selection = window.getSelection();
+            selection.removeAllRanges();
+            selection.addRange(range);
+            return;
+        }
+        if (at.nodeType === Node.TEXT_NODE) {
+            caretAt(at, node ? at.length : 0);
+        } else if (at.firstChild) {
+            caretAt(at, node ? at.childNodes.length : 0);
+        } else if (at.isConnected) {
+            const range = document.createRange();
+            if (node) range.setStartAfter(at);
+            else range.setStartBefore(at);
+            const selection = window.getSelection();
+            selection.removeAllRanges();
+            selection.addRange(range);
+        }
+    }
+    function commonPrefix(a, b) {
+        let i = 0;
+        const n = Math.min(a.length, b.length);
+        while (i < n && a.charCodeAt(i) === b.charCodeAt(i)) i++;
+        return i;
+    }
+    // Length of the common suffix that does not overlap the first prefix
+    function commonSuffix(a, b, prefix) {
+        let i = 0;
+        const n = Math.min(a.length, b.length) - prefix;
+        while (i < n && a.charCodeAt(a.length - 1 - i) === b.charCodeAt(b.length - 1 - i)) i++;
+        return i;
+    }
+    function setAttribute(el, name, value) {
+        if (value === null) el.removeAttribute(name);
+        else el.setAttribute(name, value);
+    }
+
+    // The DOM is always in the state right after the step when it is undone
+    // and right before it when redone, so records apply without searching.
+    function revert(step) {
+        let caret = null;
+        for (let i = step.records.length - 1; i >= 0; i--) {
+            const record = step.records[i];
+            const target = record[1];
+            if (record[0] === 'c') {
+                // Out of range only if the node changed outside the history
+                if (record[2] + record[4].length > target.length) continue;
+                target.replaceData(record[2], record[4].length, record[3]);
+                caret = () => caretAt(target, record[2] + record[3].length);
+            } else if (record[0] === 'a') {
+                record[4] = target.getAttribute(record[2]);
+                setAttribute(target, record[2], record[3]);
+            } else {
+                if (target === document.body && wiziwig.virtual.active) {
+                    wiziwig.virtual.ensureLive(record[3], record[4]);
+                }
+                for (const node of record[3]) if (node.parentNode === target) node.remove();
+                const next = record[4] && record[4].parentNode === target ? record[4] : null;
+                for (const node of record[2]) target.insertBefore(node, next);
+                const last = record[2][record[2].length - 1];
+                caret = () => caretBeside(target, last, next);
+            }
+        }
+        return caret;
+    }
+    function replay(step) {
+        let caret = null;
+        for (const record of step.records) {
+            const target = record[1];
+            if (record[0] === 'c') {
+                if (record[2] + record[3].length > target.length) continue;
+                target.replaceData(record[2], record[3].length, record[4]);
+                caret = () => caretAt(target, record[2] + record[4].length);
+            } else if (record[0] === 'a') {
+                setAttribute(target, record[2], record[4]);
+            } else {
+                if (target === document.body && wiziwig.virtual.active) {
+                    wiziwig.virtual.ensureLive(record[2], record[4]);
+                }
+                for (const node of record[2]) if (node.parentNode === target) node.remove();
+                const next = record[4] && record[4].parentNode === target ? record[4] : null;
+                for (const node of record[3]) target.insertBefore(node, next);
+                const last = record[3][record[3].length - 1];
+                caret = () => caretBeside(target, last, next);
+            }
+        }
+        return caret;
+    }
+    function apply(from, to, change) {
+        if (held) return false;
+        wiziwig.flushMutations();
+        const step = from.pop();
+        if (!step) return false;
+        wiziwig.history.applying = true;
+        let caret;
+        try {
+            caret = change(step);
+            // Save and journal see the change; the history does not
+            wiziwig.flushMutations();
+        } finally {
+            wiziwig.history.applying = false;
+        }
+        to.push(step);
+        nextKind = 'edit';
+        if (caret) caret();
+        report();
+        return true;
+    }
+
+    wiziwig.history = {
+        applying: false,
+        // Makes the next recorded mutation open a new step. With hold, every
+        // mutation until end() joins that step.
+        begin(kind, hold) {
+            wiziwig.flushMutations();
+            if (held) return;
+            nextKind = kind;
+            held = !!hold;
+        },
+        // Runs fn, attaching its mutations to the last step instead of
+        // starting a new one.
+        ambient(fn) {
+            wiziwig.flushMutations();
+            ambient++;
+            try {
+                return fn();
+            } finally {
+                wiziwig.flushMutations();
+                ambient--;
+            }
+        },
+        end() {
+            wiziwig.flushMutations();
+            held = false;
+            nextKind = 'edit';
+        },
+        undo() {
+            return apply(undoStack, redoStack, revert);
+        },
+        redo() {
+            return apply(redoStack, undoStack, replay);
+        },
+        clear() {
+            wiziwig.flushMutations();
+            undoStack = [];
+            redoStack = [];
+            bytes = 0;
+            nextKind = 'edit';
+            report();
+        },
+        setLimit(maxBytes) {
+            limit = maxBytes;
+            evict();
+        },
+        stats() {
+            return {depth: undoStack.length, redo: redoStack.length, bytes: bytes, limit: limit};
+        },
+    };
+
+    document.addEventListener('beforeinput', event => {
+        if (event.inputType === 'historyUndo' || event.inputType === 'historyRedo') {
+            event.preventDefault();
+            if (event.inputType === 'historyUndo') wiziwig.history.undo();
+            else wiziwig.history.redo();
+            return;
+        }
+        if (held) return;
+        wiziwig.flushMutations();
+        const kind = GROUPED[event.inputType] || event.inputType;
+        const step = undoStack[undoStack.length - 1];
+        const grouped = GROUPED[event.inputType] && !nextKind && step && step.kind === kind &&
+                        Date.now() - step.time < GROUP_MS;
+        if (!grouped) nextKind = kind;
+    }, true);
+    document.addEventListener('keydown', event => {
+        if (NAVIGATION_KEYS.has(event.key)) {
+            nextKind = nextKind || 'edit';
+            return;
+        }
+        if (!(event.ctrlKey || event.metaKey) || event.altKey) return;
+        const key = event.key.toLowerCase();
+        if (key === 'z' && !event.shiftKey) {
+            event.preventDefault();
+            wiziwig.history.undo();
+        } else if (key === 'y' || (key === 'z' && event.shiftKey)) {
+            event.preventDefault();
+            wiziwig.history.redo();
+        }
+    }, true);
+    document.addEventListener('mousedown', () => {
+        nextKind = nextKind || 'edit';
+    }, true);
+})();
+"""
+
+# Replace-all edits only the text nodes holding matches, a slice of blocks at
+# a time, and records the whole operation as one undo step.
+REPLACE_ENGINE_JS = r"""
+(function() {
+    const wiziwig = window.wiziwig;
+    if (!wiziwig || wiziwig.replace) return;
+    const BLOCKS_PER_SLICE = 200;
+    const TEMPLATE = /\$([$&`']|\d\d?|<[^>]*>)/g;
+
+    // String.prototype.replace's $-substitutions for a match found in text
+    function expand(template, m, text) {
+        return template.replace(TEMPLATE, (token, key) => {
+            if (key === '$') return '$';
+            if (key === '&') return m[0];
+            if (key === '`') return text.slice(0, m.index);
+            if (key === "'") return text.slice(m.index + m[0].length);
+            if (key[0] === '<') {
+                if (!m.groups) return token;
+                const value = m.groups[key.slice(1, -1)];
+                return value === undefined ? '' : value;
+            }
+            let n = parseInt(key, 10);
+            if (key.length === 2 && (n === 0 || n >= m.length)) {
+                n = parseInt(key[0], 10);
+                if (n === 0 || n >= m.length) return token;
+                return (m[n] === undefined ? '' : m[n]) + key[1];
+            }
+            if (n === 0 || n >= m.length) return token;
+            return m[n] === undefined ? '' : m[n];
+        });
+    }
+
+    function replaceAll(options, found) {
+        const locate = wiziwig.find.locate;
+        // Sticky, so each match is re-run in place against its whole block
+        // and lookarounds and anchors see the same context as the search.
+        const regex = options.regex ? new RegExp(options.text, options.caseSensitive ? 'y' : 'iy') : null;
+        const groups = [];
+        let group = null;
+        for (const m of found) {
+            if (!group || group.block !== m.block) {
+                group = {block: m.block, text: m.text, matches: []};
+                groups.push(group);
+            }
+            group.matches.push(m);
+        }
+        let index = 0;
+        let count = 0;
+
+        function replaceInBlock(group) {
+            if (!wiziwig.isBlock(group.block)) return 0;
+            const entry = wiziwig.find.entryFor(group.block);
+            // Skip blocks edited since they were searched: offsets are stale.
+            if (entry.text !== group.text) return 0;
+            // Back to front so earlier offsets in the block stay valid.
+            let replaced = 0;
+            for (let i = group.matches.length - 1; i >= 0; i--) {
+                const m = group.matches[i];
+                let replacement = options.replacement;
+                if (regex) {
+                    regex.lastIndex = m.start;
+                    const match = regex.exec(group.text);
+                    if (!match || match[0].length !== m.end - m.start) continue;
+                    replacement = expand(replacement, match, group.text);
+                }
+                replaced++;
+                const [startNode, startOffset, startIndex] = locate(entry, m.start, false);
+                const [endNode, endOffset, endIndex] = locate(entry, m.end, true);
+                if (startNode === endNode) {
+                    startNode.replaceData(startOffset, endOffset - startOffset, replacement);
+                    continue;
+                }
+                // A match spanning formatting keeps the first node's markup.
+                startNode.replaceData(startOffset, startNode.length - startOffset, replacement);
+                for (let k = startIndex + 1; k < endIndex; k++) entry.nodes[k].data = '';
+                endNode.deleteData(0, endOffset);
+            }
+            return replaced;
+        }
+        function slice() {
+            const end = Math.min(groups.length, index + BLOCKS_PER_SLICE);
+            for (; index < end; index++) count += replaceInBlock(groups[index]);
+            if (index < groups.length) {
+                wiziwig.post('replace', {seq: options.seq, done: index, total: groups.length, count: count});
+                setTimeout(slice, 0);
+                return;
+            }
+            wiziwig.history.end();
+            wiziwig.post('replace', {seq: options.seq, finished: true, count: count});
+        }
+        // Typing between slices joins the step too, keeping it contiguous
+        wiziwig.history.begin('replace', true);
+        slice();
+    }
+
+    wiziwig.replace = {
+        replaceAll(options) {
+            const query = Object.assign({}, options, {limit: Infinity});
+            wiziwig.find.collect(query, found => replaceAll(options, found),
+                                 error => wiziwig.post('replace', {seq: options.seq, error: error}));
+        },
+    };
+})();
+"""
+
+# Toolbar commands, preloaded once. Python sends [seq, name, args] batches
+# through CommandBridge and every batch is acknowledged with per-command
+# run times so round-trip latency can be tracked.
+COMMANDS_JS = r"""
+(function() {
+    const wiziwig = window.wiziwig;
+    if (!wiziwig || wiziwig.commands) return;
+    const THEME_STYLE_ID = 'dynamic-theme-style';
+    const THEME_CSS = `
+        @media (prefers-color-scheme: dark) {
+            body { background-color: #242424 !important; color: #e0e0e0 !important; }
+        }
+        @media (prefers-color-scheme: light) {
+            body { background-color: #ffffff !important; color: #000000 !important; }
+        }
+    `;
+
+    function selectRange(node) {
+        const selection = window.getSelection();
+        const range = document.createRange();
+        range.selectNodeContents(node);
+        selection.removeAllRanges();
+        selection.addRange(range);
+    }
+
+    const commands = wiziwig.commands = {
+        exec(command, value) {
+            document.execCommand(command, false, value === undefined ? null : value);
+        },
+        undo() {
+            wiziwig.history.undo();
+        },
+        redo() {
+            wiziwig.history.redo();
+        },
+        focusStart() {
+            const p = document.querySelector('p');
+            if (!p) return;
+            const range = document.createRange();
+            range.setStart(p, 0);
+            range.setEnd(p, 0);
+            const selection = window.getSelection();
+            selection.removeAllRanges();
+            selection.addRange(range);
+        },
+        darkMode(enabled) {
+            const existing = document.getElementById(THEME_STYLE_ID);
+            if (enabled && !existing) {
+                const style = document.createElement('style');
+                style.id = THEME_STYLE_ID;
+                style.textContent = THEME_CSS;
+                document.head.appendChild(style);
+            } else if (!enabled && existing) {
+                existing.remove();
+            }
+        },
+        fontFamily(family) {
+            const selection = window.getSelection();
+            if (!selection.rangeCount) return;
+            const range = selection.getRangeAt(0);
+            const ancestor = range.commonAncestorContainer;
+            const container = ancestor.nodeType === Node.ELEMENT_NODE ? ancestor : ancestor.parentElement;
+            const spans = container.querySelectorAll('span[style*="font-family"]');
+            if (spans.length > 0 && range.toString().length > 0) {
+                let updated = false;
+                spans.forEach(span => {
+                    if (range.intersectsNode(span)) {
+                        span.style.fontFamily = family;
+                        updated = true;
+                    }
+                });
+                if (updated) {
+                    const newRange = document.createRange();
+                    newRange.setStart(range.startContainer, range.startOffset);
+                    newRange.setEnd(range.endContainer, range.endOffset);
+                    selection.removeAllRanges();
+                    selection.addRange(newRange);
+                    return;
+                }
+            }
+            const contents = range.extractContents();
+            if (!contents.hasChildNodes()) {
+                range.insertNode(contents);
+                return;
+            }
+            const span = document.createElement('span');
+            span.style.fontFamily = family;
+            span.appendChild(contents);
+            range.insertNode(span);
+            selectRange(span);
+        },
+        fontSize(size) {
+            const selection = window.getSelection();
+            if (!selection.rangeCount) return;
+            const range = selection.getRangeAt(0);
+            const span = document.createElement('span');
+            span.style.fontSize = size + 'pt';
+            span.appendChild(range.extractContents());
+            for (const old of Array.from(span.querySelectorAll('span[style*="font-size"]'))) {
+                old.style.fontSize = '';
+                if (!old.getAttribute('style')) old.replaceWith(...old.childNodes);
+            }
+            range.insertNode(span);
+            selectRange(span);
+        },
+        insertImage(src, width, height) {
+            wiziwig.images.insert(src, width, height);
+        },
+        styleClasses() {
+            wiziwig.styleClasses.enable();
+        },
+        historyLimit(bytes) {
+            wiziwig.history.setLimit(bytes);
+        },
+        externalBaseline(clean) {
+            wiziwig.external.baseline(clean);
+        },
+        externalResolve(useDisk) {
+            wiziwig.external.resolve(useDisk);
+        },
+        virtualize(threshold) {
+            wiziwig.virtual.enable(threshold);
+        },
+        scrollTo(x, y) {
+            window.scrollTo(x, y);
+        },
+        refreshSelection() {
+            wiziwig.selectionState.refresh();
+        },
+        findStep(delta) {
+            wiziwig.find.step(delta);
+        },
+        findClear() {
+            wiziwig.find.clear();
+        },
+        replaceAll(options) {
+            wiziwig.find.clear();
+            wiziwig.replace.replaceAll(options);
+        },
+    };
+
+    // Commands that edit the body; each one is a separate undo step
+    const EDITS = new Set(['exec', 'fontFamily', 'fontSize', 'insertImage']);
+
+    wiziwig.run = function(batch) {
+        const acks = [];
+        for (const [seq, name, args] of batch) {
+            const start = performance.now();
+            let error = null;
+            try {
+                if (EDITS.has(name)) wiziwig.history.begin(name);
+                commands[name](...args);
+            } catch (err) {
+                error = name + ': ' + err;
+            }
+            acks.push([seq, performance.now() - start, error]);
+        }
+        wiziwig.post('ack', acks);
+    };
+})();
+"""
+
+# Formatting at the caret, recomputed at most once per animation frame.
+# Only fields that changed since the last report are posted to Python.
+SELECTION_STATE_JS = r"""
+(function() {
+    const wiziwig = window.wiziwig;
+    if (!wiziwig || wiziwig.selectionState) return;
+    const BLOCKS = 'h1,h2,h3,h4,h5,h6,p,div,li,blockquote,pre';
+    const ALIGN = {start: 'left', left: 'left', '-webkit-left': 'left', center: 'center',
+                   '-webkit-center': 'center', end: 'right', right: 'right', '-webkit-right': 'right',
+                   justify: 'justify'};
+    let last = {};
+    let frame = 0;
+
+    function compute() {
+        frame = 0;
+        const selection = window.getSelection();
+        if (!selection.rangeCount) return;
+        const node = selection.focusNode;
+        const element = node.nodeType === Node.ELEMENT_NODE ? node : node.parentElement;
+        if (!element || element === document.body || !document.body.contains(element)) return;
+        const style = getComputedStyle(element);
+        const block = element.closest(BLOCKS);
+        const list = element.closest('ul,ol');
+        const family = style.fontFamily.split(',')[0].trim().replace(/^["']|["']$/g, '');
+        const state = {
+            block: block && /^h[1-6]$/.test(block.localName) ? block.localName : 'normal',
+            font: family,
+            size: Math.round(parseFloat(style.fontSize) * 0.75 * 10) / 10,
+            bold: document.queryCommandState('bold'),
+            italic: document.queryCommandState('italic'),
+            underline: document.queryCommandState('underline'),
+            strikethrough: document.queryCommandState('strikeThrough'),
+            list: list ? list.localName : '',
+            align: ALIGN[style.textAlign] || 'left',
+            color: style.color,
+            background: style.backgroundColor,
+        };
+        const changed = {};
+        let any = false;
+        for (const key in state) {
+            if (state[key] !== last[key]) {
+                changed[key] = state[key];
+                any = true;
+            }
+        }
+        last = state;
+        if (any) wiziwig.post('selection', changed);
+    }
+    function schedule() {
+        if (!frame) frame = requestAnimationFrame(compute);
+    }
+    document.addEventListener('selectionchange', schedule);
+    document.addEventListener('input', schedule);
+
+    wiziwig.selectionState = {
+        // Resend every field, e.g. after Python reset its widgets.
+        refresh() {
+            last = {};
+            schedule();
+        },
+    };
+})();
+"""
+
+# Cleans up the spans left behind by repeated font changes. Mutated blocks are
+# normalized when the page is idle; a block holding the selection waits until
+# the caret leaves it so typing and native undo are not disturbed.
+NORMALIZE_JS = r"""
+(function() {
+    const wiziwig = window.wiziwig;
+    if (!wiziwig || wiziwig.normalize) return;
+    const IDLE_DELAY = 1000;
+    const SLICE_MS = 8;
+    // Inherited properties: equal computed values on the parent make the
+    // span's own declaration redundant.
+    const INHERITED = ['font-family', 'font-size', 'font-weight', 'font-style', 'font-variant',
+                       'color', 'letter-spacing', 'word-spacing', 'line-height', 'text-transform'];
+    // Declarations that can move from an only child onto its parent span.
+    const MERGEABLE = new Set([...INHERITED, 'background-color']);
+    const pending = new Set();
+    let timer = 0;
+    let running = false;
+
+    function schedule() {
+        clearTimeout(timer);
+        timer = setTimeout(() => {
+            if (window.requestIdleCallback) requestIdleCallback(run, {timeout: IDLE_DELAY});
+            else run(null);
+        }, IDLE_DELAY);
+    }
+    wiziwig.observe(records => {
+        if (running || wiziwig.history.applying) return;
+        for (const record of records) {
+            if (record.target === document.body) {
+                for (const node of record.addedNodes) {
+                    if (node.nodeType === Node.ELEMENT_NODE) pending.add(node);
+                }
+                continue;
+            }
+            const top = wiziwig.topLevelNode(record.target);
+            if (top && top.nodeType === Node.ELEMENT_NODE) pending.add(top);
+        }
+        if (pending.size) schedule();
+    });
+    document.addEventListener('selectionchange', () => {
+        if (pending.size) schedule();
+    });
+
+    function countNodes(root) {
+        const walker = document.createTreeWalker(root);
+        let count = 1;
+        while (walker.nextNode()) count++;
+        return count;
+    }
+    const plainSpan = node => node && node.nodeType === Node.ELEMENT_NODE && node.localName === 'span' &&
+        node.attributes.length === (node.hasAttribute('style') ? 1 : 0);
+    const blankText = node => node.nodeType === Node.TEXT_NODE && node.data === '';
+    const isEmpty = el => Array.from(el.childNodes).every(blankText);
+
+    function unwrap(el) {
+        el.replaceWith(...el.childNodes);
+    }
+    function dropInherited(span) {
+        const own = getComputedStyle(span);
+        const inherited = getComputedStyle(span.parentElement);
+        for (const name of Array.from(span.style)) {
+            if (INHERITED.includes(name) && own.getPropertyValue(name) === inherited.getPropertyValue(name)) {
+                span.style.removeProperty(name);
+            }
+        }
+        if (!span.style.length) span.removeAttribute('style');
+    }
+    function onlyChild(el) {
+        let found = null;
+        for (const child of el.childNodes) {
+            if (blankText(child)) continue;
+            if (found) return null;
+            found = child;
+        }
+        return found;
+    }
+    function mergeInto(target, span) {
+        for (const name of Array.from(span.style)) {
+            target.style.setProperty(name, span.style.getPropertyValue(name), span.style.getPropertyPriority(name));
+        }
+        unwrap(span);
+    }
+    function nextSpan(span) {
+        let next = span.nextSibling;
+        while (next && blankText(next)) next = next.nextSibling;
+        return next;
+    }
+
+    function normalizeBlock(block) {
+        // Descendants before ancestors, so emptied parents are seen as empty
+        const spans = Array.from(block.querySelectorAll('span')).reverse();
+        for (const span of spans) {
+            if (!span.isConnected) continue;
+            if (isEmpty(span)) {
+                span.remove();
+                continue;
+            }
+            if (!plainSpan(span)) continue;
+            dropInherited(span);
+            if (!span.attributes.length) {
+                unwrap(span);
+                continue;
+            }
+            const child = onlyChild(span);
+            if (plainSpan(child) && Array.from(child.style).every(name => MERGEABLE.has(name))) {
+                mergeInto(span, child);
+            }
+            let next = nextSpan(span);
+            while (plainSpan(next) && next.style.cssText === span.style.cssText) {
+                while (span.nextSibling !== next) span.nextSibling.remove();
+                span.append(...next.childNodes);
+                next.remove();
+                next = nextSpan(span);
+            }
+        }
+    }
+
+    function run(deadline) {
+        timer = 0;
+        wiziwig.flushMutations();
+        const selection = window.getSelection();
+        const range = selection.rangeCount ? selection.getRangeAt(0) : null;
+        const started = performance.now();
+        const timeLeft = () => deadline ? deadline.timeRemaining() > 1 : performance.now() - started < SLICE_MS;
+        const deferred = [];
+        let blocks = 0;
+        let before = 0;
+        let after = 0;
+        running = true;
+        try {
+            // The pass joins the last undo step. Save and journal still see
+            // its mutations, flushed before running is cleared.
+            wiziwig.history.ambient(() => {
+                for (const block of Array.from(pending)) {
+                    if (!timeLeft()) break;
+                    pending.delete(block);
+                    if (block.parentNode !== document.body) continue;
+                    if (range && range.intersectsNode(block)) {
+                        deferred.push(block);
+                        continue;
+                    }
+                    before += countNodes(block);
+                    normalizeBlock(block);
+                    after += countNodes(block);
+                    blocks++;
+                }
+            });
+        } finally {
+            running = false;
+        }
+        for (const block of deferred) pending.add(block);
+        if (blocks) wiziwig.post('normalize', {blocks: blocks, before: before, after: after});
+        if (pending.size > deferred.length) schedule();
+    }
+
+    wiziwig.normalize = {
+        block: normalizeBlock,
+    };
+})();
+"""
+
+# Optional class-based formatting. Inline style attributes are interned into
+# one generated class per distinct set of declarations, all kept in a single
+# <style> element in the head. Unused classes are dropped at save time.
+STYLE_CLASSES_JS = r"""
+(function() {
+    const wiziwig = window.wiziwig;
+    if (!wiziwig || wiziwig.styleClasses) return;
+    const STYLE_ID = 'wiziwig-classes';
+    const CLASS_RE = /^\.(wz-(\d+))$/;
+    const classes = new Map();
+    const byKey = new Map();
+    let nextClass = 1;
+    let enabled = false;
+    let sheetChanged = false;
+
+    function declarations(style) {
+        const decls = new Map();
+        for (const name of Array.from(style)) {
+            const priority = style.getPropertyPriority(name);
+            decls.set(name, style.getPropertyValue(name) + (priority ? ' !important' : ''));
+        }
+        return decls;
+    }
+    const keyOf = decls => Array.from(decls).sort((a, b) => a[0] < b[0] ? -1 : 1)
+        .map(([name, value]) => name + ': ' + value).join('; ');
+
+    function load() {
+        // Classes interned when the document was last edited in this mode
+        const style = document.getElementById(STYLE_ID);
+        if (!style || !style.sheet) return;
+        for (const rule of style.sheet.cssRules) {
+            const match = CLASS_RE.exec(rule.selectorText || '');
+            if (!match) continue;
+            const decls = declarations(rule.style);
+            const key = keyOf(decls);
+            classes.set(match[1], {key: key, decls: decls});
+            byKey.set(key, match[1]);
+            nextClass = Math.max(nextClass, Number(match[2]) + 1);
+        }
+    }
+    function intern(decls) {
+        const key = keyOf(decls);
+        let name = byKey.get(key);
+        if (!name) {
+            name = 'wz-' + nextClass++;
+            classes.set(name, {key: key, decls: decls});
+            byKey.set(key, name);
+            sheetChanged = true;
+        }
+        return name;
+    }
+    function classify(el) {
+        if (!el.hasAttribute('style')) return;
+        // The inline declarations extend the element's current class
+        const decls = new Map();
+        for (const name of Array.from(el.classList)) {
+            const entry = classes.get(name);
+            if (!entry) continue;
+            for (const [prop, value] of entry.decls) decls.set(prop, value);
+            el.classList.remove(name);
+        }
+        for (const [prop, value] of declarations(el.style)) decls.set(prop, value);
+        el.removeAttribute('style');
+        if (decls.size) el.classList.add(intern(decls));
+        if (!el.classList.length) el.removeAttribute('class');
+    }
+    // Elements matching selector in every block, including the blocks a
+    // virtualized view keeps out of the DOM
+    function* matching(selector) {
+        for (const node of wiziwig.blocks()) {
+            if (node.nodeType !== Node.ELEMENT_NODE) continue;
+            if (node.matches(selector)) yield node;
+            yield* node.querySelectorAll(selector);
+        }
+    }
+    function writeSheet() {
+        if (!sheetChanged) return;
+        sheetChanged = false;
+        let style = document.getElementById(STYLE_ID);
+        if (!style) {
+            style = document.createElement('style');
+            style.id = STYLE_ID;
+            document.head.appendChild(style);
+        }
+        style.textContent = '\n' + Array.from(classes,
+            ([name, entry]) => '.' + name + ' { ' + entry.key + '; }\n').join('');
+    }
+
+    wiziwig.observe(records => {
+        if (!enabled || wiziwig.history.applying) return;
+        const styled = [];
+        for (const record of records) {
+            if (record.type === 'attributes') {
+                if (record.attributeName === 'style' && wiziwig.topLevelNode(record.target)) styled.push(record.target);
+            } else if (record.type === 'childList') {
+                for (const node of record.addedNodes) {
+                    if (node.nodeType !== Node.ELEMENT_NODE || !wiziwig.topLevelNode(node)) continue;
+                    styled.push(node, ...node.querySelectorAll('[style]'));
+                }
+            }
+        }
+        if (styled.some(el => el.hasAttribute('style'))) {
+            // Undoing the edit also undoes its conversion
+            wiziwig.history.ambient(() => styled.forEach(classify));
+        }
+        writeSheet();
+    });
+
+    wiziwig.styleClasses = {
+        // Converts every inline style in the body in one pass. Returns the
+        // number of elements converted.
+        enable() {
+            if (enabled) return 0;
+            enabled = true;
+            load();
+            const styled = Array.from(matching('[style]'));
+            wiziwig.history.ambient(() => styled.forEach(classify));
+            writeSheet();
+            return styled.length;
+        },
+        collect() {
+            if (!enabled || !classes.size) return 0;
+            const used = new Set();
+            for (const el of matching('[class*="wz-"]')) {
+                for (const name of el.classList) used.add(name);
+            }
+            let removed = 0;
+            for (const [name, entry] of classes) {
+                if (used.has(name)) continue;
+                classes.delete(name);
+                byKey.delete(entry.key);
+                removed++;
+            }
+            if (removed) {
+                sheetChanged = true;
+                writeSheet();
+            }
+            return removed;
+        },
+    };
+})();
+"""
+
+# Images are inserted by content address with lazy loading and async
+# decoding, and reserve their box up front so offscreen images cost nothing
+# until they scroll into view.
+IMAGES_JS = r"""
+(function() {
+    const wiziwig = window.wiziwig;
+    if (!wiziwig || wiziwig.images) return;
+    const BLOB_SELECTOR = 'img[src^="wiziwig-blob:"]';
+
+    wiziwig.images = {
+        insert(src, width, height) {
+            const img = document.createElement('img');
+            img.src = src;
+            img.loading = 'lazy';
+            img.decoding = 'async';
+            if (width && height) {
+                img.width = width;
+                img.style.aspectRatio = width + ' / ' + height;
+            }
+            const selection = window.getSelection();
+            let range = selection.rangeCount ? selection.getRangeAt(0) : null;
+            if (!range || !document.body.contains(range.commonAncestorContainer)) {
+                range = document.createRange();
+                range.selectNodeContents(document.body.lastElementChild || document.body);
+                range.collapse(false);
+            }
+            range.deleteContents();
+            range.insertNode(img);
+            range.setStartAfter(img);
+            range.collapse(true);
+            selection.removeAllRanges();
+            selection.addRange(range);
+        },
+        // Whether saving has any store references to rewrite
+        usesBlobs() {
+            for (const node of wiziwig.blocks()) {
+                if (node.nodeType !== Node.ELEMENT_NODE) continue;
+                if (node.matches(BLOB_SELECTOR) || node.querySelector(BLOB_SELECTOR)) return true;
+            }
+            return false;
+        },
+    };
+})();
+"""
+
+# Inserts sanitized clipboard content one chunk per evaluate call so the page
+# renders between chunks. begin() to end() is recorded as a single undo step.
+# Native pastes are routed to the window, which reads and sanitizes the
+# clipboard off the main thread.
+PASTE_JS = r"""
+(function() {
+    const wiziwig = window.wiziwig;
+    if (!wiziwig || wiziwig.paste) return;
+    let marker = null;
+
+    function onlyBlank(node, forward) {
+        for (; node; node = forward ? node.nextSibling : node.previousSibling) {
+            if (node.nodeType !== Node.TEXT_NODE || node.data.trim()) return false;
+        }
+        return true;
+    }
+
+    function edgeBlock(container, offset, before) {
+        if (container !== document.body) return wiziwig.topLevelNode(container);
+        return document.body.childNodes[before ? offset - 1 : offset] || null;
+    }
+
+    // True when the selection spans all content, as after select all
+    function coversBody(range) {
+        if (range.collapsed) return false;
+        const first = edgeBlock(range.startContainer, range.startOffset, false);
+        const last = edgeBlock(range.endContainer, range.endOffset, true);
+        if (!first || !last || !onlyBlank(first.previousSibling, false) || !onlyBlank(last.nextSibling, true)) {
+            return false;
+        }
+        const head = document.createRange();
+        head.setStartBefore(first);
+        head.setEnd(range.startContainer, range.startOffset);
+        const tail = document.createRange();
+        tail.setStart(range.endContainer, range.endOffset);
+        tail.setEndAfter(last);
+        return !head.toString().trim() && !tail.toString().trim();
+    }
+
+    function isEmpty(node) {
+        return !node.textContent.trim() && !(node.querySelector && node.querySelector('img, hr, table'));
+    }
+
+    // Splits the top-level block holding the caret and leaves the marker
+    // between the halves, dropping a half that ends up empty.
+    function placeBetweenBlocks(range) {
+        const body = document.body;
+        if (range.startContainer === body) {
+            range.insertNode(marker);
+            return;
+        }
+        const block = wiziwig.topLevelNode(range.startContainer);
+        const tail = document.createRange();
+        tail.setStart(range.startContainer, range.startOffset);
+        tail.setEndAfter(block);
+        const rest = tail.extractContents();
+        block.after(marker);
+        if (!isEmpty(rest)) marker.after(rest);
+        if (isEmpty(block)) block.remove();
+    }
+
+    wiziwig.paste = {
+        begin(inline) {
+            wiziwig.history.begin('paste', true);
+            const body = document.body;
+            const selection = window.getSelection();
+            const range = selection.rangeCount ? selection.getRangeAt(0) : null;
+            marker = document.createComment('wiziwig-paste');
+            if (range && body.contains(range.commonAncestorContainer) && !coversBody(range)) {
+                range.deleteContents();
+                if (inline) range.insertNode(marker);
+                else placeBetweenBlocks(range);
+                return true;
+            }
+            // Replacing everything starts from an empty body, so no leftover
+            // text node or line break ends up ahead of the pasted content.
+            if (range) body.replaceChildren();
+            if (inline) {
+                const p = document.createElement('p');
+                p.append(marker);
+                body.append(p);
+            } else {
+                body.append(marker);
+            }
+            return true;
+        },
+
+        chunk(html) {
+            if (!marker || !marker.parentNode) return false;
+            const range = document.createRange();
+            range.selectNodeContents(marker.parentNode);
+            marker.before(range.createContextualFragment(html));
+            return true;
+        },
+
+        end() {
+            if (!marker) return false;
+            const body = document.body;
+            if (marker.parentNode) {
+                const previous = marker.previousSibling;
+                const range = document.createRange();
+                if (marker.parentNode === body && previous && previous.nodeType === Node.ELEMENT_NODE) {
+                    range.selectNodeContents(previous);
+                    range.collapse(false);
+                } else {
+                    range.setStartBefore(marker);
+                    range.collapse(true);
+                }
+                marker.remove();
+                if (!body.firstChild) {
+                    body.innerHTML = '<p><br></p>';
+                    range.setStart(body.firstChild, 0);
+                    range.collapse(true);
+                }
+                const selection = window.getSelection();
+                selection.removeAllRanges();
+                selection.addRange(range);
+                if (previous && previous.scrollIntoView) previous.scrollIntoView({block: 'nearest'});
+            }
+            marker = null;
+            wiziwig.history.end();
+            return true;
+        },
+    };
+
+    document.addEventListener('paste', (event) => {
+        event.preventDefault();
+        wiziwig.post('paste', null);
+    }, true);
+})();
+"""
+
+# Loaded only with WIZIWIG_PROFILE set. Reports how long each key press took
+# to reach a painted frame inside the page.
+PROFILE_JS = r"""
+(function() {
+    const wiziwig = window.wiziwig;
+    if (!wiziwig || wiziwig.profile) return;
+    wiziwig.profile = true;
+    document.addEventListener('keydown', () => {
+        const started = performance.now();
+        // requestAnimationFrame runs just before the frame is painted, a
+        // task queued from there runs once it is done.
+        requestAnimationFrame(() => setTimeout(() => {
+            wiziwig.post('profile', {input_ms: performance.now() - started});
+        }, 0));
+    }, true);
+})();
+"""
+
+# Reloads a file rewritten by another program block by block. Blocks changed
+# locally since the page was loaded or saved are tracked from the mutation
+# stream; disk changes touching them are held back as conflicts instead of
+# being applied over the unsaved edits.
+EXTERNAL_JS = r"""
+(function() {
+    const wiziwig = window.wiziwig;
+    if (!wiziwig || wiziwig.external) return;
+    // Blocks further apart than this are never paired up by the diff
+    const LOOKAHEAD = 2000;
+    let edited = new WeakSet();
+    // True when the loaded page already held unsaved changes
+    let allEdited = false;
+    let applying = false;
+    let incoming = [];
+    let pending = null;
+
+    function mark(node) {
+        if (node) edited.add(node);
+    }
+
+    wiziwig.observe(records => {
+        if (applying) return;
+        const body = document.body;
+        for (const record of records) {
+            if (record.target === body) {
+                if (record.type !== 'childList') continue;
+                // A removed block leaves its neighbours as the edited region
+                mark(record.previousSibling);
+                mark(record.nextSibling);
+                for (const node of record.addedNodes) mark(node);
+            } else {
+                mark(wiziwig.topLevelNode(record.target));
+            }
+        }
+    });
+
+    function keys(nodes) {
+        return nodes.map(node => wiziwig.serializeNode(node));
+    }
+
+    // Hunks [oldStart, oldEnd, newStart, newEnd] left after pairing equal
+    // blocks in order: the common ends are trimmed, then each old block takes
+    // the next unused equal block ahead of the last pairing.
+    function diff(before, after) {
+        let head = 0;
+        while (head < before.length && head < after.length && before[head] === after[head]) head++;
+        let tail = 0;
+        while (tail < before.length - head && tail < after.length - head &&
+               before[before.length - 1 - tail] === after[after.length - 1 - tail]) tail++;
+        const oldEnd = before.length - tail;
+        const newEnd = after.length - tail;
+        const positions = new Map();
+        for (let j = head; j < newEnd; j++) {
+            const entry = positions.get(after[j]);
+            if (entry) entry.list.push(j);
+            else positions.set(after[j], {list: [j], next: 0});
+        }
+        const hunks = [];
+        let hunkStart = head;
+        let j = head;
+        for (let i = head; i < oldEnd; i++) {
+            const entry = positions.get(before[i]);
+            let match = -1;
+            if (entry) {
+                while (entry.next < entry.list.length && entry.list[entry.next] < j) entry.next++;
+                if (entry.next < entry.list.length && entry.list[entry.next] - j <= LOOKAHEAD) {
+                    match = entry.list[entry.next++];
+                }
+            }
+            if (match < 0) continue;
+            if (hunkStart < i || j < match) hunks.push([hunkStart, i, j, match]);
+            hunkStart = i + 1;
+            j = match + 1;
+        }
+        if (hunkStart < oldEnd || j < newEnd) hunks.push([hunkStart, oldEnd, j, newEnd]);
+        return hunks;
+    }
+
+    function conflicts(hunk, current) {
+        if (allEdited) return true;
+        const [oldStart, oldEnd] = hunk;
+        // An insertion conflicts with edits right where it lands
+        const from = oldStart === oldEnd ? oldStart - 1 : oldStart;
+        const to = oldStart === oldEnd ? oldEnd + 1 : oldEnd;
+        for (let i = Math.max(0, from); i < Math.min(to, current.length); i++) {
+            if (edited.has(current[i])) return true;
+        }
+        return false;
+    }
+
+    function apply(hunks) {
+        const body = document.body;
+        wiziwig.flushMutations();
+        applying = true;
+        wiziwig.history.begin('reload', true);
+        try {
+            for (const hunk of hunks) {
+                const anchor = hunk.anchor && hunk.anchor.parentNode === body ? hunk.anchor : null;
+                for (const node of hunk.removed) node.remove();
+                const fragment = document.createDocumentFragment();
+                for (const node of hunk.added) fragment.appendChild(document.importNode(node, true));
+                body.insertBefore(fragment, anchor);
+            }
+        } finally {
+            wiziwig.history.end();
+            applying = false;
+        }
+    }
+
+    wiziwig.external = {
+        // Takes the page as it is now as matching the file on disk, or as
+        // wholly edited when it was loaded with unsaved changes.
+        baseline(clean) {
+            wiziwig.flushMutations();
+            edited = new WeakSet();
+            allEdited = !clean;
+            pending = null;
+        },
+        receive(chunk) {
+            incoming.push(chunk);
+        },
+        // Diffs the received file against the page and applies every change
+        // that does not touch a locally edited block.
+        apply() {
+            const html = incoming.join('');
+            incoming = [];
+            wiziwig.flushMutations();
+            if (wiziwig.virtual) wiziwig.virtual.disable();
+            const parsed = new DOMParser().parseFromString(html, 'text/html');
+            const after = Array.from(parsed.body.childNodes);
+            const current = Array.from(document.body.childNodes);
+            const hunks = diff(keys(current), keys(after)).map(([oldStart, oldEnd, newStart, newEnd]) => ({
+                removed: current.slice(oldStart, oldEnd),
+                added: after.slice(newStart, newEnd),
+                anchor: current[oldEnd] || null,
+                conflict: conflicts([oldStart, oldEnd], current),
+            }));
+            const clean = hunks.filter(hunk => !hunk.conflict);
+            const held = hunks.filter(hunk => hunk.conflict);
+            if (clean.length) apply(clean);
+            pending = held.length ? held : null;
+            return {applied: clean.length, conflicts: held.length};
+        },
+        // Settles held conflicts, taking the disk version when useDisk.
+        resolve(useDisk) {
+            if (pending && useDisk) {
+                wiziwig.flushMutations();
+                if (wiziwig.virtual) wiziwig.virtual.disable();
+                apply(pending);
+            }
+            pending = null;
+        },
+    };
+})();
+"""
+
+FIND_HIGHLIGHT_CSS = """
+::highlight(wiziwig-find) { background-color: yellow; color: black; }
+::highlight(wiziwig-find-current) { background-color: orange; color: black; }
+"""
+
+# Regular expression searches running longer than this are abandoned
+FIND_REGEX_BUDGET_MS = 2000
+
+EDITOR_SCRIPTS = [EDITOR_RUNTIME_JS, VIRTUAL_JS, SAVE_ENGINE_JS, JOURNAL_JS, HISTORY_JS,
+                  FIND_ENGINE_JS, REPLACE_ENGINE_JS, COMMANDS_JS, SELECTION_STATE_JS, NORMALIZE_JS,
+                  STYLE_CLASSES_JS, PASTE_JS, IMAGES_JS, EXTERNAL_JS]
+
+# Journal batches between compactions into a snapshot
+JOURNAL_COMPACT_RECORDS = 500
+JOURNAL_COMPACT_BYTES = 8 * 1024 * 1024
+
+# Settings read from ~/.config/wiziwig/config.json, missing keys use these.
+DEFAULT_CONFIG = {
+    # Seconds a background tab stays idle before its web view is released
+    "tab_hibernate_after": 600,
+    # Blank editor views kept loaded in the background for New and Open
+    "webview_pool_size": 2,
+    # "inline" style attributes, or "classes" interned into a head stylesheet
+    "formatting_mode": "inline",
+    # Suggested when saving a document with images: "inline" data: URIs, or
+    # "folder" for a <name>_files folder next to the document
+    "image_save_mode": "inline",
+    # Memory the undo history of one document may use before the oldest
+    # steps are dropped
+    "history_memory_limit": 64 * 1024 * 1024,
+    # Documents with more top-level blocks than this only keep the blocks
+    # near the viewport in the DOM
+    "virtualize_above_blocks": 20000,
+}
+
+def load_config():
+    config = dict(DEFAULT_CONFIG)
+    path = os.path.join(GLib.get_user_config_dir(), "wiziwig", "config.json")
+    try:
+        with open(path) as f:
+            config.update(json.load(f))
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        print("Config error:", e)
+    return config
+
+# fontconfig rewrites these directories whenever the installed fonts change
+FONTCONFIG_CACHE_DIRS = [
+    os.path.join(GLib.get_user_cache_dir(), "fontconfig"),
+    "/var/cache/fontconfig",
+    "/usr/lib/fontconfig/cache",
+]
+
+def fontconfig_cache_stamp():
+    stamp = []
+    for directory in FONTCONFIG_CACHE_DIRS:
+        try:
+            stamp.append([directory, os.stat(directory).st_mtime_ns])
+        except OSError:
+            pass
+    return stamp
+
+def load_font_families():
+    # Enumerating fonts through Pango is slow with large font collections, so
+    # the sorted family names are cached until the fontconfig cache changes.
+    path = os.path.join(GLib.get_user_cache_dir(), "wiziwig", "fonts.json")
+    stamp = fontconfig_cache_stamp()
+    try:
+        with open(path) as f:
+            cached = json.load(f)
+        if cached["stamp"] == stamp:
+            return cached["families"]
+    except (OSError, ValueError, KeyError):
+        pass
+    families = sorted(family.get_name() for family in PangoCairo.FontMap.get_default().list_families())
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            json.dump({"stamp": stamp, "families": families}, f)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        print("Font cache error:", e)
+    return families
+
+def document_uri_for_path(path):
+    return DOCUMENT_SCHEME + "://" + GLib.Uri.escape_string(path, "/", False)
+
+def file_stamp(path):
+    """Returns (mtime_ns, size) of path, or None when it does not exist."""
+    try:
+        info = os.stat(path)
+    except OSError:
+        return None
+    return (info.st_mtime_ns, info.st_size)
+
+# Set WIZIWIG_PROFILE=1 to time bridge round trips, commands, load and save
+# phases and key-to-paint latency, and to sample DOM size and web process
+# memory. F12 toggles an overlay with rolling histograms; the Chrome trace
+# (chrome://tracing, Perfetto) is written on exit to WIZIWIG_PROFILE_FILE or
+# the cache directory.
+PROFILE = bool(os.environ.get("WIZIWIG_PROFILE"))
+# Samples per rolling histogram, and trace events kept for the dump
+PROFILE_WINDOW = 512
+PROFILE_TRACE_EVENTS = 200000
+PROFILE_BUCKETS_MS = [1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024]
+PROFILE_BARS = " ▁▂▃▄▅▆▇█"
+SCRIPT_NAME_RE = re.compile(r"\s*([\w.]+)")
+
+def child_process_memory():
+    # Resident memory in MiB of the WebKit helper processes, by process name
+    memory = {}
+    pid = os.getpid()
+    children = []
+    try:
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                children.extend(f.read().split())
+    except OSError:
+        return memory
+    for child in children:
+        try:
+            with open(f"/proc/{child}/status") as f:
+                status = dict(line.split(":", 1) for line in f if ":" in line)
+        except OSError:
+            continue
+        name = status.get("Name", "").strip()
+        rss = status.get("VmRSS", "0 kB").split()[0]
+        memory[name] = memory.get(name, 0.0) + int(rss) / 1024
+    return memory
+
+class Profiler:
+    """Spans and counters recorded while WIZIWIG_PROFILE is set.
+
+    Every span feeds a rolling histogram for its name and, like counters, a
+    bounded list of Chrome trace events. Spans may come from any thread."""
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.events = deque(maxlen=PROFILE_TRACE_EVENTS)
+        self.threads = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def timestamp(t):
+        return round((t - STARTUP_BEGIN) * 1e6)
+
+    def span(self, name, started, ended=None, category="editor"):
+        # started and ended are time.monotonic() values
+        ended = time.monotonic() if ended is None else ended
+        with self.lock:
+            self.histograms.setdefault(name, deque(maxlen=PROFILE_WINDOW)).append((ended - started) * 1000)
+            tid = self.threads.setdefault(threading.get_ident(), len(self.threads) + 1)
+            self.events.append({"name": name, "cat": category, "ph": "X", "pid": os.getpid(), "tid": tid,
+                                "ts": self.timestamp(started), "dur": round((ended - started) * 1e6)})
+
+    def counter(self, name, value):
+        with self.lock:
+            self.counters[name] = value
+            self.events.append({"name": name, "ph": "C", "pid": os.getpid(),
+                                "ts": self.timestamp(time.monotonic()), "args": {"value": value}})
+
+    def instrument(self, webview):
+        # Times every evaluate_javascript call made on this view, named after
+        # the function the script starts with.
+        evaluate = webview.evaluate_javascript
+        def evaluate_javascript(script, length, world, source_uri, cancellable, callback, user_data):
+            match = SCRIPT_NAME_RE.match(script)
+            name = "js " + (match.group(1) if match else "script")
+            started = time.monotonic()
+            def on_done(webview, result, data):
+                self.span(name, started, category="bridge")
+                if callback:
+                    callback(webview, result, data)
+                    return
+                try:
+                    webview.evaluate_javascript_finish(result)
+                except GLib.Error:
+                    pass
+            evaluate(script, length, world, source_uri, cancellable, on_done, user_data)
+        webview.evaluate_javascript = evaluate_javascript
+
+    def report(self):
+        lines = [f"{'':<28} {'n':>5} {'p50':>8} {'p95':>8} {'max':>8}  "
+                 f"{PROFILE_BUCKETS_MS[0]}..{PROFILE_BUCKETS_MS[-1]}+ ms"]
+        with self.lock:
+            histograms = {name: sorted(samples) for name, samples in self.histograms.items()}
+            counters = dict(self.counters)
+        for name, samples in sorted(histograms.items()):
+            n = len(samples)
+            buckets = [0] * (len(PROFILE_BUCKETS_MS) + 1)
+            for ms in samples:
+                buckets[next((i for i, edge in enumerate(PROFILE_BUCKETS_MS) if ms < edge),
+                             len(PROFILE_BUCKETS_MS))] += 1
+            peak = max(buckets)
+            top = len(PROFILE_BARS) - 1
+            bars = "".join(PROFILE_BARS[count and max(1, round(count * top / peak))] for count in buckets)
+            lines.append(f"{name[:28]:<28} {n:>5} {samples[n // 2]:>8.1f} {samples[min(n - 1, n * 95 // 100)]:>8.1f} "
+                         f"{samples[-1]:>8.1f}  {bars}")
+        for name, value in sorted(counters.items()):
+            lines.append(f"{name:<28} {value:>10.1f}" if isinstance(value, float) else f"{name:<28} {value:>10}")
+        return "\n".join(lines)
+
+    def dump(self, path=None):
+        path = path or os.environ.get("WIZIWIG_PROFILE_FILE") or os.path.join(
+            GLib.get_user_cache_dir(), "wiziwig", f"profile-{os.getpid()}.json")
+        with self.lock:
+            events = list(self.events)
+            threads = dict(self.threads)
+        for ident, tid in threads.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid,
+                           "args": {"name": "main" if ident == threading.main_thread().ident else f"worker {tid}"}})
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            with open(path, "w") as f:
+                json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+            print("Profile written to", path)
+        except OSError as e:
+            print("Profile error:", e)
+
+profiler = Profiler() if PROFILE else None
+
+class BlobStore:
+    """Content-addressed image files under the user data directory.
+
+    Blobs are named by the SHA-256 of their bytes plus the original
+    extension, so inserting the same image twice stores it once. Wide images
+    are served through a downscaled rendition, generated once in a thread
+    pool and cached beside the originals."""
+
+    def __init__(self, root):
+        self.root = root
+        self.pool = ThreadPoolExecutor(max_workers=BLOB_RENDITION_WORKERS, thread_name_prefix="rendition")
+        # name -> Future of the display path, touched on the main thread only
+        self.displays = {}
+
+    @staticmethod
+    def uri(name):
+        return f"{BLOB_SCHEME}:///{name}"
+
+    def path(self, name):
+        if not BLOB_NAME_RE.fullmatch(name):
+            return None
+        return os.path.join(self.root, name[:2], name)
+
+    def store(self, source, digest, extension):
+        name = digest + (extension.lower() if extension else ".bin")
+        target = self.path(name)
+        if target is None:
+            name = digest + ".bin"
+            target = self.path(name)
+        if not os.path.exists(target):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            source(target + ".tmp")
+            os.replace(target + ".tmp", target)
+        return name
+
+    def put_file(self, path):
+        # Blocking, call from a worker thread
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+        return self.store(lambda target: shutil.copyfile(path, target), digest.hexdigest(),
+                          os.path.splitext(path)[1])
+
+    def put_bytes(self, data, extension):
+        def write(target):
+            with open(target, "wb") as f:
+                f.write(data)
+        return self.store(write, hashlib.sha256(data).hexdigest(), extension)
+
+    @staticmethod
+    def size(path):
+        _, width, height = GdkPixbuf.Pixbuf.get_file_info(path)
+        return width, height
+
+    def display_path(self, name, callback):
+        # callback(path, error) runs on the main thread
+        future = self.displays.get(name)
+        if future is None:
+            future = self.displays[name] = self.pool.submit(self.make_display, name)
+        def deliver(future):
+            error = future.exception()
+            if error and self.displays.get(name) is future:
+                # Not cached, so the next request tries again
+                del self.displays[name]
+            callback(None if error else future.result(), error)
+            return False
+        future.add_done_callback(lambda future: GLib.idle_add(deliver, future))
+
+    def make_display(self, name):
+        source = self.path(name)
+        if source is None or not os.path.exists(source):
+            raise FileNotFoundError(name)
+        info, width, _ = GdkPixbuf.Pixbuf.get_file_info(source)
+        # Animations and vector images are served as they are
+        if info is None or width <= BLOB_DISPLAY_WIDTH or info.get_name() in ("gif", "svg"):
+            return source
+        kind = "jpeg" if info.get_name() == "jpeg" else "png"
+        target = os.path.join(self.root, "renditions", f"{BLOB_DISPLAY_WIDTH}-{os.path.splitext(name)[0]}.{kind}")
+        if not os.path.exists(target):
+            pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_scale(source, BLOB_DISPLAY_WIDTH, -1, True)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            pixbuf.savev(target + ".tmp", kind, [], [])
+            os.replace(target + ".tmp", target)
+        return target
+
+class ImageExporter:
+    """Rewrites blob store references in HTML being written to file.
+
+    "inline" embeds every image as a data: URI, "folder" copies it into a
+    <name>_files folder beside the document and links it relatively. Runs
+    on the save thread."""
+
+    def __init__(self, store, mode, file):
+        self.store = store
+        self.folder = None
+        path = file.get_path()
+        if mode == "folder" and path:
+            stem = os.path.splitext(os.path.basename(path))[0]
+            self.folder = os.path.join(os.path.dirname(path), stem + "_files")
+        self.replacements = {}
+
+    def replacement(self, name):
+        if name in self.replacements:
+            return self.replacements[name]
+        source = self.store.path(name)
+        if self.folder:
+            target = os.path.join(self.folder, name)
+            if not os.path.exists(target):
+                os.makedirs(self.folder, exist_ok=True)
+                shutil.copyfile(source, target)
+            value = GLib.Uri.escape_string(os.path.basename(self.folder), None, False).encode() + b"/" + name.encode()
+        else:
+            content_type, _ = Gio.content_type_guess(name, None)
+            mime_type = Gio.content_type_get_mime_type(content_type) or "application/octet-stream"
+            with open(source, "rb") as f:
+                value = b"data:" + mime_type.encode() + b";base64," + base64.b64encode(f.read())
+        self.replacements[name] = value
+        return value
+
+    def rewrite(self, chunk):
+        if b"wiziwig-blob:" not in chunk:
+            return chunk
+        return BLOB_REFERENCE_RE.sub(lambda m: self.replacement(m.group(1).decode()), chunk)
+
+class Wiziwig(Adw.Application):
+    def __init__(self):
+        super().__init__(application_id="io.github.fastrizwaan.wiziwig",
+                         flags=Gio.ApplicationFlags.HANDLES_OPEN)
+        self.connect("startup", self.on_startup)
+        self.connect("activate", self.on_activate)
+        self.connect("open", self.on_open)
+        self.library = None
+        self.window_count = 0
+        self.library_state_path = os.path.join(GLib.get_user_data_dir(), "wiziwig", "library.json")
+        # The document each view was asked to load; the scheme serves only it
+        # and the files under its directory.
+        self.document_paths = weakref.WeakKeyDictionary()
+
+    def on_startup(self, app):
+        context = WebKit.WebContext.get_default()
+        context.register_uri_scheme(DOCUMENT_SCHEME, self.on_document_scheme_request)
+        context.get_security_manager().register_uri_scheme_as_local(DOCUMENT_SCHEME)
+        self.blob_store = BlobStore(os.path.join(GLib.get_user_data_dir(), "wiziwig", "blobs"))
+        context.register_uri_scheme(BLOB_SCHEME, self.on_blob_scheme_request)
+        context.get_security_manager().register_uri_scheme_as_local(BLOB_SCHEME)
+
+    def on_activate(self, app):
+        win = EditorWindow(application=self)
+        win.present()
+
+    def get_library(self):
+        # Opened on first use; the scan only reindexes what changed since
+        if self.library is None:
+            self.library = Library(os.path.join(GLib.get_user_cache_dir(), "wiziwig", "library.sqlite"))
+            try:
+                with open(self.library_state_path) as f:
+                    folder = json.load(f)["folder"]
+                if os.path.isdir(folder):
+                    self.library.open_folder(folder)
+            except (OSError, ValueError, KeyError, TypeError):
+                pass
+        return self.library
+
+    def set_library_folder(self, folder):
+        self.get_library().open_folder(folder)
+        try:
+            os.makedirs(os.path.dirname(self.library_state_path), exist_ok=True)
+            with open(self.library_state_path, "w") as f:
+                json.dump({"folder": folder}, f)
+        except OSError as e:
+            print("Library error:", e)
+
+    def on_open(self, app, files, n_files, hint):
+        # Files given on the command line or by the file manager. A second
+        # launch forwards them over D-Bus and exits, so they open as tabs of
+        # the running instance without another GTK and WebKit startup.
+        win = self.get_active_window()
+        if win is None:
+            win = EditorWindow(application=self, files=files)
+        else:
+            for file in files:
+                win.open_file(file)
+        win.present()
+
+    def load_document(self, webview, path, source=None):
+        # source, when given, is served as the document at path: a saved copy
+        # of the page keeps resolving its relative resources beside the original.
+        self.document_paths[webview] = (os.path.realpath(path), os.path.realpath(os.path.dirname(path)),
+                                        os.path.splitext(os.path.basename(path))[0] + "_files", source)
+        webview.load_uri(document_uri_for_path(path))
+
+    def document_request_path(self, request):
+        # Returns the file to serve, or None when the request is neither the
+        # view's document nor one of its resources. Paths are compared after
+        # resolving symlinks, so a link beside the document leads nowhere else.
+        entry = self.document_paths.get(request.get_web_view())
+        if entry is None:
+            return None
+        document, directory, folder, source = entry
+        path = os.path.realpath(GLib.Uri.unescape_string(request.get_path(), None) or "/")
+        if path == document:
+            return source or path
+        if path.startswith(os.path.join(directory, folder, "")):
+            return path  # the images folder written by ImageExporter
+        if os.path.dirname(path) == directory:
+            content_type, _ = Gio.content_type_guess(path, None)
+            mime_type = Gio.content_type_get_mime_type(content_type) or ""
+            if mime_type.startswith(DOCUMENT_RESOURCE_TYPES):
+                return path
+        return None
+
+    def on_document_scheme_request(self, request):
+        # Relative resources (images, stylesheets) resolve against the
+        # document URI. Everything else is refused, as the scheme is local
+        # and a page could otherwise read arbitrary files through it.
+        path = self.document_request_path(request)
+        if path is None:
+            request.finish_error(GLib.Error.new_literal(Gio.io_error_quark(),
+                                                        f"{request.get_path()}: access denied",
+                                                        Gio.IOErrorEnum.PERMISSION_DENIED))
+            return
+        if is_markdown(path):
+            self.serve_markdown(path, request)
+            return
+        file = Gio.File.new_for_path(path)
+        file.read_async(GLib.PRIORITY_DEFAULT, None, self.on_document_stream_ready, request)
+
+    def serve_markdown(self, path, request):
+        # The converter writes into a pipe that WebKit parses from as it
+        # fills, so the HTML is never held whole.
+        try:
+            source = open(path, encoding="utf-8", errors="replace")
+        except OSError as e:
+            request.finish_error(GLib.Error.new_literal(Gio.io_error_quark(), str(e),
+                                                        Gio.IOErrorEnum.NOT_FOUND))
+            return
+        read_fd, write_fd = os.pipe()
+        title = os.path.splitext(os.path.basename(path))[0]
+        webview = request.get_web_view()
+
+        def convert_thread():
+            error = None
+            try:
+                with source, os.fdopen(write_fd, "wb") as out:
+                    for html in markdown_to_html(iter(lambda: source.read(MARKDOWN_READ_CHARS), ""), title):
+                        out.write(html.encode())
+            except BrokenPipeError:
+                pass  # the load was stopped
+            except OSError as e:
+                error = str(e)
+            except Exception as e:
+                error = f"could not convert {path}: {e!r}"
+            if error:
+                GLib.idle_add(self.on_markdown_failed, webview, error)
+        threading.Thread(target=convert_thread, daemon=True).start()
+        request.finish(UnixInputStream.new(read_fd, True), -1, "text/html")
+
+    def on_markdown_failed(self, webview, error):
+        # The page only holds what was converted before the error
+        print("Markdown error:", error)
+        for win in self.get_windows():
+            if isinstance(win, EditorWindow):
+                doc = next((doc for doc in win.live_documents() if doc.webview is webview), None)
+                if doc:
+                    if win.loading_doc is doc:
+                        win.hide_progress()
+                    win.cancel_streaming_load(doc)
+        return False
+
+    def on_blob_scheme_request(self, request):
+        def on_display_path(path, error):
+            if error:
+                request.finish_error(GLib.Error.new_literal(Gio.io_error_quark(), str(error),
+                                                            Gio.IOErrorEnum.NOT_FOUND))
+                return
+            Gio.File.new_for_path(path).read_async(GLib.PRIORITY_DEFAULT, None, self.on_document_stream_ready, request)
+        self.blob_store.display_path(request.get_path().lstrip("/"), on_display_path)
+
+    def on_document_stream_ready(self, file, result, request):
+        try:
+            stream = file.read_finish(result)
+            info = stream.query_info(Gio.FILE_ATTRIBUTE_STANDARD_SIZE, None)
+            content_type, _ = Gio.content_type_guess(file.get_basename(), None)
+            mime_type = Gio.content_type_get_mime_type(content_type) or "application/octet-stream"
+            # WebKit pulls from the stream in chunks and parses progressively.
+            request.finish(stream, info.get_size(), mime_type)
+        except GLib.Error as e:
+            print("Stream error:", e.message)
+            request.finish_error(e)
+
+class CommandBridge:
+    def __init__(self, webview):
+        self.webview = webview
+        self.pending = []
+        self.in_flight = {}
+        self.seq = 0
+        self.flush_source = 0
+        # command name -> {"count", "total_ms", "max_ms", "last_ms", "run_ms"}
+        self.latency = {}
+
+    def send(self, name, *args):
+        self.seq += 1
+        self.pending.append([self.seq, name, list(args)])
+        if not self.flush_source:
+            # Runs before the next frame is drawn, so commands issued during
+            # the same main loop iteration travel as one batch.
+            self.flush_source = GLib.idle_add(self.flush, priority=GLib.PRIORITY_HIGH_IDLE)
+
+    def flush(self):
+        self.flush_source = 0
+        batch, self.pending = self.pending, []
+        if batch:
+            now = time.monotonic()
+            for seq, name, args in batch:
+                self.in_flight[seq] = (name, now)
+            self.webview.evaluate_javascript(f"wiziwig.run({json.dumps(batch)})", -1, None, None, None, None, None)
+        return GLib.SOURCE_REMOVE
+
+    def reset(self):
+        # Acks for a page that has been replaced will never arrive.
+        self.in_flight.clear()
+
+    def on_ack(self, acks):
+        now = time.monotonic()
+        for seq, run_ms, error in acks:
+            sent = self.in_flight.pop(seq, None)
+            if sent is None:
+                continue
+            name, start = sent
+            if error:
+                print("Command error:", error)
+            round_trip = (now - start) * 1000
+            if profiler:
+                profiler.span(f"command {name}", start, now, category="bridge")
+            stats = self.latency.setdefault(name, {"count": 0, "total_ms": 0.0, "max_ms": 0.0,
+                                                   "last_ms": 0.0, "run_ms": 0.0})
+            stats["count"] += 1
+            stats["total_ms"] += round_trip
+            stats["max_ms"] = max(stats["max_ms"], round_trip)
+            stats["last_ms"] = round_trip
+            stats["run_ms"] = run_ms
+
+class DocumentSaver:
+    def __init__(self, webview):
+        self.webview = webview
+        self.generation = 0
+        self.reset()
+
+    def reset(self, saved_file=None):
+        # Called whenever a new document is loaded into the web view.
+        self.generation += 1
+        self.blocks = {}
+        self.order = None
+        self.prologue = b""
+        self.epilogue = b""
+        self.written_file = saved_file
+        self.busy = False
+        self.snapshot_mode = False
+        self.snapshot_clean = False
+        self.images = None
+
+    def save(self, file, callback, user_data=None, images=None):
+        # images, an ImageExporter, rewrites blob store references on write
+        if self.busy:
+            print("Save already in progress")
+            return
+        self.busy = True
+        self.snapshot_mode = False
+        self.images = images
+        self.file = file
+        self.callback = callback
+        self.user_data = user_data
+        self.begin()
+
+    def snapshot(self, file, callback, user_data=None):
+        # Writes the document to a scratch file without treating it as saved.
+        # callback(file, error, user_data, clean) reports whether the page
+        # still matched the last written file.
+        if self.busy:
+            return False
+        self.save(file, callback, user_data)
+        self.snapshot_mode = True
+        return True
+
+    def begin(self):
+        self.started = time.monotonic()
+        need_order = "true" if self.order is None else "false"
+        self.webview.evaluate_javascript(f"wiziwig.save.begin({need_order})", -1, None, None, None,
+                                         self.on_begin, self.generation)
+
+    def on_begin(self, webview, result, generation):
+        if generation != self.generation:
+            return
+        try:
+            state = json.loads(webview.evaluate_javascript_finish(result).to_string())
+        except (GLib.Error, ValueError) as e:
+            self.finish(f"could not read document state: {e}")
+            return
+        if profiler:
+            profiler.span("save begin", self.started)
+        self.prologue = state["prologue"].encode()
+        self.epilogue = state["epilogue"].encode()
+        if state["order"] is not None:
+            self.order = state["order"]
+        if self.snapshot_mode:
+            self.snapshot_clean = state["clean"] and self.written_file is not None
+            if not self.snapshot_clean:
+                # The dirty state was consumed; the real file is now stale.
+                self.written_file = None
+            if state["pending"]:
+                self.request_chunk()
+            else:
+                self.write()
+        elif state["clean"] and self.written_file is not None and self.written_file.equal(self.file):
+            # Nothing changed since this file was last loaded or written
+            self.finish(None)
+        elif state["pending"]:
+            self.request_chunk()
+        else:
+            self.write()
+
+    def request_chunk(self):
+        self.webview.evaluate_javascript(f"wiziwig.save.next({SAVE_CHUNK_CHARS})", -1, None, None, None,
+                                         self.on_chunk, self.generation)
+
+    def on_chunk(self, webview, result, generation):
+        if generation != self.generation:
+            return
+        try:
+            chunk = json.loads(webview.evaluate_javascript_finish(result).to_string())
+        except (GLib.Error, ValueError) as e:
+            self.finish(f"could not serialize document: {e}")
+            return
+        for block_id, html in chunk["blocks"]:
+            self.blocks[block_id] = html.encode()
+        if chunk["done"]:
+            self.write()
+        else:
+            self.request_chunk()
+
+    def write(self):
+        live = set(self.order)
+        if not live.issubset(self.blocks):
+            # Cache and page disagree; resend everything on the next attempt.
+            self.order = None
+            self.blocks = {}
+            self.webview.evaluate_javascript("wiziwig.save.forget()", -1, None, None, None, None, None)
+            self.finish("serialized block cache out of sync, please save again")
+            return
+        for block_id in [i for i in self.blocks if i not in live]:
+            del self.blocks[block_id]
+        chunks = [self.prologue]
+        chunks.extend(self.blocks[block_id] for block_id in self.order)
+        chunks.append(self.epilogue)
+        if profiler:
+            profiler.span("save serialize", self.started)
+        threading.Thread(target=self.write_thread, args=(self.file, chunks, self.generation, self.images),
+                         daemon=True).start()
+
+    def write_thread(self, file, chunks, generation, images=None):
+        # Gio writes to a temporary file and renames it over the target on
+        # close, so a failed or interrupted save never leaves a torn file.
+        error = None
+        started = time.monotonic()
+        cancellable = Gio.Cancellable()
+        try:
+            stream = file.replace(None, False, Gio.FileCreateFlags.REPLACE_DESTINATION, cancellable)
+            if images:
+                chunks = (images.rewrite(chunk) for chunk in chunks)
+            if is_markdown(file.get_basename() or ""):
+                chunks = (text.encode() for text in
+                          html_to_markdown(chunk.decode(errors="replace") for chunk in chunks))
+            try:
+                for chunk in chunks:
+                    stream.write_all(chunk, cancellable)
+            except Exception:
+                # Cancelling first makes close() drop the temporary file
+                # instead of renaming it over the target.
+                cancellable.cancel()
+                try:
+                    stream.close(None)
+                except GLib.Error:
+                    pass
+                raise
+            stream.close(cancellable)
+        except GLib.Error as e:
+            error = e.message
+        except OSError as e:
+            error = f"could not write images: {e}"
+        except Exception as e:
+            # A converter failing must still reach on_written, or the saver
+            # would stay busy and refuse every later save.
+            error = f"could not convert document: {e!r}"
+        if profiler:
+            profiler.span("save write", started)
+        GLib.idle_add(self.on_written, file, error, generation)
+
+    def on_written(self, file, error, generation):
+        if generation == self.generation:
+            if not self.snapshot_mode:
+                self.written_file = None if error else file
+            self.finish(error)
+        return False
+
+    def finish(self, error):
+        self.busy = False
+        if profiler:
+            profiler.span("snapshot total" if self.snapshot_mode else "save total", self.started)
+        if self.snapshot_mode:
+            self.callback(self.file, error, self.user_data, self.snapshot_clean)
+        else:
+            self.callback(self.file, error, self.user_data)
+
+# Clipboard HTML is rebuilt from this allowlist; other tags are dropped but
+# their text is kept, except for the DROP_CONTENT_TAGS.
+PASTE_TAGS = {
+    "a", "b", "blockquote", "br", "code", "del", "div", "em", "h1", "h2", "h3", "h4", "h5", "h6",
+    "hr", "i", "img", "li", "ol", "p", "pre", "s", "span", "strike", "strong", "sub", "sup",
+    "table", "tbody", "td", "tfoot", "th", "thead", "tr", "u", "ul",
+}
+PASTE_BLOCK_TAGS = {
+    "blockquote", "div", "h1", "h2", "h3", "h4", "h5", "h6", "hr", "li", "ol", "p", "pre",
+    "table", "ul",
+}
+PASTE_VOID_TAGS = {"br", "hr", "img"}
+DROP_CONTENT_TAGS = {
+    "head", "iframe", "math", "noscript", "object", "script", "select", "style", "svg",
+    "template", "textarea", "title",
+}
+PASTE_ATTRIBUTES = {"alt", "colspan", "height", "href", "rowspan", "src", "style", "title", "width"}
+PASTE_CSS_PROPERTIES = {
+    "background-color", "color", "font-family", "font-size", "font-style", "font-weight",
+    "text-align", "text-decoration",
+}
+PASTE_URL_SCHEMES = {"href": ("http:", "https:", "mailto:", "#"),
+                     "src": ("http:", "https:", "data:image/", BLOB_SCHEME + ":")}
+
+def clean_style(value):
+    declarations = []
+    for declaration in value.split(";"):
+        name, sep, val = declaration.partition(":")
+        name = name.strip().lower()
+        val = val.strip()
+        lowered = val.lower()
+        if sep and val and name in PASTE_CSS_PROPERTIES and "url(" not in lowered and "expression" not in lowered:
+            declarations.append(f"{name}: {val}")
+    return "; ".join(declarations)
+
+class PasteSanitizer(HTMLParser):
+    """Rebuilds clipboard HTML from allowed tags and attributes.
+
+    Output is split into chunks of roughly PASTE_CHUNK_CHARS, always at a
+    top-level boundary so every chunk parses on its own."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.chunks = []
+        self.parts = []
+        self.size = 0
+        self.open = []
+        self.skipping = []
+        self.pre = 0
+        self.inline = True
+
+    def emit(self, text):
+        self.parts.append(text)
+        self.size += len(text)
+
+    def cut(self):
+        if not self.open and self.size >= PASTE_CHUNK_CHARS:
+            self.chunks.append("".join(self.parts))
+            self.parts = []
+            self.size = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in DROP_CONTENT_TAGS:
+            self.skipping.append(tag)
+            return
+        if self.skipping or tag not in PASTE_TAGS:
+            return
+        kept = []
+        for name, value in attrs:
+            if name not in PASTE_ATTRIBUTES or value is None:
+                continue
+            if name == "style":
+                value = clean_style(value)
+                if not value:
+                    continue
+            elif name in PASTE_URL_SCHEMES:
+                if not value.strip().lower().startswith(PASTE_URL_SCHEMES[name]):
+                    continue
+            kept.append(f' {name}="{escape(value)}"')
+        if tag == "img" and not any(attr.startswith(' src="') for attr in kept):
+            return
+        # Implied end tags, as in <p>one<p>two and <li>one<li>two
+        if tag in PASTE_BLOCK_TAGS and "p" in self.open:
+            self.handle_endtag("p")
+        if tag == "li" and "li" in self.open and not {"ul", "ol"} & set(self.open[self.open.index("li"):]):
+            self.handle_endtag("li")
+        if not self.open and tag in PASTE_BLOCK_TAGS:
+            self.inline = False
+        self.emit(f"<{tag}{''.join(kept)}>")
+        if tag in PASTE_VOID_TAGS:
+            self.cut()
+            return
+        self.open.append(tag)
+        if tag == "pre":
+            self.pre += 1
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in PASTE_VOID_TAGS:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if self.skipping:
+            if tag == self.skipping[-1]:
+                self.skipping.pop()
+            return
+        if tag not in self.open:
+            return
+        while self.open:
+            closed = self.open.pop()
+            self.emit(f"</{closed}>")
+            if closed == "pre":
+                self.pre -= 1
+            if closed == tag:
+                break
+        self.cut()
+
+    def handle_data(self, data):
+        if self.skipping:
+            return
+        if not self.pre:
+            data = re.sub(r"\s+", " ", data)
+            if not self.open and not data.strip():
+                return
+        self.emit(escape(data, quote=False))
+        self.cut()
+
+    def finish(self):
+        self.close()
+        while self.open:
+            self.emit(f"</{self.open.pop()}>")
+        if self.parts:
+            self.chunks.append("".join(self.parts))
+        return self.inline, self.chunks
+
+def sanitize_clipboard_html(markup):
+    """Returns (inline, chunks) for markup read from the clipboard."""
+    # Word and LibreOffice wrap the copied range in a full document; only
+    # the body is of interest.
+    start = re.search(r"<body[^>]*>", markup, re.IGNORECASE)
+    if start:
+        markup = markup[start.end():]
+    sanitizer = PasteSanitizer()
+    sanitizer.feed(markup)
+    return sanitizer.finish()
+
+def clipboard_text_to_html(text):
+    """Returns (inline, chunks) for plain text, one paragraph per line."""
+    lines = text.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+    if lines and not lines[-1]:
+        lines.pop()
+    if len(lines) == 1:
+        line = lines[0]
+        return True, [escape(line[i:i + PASTE_CHUNK_CHARS], quote=False)
+                      for i in range(0, len(line), PASTE_CHUNK_CHARS)]
+    chunks = []
+    parts = []
+    size = 0
+    for line in lines:
+        # Keep runs of spaces and indentation, which HTML would collapse
+        line = escape(line.expandtabs(4), quote=False).replace("  ", " &nbsp;")
+        if line.startswith(" "):
+            line = "&nbsp;" + line[1:]
+        part = f"<p>{line or '<br>'}</p>"
+        parts.append(part)
+        size += len(part)
+        if size >= PASTE_CHUNK_CHARS:
+            chunks.append("".join(parts))
+            parts = []
+            size = 0
+    if parts:
+        chunks.append("".join(parts))
+    return False, chunks
+
+def decode_clipboard_html(data):
+    # Firefox and Chromium offer text/html as UTF-16 on some setups
+    if data.startswith((b"\xff\xfe", b"\xfe\xff")):
+        return data.decode("utf-16", errors="replace")
+    if b"\x00" in data[:64]:
+        return data.decode("utf-16-le", errors="replace")
+    return data.decode("utf-8", errors="replace")
+
+class PasteJob:
+    """Feeds sanitized chunks to wiziwig.paste, one evaluate call each."""
+
+    def __init__(self, webview, inline, chunks, on_progress=None, on_done=None):
+        self.webview = webview
+        self.inline = inline
+        self.chunks = chunks
+        self.index = 0
+        self.cancelled = False
+        self.on_progress = on_progress
+        self.on_done = on_done
+
+    def start(self):
+        inline = "true" if self.inline else "false"
+        self.webview.evaluate_javascript(f"wiziwig.paste.begin({inline})", -1, None, None, None,
+                                         self.on_step, None)
+
+    def cancel(self):
+        # Chunks already inserted stay, and undo removes them in one step
+        self.cancelled = True
+
+    def on_step(self, webview, result, user_data):
+        try:
+            webview.evaluate_javascript_finish(result)
+        except GLib.Error as e:
+            print("Paste error:", e.message)
+            self.cancelled = True
+        if self.cancelled or self.index >= len(self.chunks):
+            webview.evaluate_javascript("wiziwig.paste.end()", -1, None, None, None, self.on_end, None)
+            return
+        chunk = self.chunks[self.index]
+        self.index += 1
+        if self.on_progress:
+            self.on_progress(self.index / len(self.chunks))
+        webview.evaluate_javascript(f"wiziwig.paste.chunk({json.dumps(chunk)})", -1, None, None, None,
+                                    self.on_step, None)
+
+    def on_end(self, webview, result, user_data):
+        try:
+            webview.evaluate_javascript_finish(result)
+        except GLib.Error as e:
+            print("Paste error:", e.message)
+        if self.on_done:
+            self.on_done(self)
+
+def encode_ranges(order):
+    # [1, 2, 3, 7, 9, 10] -> [[1, 3], 7, [9, 10]]
+    encoded = []
+    start = prev = None
+    for value in order:
+        if prev is not None and value == prev + 1:
+            prev = value
+            continue
+        if start is not None:
+            encoded.append(start if start == prev else [start, prev])
+        start = prev = value
+    if start is not None:
+        encoded.append(start if start == prev else [start, prev])
+    return encoded
+
+def decode_ranges(encoded):
+    order = []
+    for item in encoded:
+        if isinstance(item, list):
+            order.extend(range(item[0], item[1] + 1))
+        else:
+            order.append(item)
+    return order
+
+class JournalWriter:
+    """Writes the journals of every open document on one thread. Each
+    document's model and stream are kept under its journal key."""
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread = None
+
+    def put(self, op, journal, key, payload=None):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.writer_thread, daemon=True)
+            self.thread.start()
+        self.queue.put((op, journal, key, payload))
+
+    def close(self):
+        # Drain pending writes before the process exits.
+        if self.thread:
+            self.queue.put(("stop", None, None, None))
+            self.thread.join(timeout=5)
+            self.thread = None
+
+    def writer_thread(self):
+        # key -> [model, stream, records since the last compaction]
+        journals = {}
+        while True:
+            op, journal, key, payload = self.queue.get()
+            if op == "stop":
+                for model, stream, records in journals.values():
+                    stream.close()
+                return
+            try:
+                if op in ("start", "resume", "close", "discard") and key in journals:
+                    journals.pop(key)[1].close()
+                if op == "start":
+                    os.makedirs(journal.directory, exist_ok=True)
+                    model = {"header": payload, "order": list(range(1, payload["n"] + 1)),
+                             "html": {}, "head": None, "next_id": payload["n"] + 1}
+                    journals[key] = [model, *self.compact(journal, key, model)]
+                elif op == "resume":
+                    journals[key] = [payload, *self.compact(journal, key, payload)]
+                elif op == "append" and key in journals:
+                    state = journals[key]
+                    model, stream, records = state
+                    try:
+                        apply_journal_record(model, payload)
+                    except ValueError as e:
+                        # The model no longer matches the page. Replaying
+                        # this journal would restore the wrong document, so
+                        # it is dropped and a full one started over.
+                        print("Journal error:", e)
+                        journals.pop(key)
+                        stream.close()
+                        journal.remove(key)
+                        if journal.on_reset:
+                            GLib.idle_add(journal.on_reset, key)
+                        continue
+                    stream.write(json.dumps(payload) + "\n")
+                    stream.flush()
+                    os.fsync(stream.fileno())
+                    state[2] = records + 1
+                    if state[2] >= JOURNAL_COMPACT_RECORDS or stream.tell() >= JOURNAL_COMPACT_BYTES:
+                        stream.close()
+                        state[1:] = self.compact(journal, key, model)
+                elif op == "discard":
+                    journal.remove(key)
+            except (OSError, ValueError, KeyError) as e:
+                journals.pop(key, None)
+                print("Journal error:", e)
+
+    @staticmethod
+    def compact(journal, key, model):
+        # Snapshot = base reference + order of block ids + html of every
+        # block that differs from the base. The journal restarts empty.
+        snapshot_path, journal_path = journal.paths(key)
+        snapshot = {"header": model["header"], "order": encode_ranges(model["order"]),
+                    "html": list(model["html"].items()), "head": model["head"],
+                    "next_id": model["next_id"]}
+        tmp_path = snapshot_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(snapshot, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, snapshot_path)
+        return [open(journal_path, "w"), 0]
+
+class Journal:
+    # Shared by the documents of every window
+    writer = JournalWriter()
+    # Orphans already offered for recovery in this process
+    claimed = set()
+
+    def __init__(self):
+        self.directory = os.path.join(GLib.get_user_cache_dir(), "wiziwig", "journal")
+        self.key = None
+        # Called on the main loop with the key of a journal that was dropped
+        # because it no longer matched the document.
+        self.on_reset = None
+
+    @staticmethod
+    def key_for_file(file):
+        if file is None:
+            return f"untitled-{uuid.uuid4().hex}"
+        return hashlib.sha1(file.get_uri().encode()).hexdigest()
+
+    @staticmethod
+    def base_info(file):
+        path = file.get_path() if file else None
+        info = {"uri": file.get_uri() if file else None, "size": None, "mtime": None}
+        if path:
+            try:
+                st = os.stat(path)
+                info["size"] = st.st_size
+                info["mtime"] = st.st_mtime
+            except OSError:
+                pass
+        return info
+
+    def paths(self, key):
+        base = os.path.join(self.directory, key)
+        return base + ".snapshot", base + ".journal"
+
+    def switch(self, key):
+        # A journal left under another key stays on disk but is closed
+        if self.key and self.key != key:
+            Journal.writer.put("close", self, self.key)
+        self.key = key
+
+    def start(self, file, n, key=None, window=None, full=False):
+        # window ties an untitled journal to the window that wrote it; a full
+        # journal records every block and does not depend on the file.
+        self.switch(key or self.key_for_file(file))
+        header = self.base_info(file)
+        if full:
+            header.update({"size": None, "mtime": None, "full": True})
+        header.update({"pid": os.getpid(), "window": window, "n": n, "created": time.time()})
+        Journal.writer.put("start", self, self.key, header)
+
+    def resume(self, key, model, window=None):
+        # Continue journaling on top of a recovered model.
+        self.switch(key)
+        model["header"]["pid"] = os.getpid()
+        model["header"]["window"] = window
+        Journal.writer.put("resume", self, key, model)
+
+    def append(self, batch):
+        if self.key:
+            Journal.writer.put("append", self, self.key, batch)
+
+    def discard(self):
+        if self.key:
+            Journal.writer.put("discard", self, self.key)
+            self.key = None
+
+    def find_orphan(self, file, window=None):
+        # Returns the key of a journal left behind by a dead process for this
+        # document. Untitled journals are only offered to the window that
+        # wrote them, and each orphan to one document only.
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return None
+        if file is not None:
+            key = self.key_for_file(file)
+            candidates = [key] if key + ".snapshot" in names else []
+        else:
+            candidates = [name[:-len(".snapshot")] for name in names
+                          if name.startswith("untitled-") and name.endswith(".snapshot")]
+        orphans = []
+        for key in candidates:
+            snapshot_path, journal_path = self.paths(key)
+            try:
+                with open(snapshot_path) as f:
+                    header = json.load(f)["header"]
+            except (OSError, ValueError, KeyError):
+                continue
+            if key in Journal.claimed or (file is None and header.get("window") != window):
+                continue
+            if header["pid"] != os.getpid() and not pid_alive(header["pid"]):
+                orphans.append((header.get("created", 0), key))
+        if not orphans:
+            return None
+        key = max(orphans)[1]  # the most recent one
+        Journal.claimed.add(key)
+        return key
+
+    def load(self, key):
+        # Replays the journal onto its snapshot. Runs in a worker thread.
+        snapshot_path, journal_path = self.paths(key)
+        with open(snapshot_path) as f:
+            snapshot = json.load(f)
+        model = {"header": snapshot["header"], "order": decode_ranges(snapshot["order"]),
+                 "html": {int(k): v for k, v in snapshot["html"]}, "head": snapshot["head"],
+                 "next_id": snapshot["next_id"]}
+        changed = bool(model["html"]) or model["head"] is not None or model["order"] != list(range(1, model["header"]["n"] + 1))
+        try:
+            with open(journal_path) as f:
+                for line in f:
+                    try:
+                        apply_journal_record(model, json.loads(line))
+                    except ValueError:
+                        break  # torn final write, or the page drifted after it
+                    changed = True
+        except FileNotFoundError:
+            pass
+        if model["header"].get("full"):
+            # Cut short before its first record; there is nothing to restore
+            if any(block_id not in model["html"] for block_id in model["order"]):
+                return None
+        return model if changed else None
+
+    def remove(self, key):
+        for path in self.paths(key):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+def apply_journal_record(model, record):
+    # Raises ValueError, leaving the model as it was, when the record names a
+    # block the model does not have.
+    order = model["order"]
+    html = model["html"]
+    live = set(order)
+    for block_id in record.get("d", ()):
+        if block_id not in live:
+            raise ValueError(f"journal removes unknown block {block_id}")
+        live.discard(block_id)
+    for block_id, prev_id, block_html in record.get("i", ()):
+        if prev_id and prev_id not in live:
+            raise ValueError(f"journal inserts after unknown block {prev_id}")
+        live.add(block_id)
+    for block_id, block_html in record.get("s", ()):
+        if block_id not in live:
+            raise ValueError(f"journal changes unknown block {block_id}")
+    for block_id in record.get("d", ()):
+        order.remove(block_id)
+        html.pop(block_id, None)
+    for block_id, prev_id, block_html in record.get("i", ()):
+        order.insert(order.index(prev_id) + 1 if prev_id else 0, block_id)
+        html[block_id] = block_html
+        model["next_id"] = max(model["next_id"], block_id + 1)
+    for block_id, block_html in record.get("s", ()):
+        html[block_id] = block_html
+    if "h" in record:
+        model["head"] = record["h"]
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+class EditorDocument:
+    def __init__(self):
+        self.webview = None
+        self.saver = None
+        self.bridge = None
+        self.current_file = None
+        # The file the page was loaded from, which the journal replays onto.
+        # It differs from current_file after restoring a hibernated tab.
+        self.journal_base = None
+        self.journal_key = Journal.key_for_file(None)
+        self.journal = Journal()
+        # False when the page being loaded holds changes not in current_file
+        self.load_is_clean = True
+        self.pristine = True
+        self.pending_restore = None
+        # Text to find once the page is ready, set when opened from the library
+        self.pending_find = None
+        self.page = None
+        self.container = Gtk.ScrolledWindow(vexpand=True)
+        self.last_active = time.monotonic()
+        self.hibernating = False
+        self.hibernation_file = None
+        self.scroll_position = None
+        self.normalize_stats = {"blocks": 0, "nodes_before": 0, "nodes_after": 0}
+        self.history_stats = {}
+        # Set while the view waits in the warm pool, before it gets a tab
+        self.pooled = False
+        self.warm = False
+        # (monotonic start, kind) of the switch being timed until editable
+        self.editable_started = None
+        # How images are written on save, chosen on the first Save As
+        self.image_mode = None
+        # Monotonic time the current page load started, for the profiler
+        self.load_started = None
+        # Whether the page being shown was loaded without unsaved changes
+        self.loaded_clean = True
+        # Watches current_file for writes by other programs
+        self.monitor = None
+        self.monitored_path = None
+        # file_stamp() of current_file as last loaded, saved or reloaded
+        self.disk_stamp = None
+        self.external_check_id = 0
+        # Set when a change arrived while the page could not take it
+        self.external_pending = False
+        # "conflict" or "deleted" while the tab has an unresolved disk change
+        self.external_state = None
+        self.external_conflicts = 0
+        # Bumped for every journaled edit; an exported PDF stays valid while
+        # the revision it was printed at is current
+        self.revision = 0
+        self.pdf_cache = None
+        # Set when the tab closes once the save in progress has finished
+        self.close_after_save = False
+        self.save_when_ready = False
+
+    def title(self):
+        return self.current_file.get_basename() if self.current_file else "Untitled"
+
+    def set_file(self, file):
+        self.current_file = file
+        self.journal_base = file
+        self.journal_key = Journal.key_for_file(file)
+        if self.page:
+            self.page.set_title(self.title())
+
+    def attach(self, webview):
+        self.webview = webview
+        self.saver = DocumentSaver(webview)
+        self.bridge = CommandBridge(webview)
+        self.container.set_child(webview)
+
+    def detach(self):
+        self.webview = None
+        self.saver = None
+        self.bridge = None
+        self.container.set_child(Adw.StatusPage(icon_name="document-open-recent-symbolic",
+                                                title=self.title()))
+
+    def remove_hibernation_file(self):
+        if self.hibernation_file:
+            try:
+                self.hibernation_file.delete(None)
+            except GLib.Error:
+                pass
+            self.hibernation_file = None
+
+    def remove_pdf_cache(self):
+        if self.pdf_cache:
+            try:
+                os.remove(self.pdf_cache[1])
+            except OSError:
+                pass
+            self.pdf_cache = None
+
+# Export: PDF comes from WebKit's printing and is kept per document until the
+# next edit. ODT and DOCX are converted from a snapshot of the page in a
+# worker thread, which streams it through a DocumentWalker into the zip.
+EXPORT_FORMATS = {
+    "pdf": ("PDF Document", "application/pdf"),
+    "odt": ("OpenDocument Text", "application/vnd.oasis.opendocument.text"),
+    "docx": ("Word Document", "application/vnd.openxmlformats-officedocument.wordprocessingml.document"),
+}
+EXPORT_READ_BYTES = 256 * 1024
+
+WALK_BLOCK_TAGS = {
+    "address", "article", "blockquote", "caption", "dd", "div", "dt", "footer", "h1", "h2", "h3",
+    "h4", "h5", "h6", "header", "hr", "li", "ol", "p", "pre", "section", "table", "td", "th", "tr",
+    "ul",
+}
+WALK_VOID_TAGS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "source", "wbr"}
+WALK_TAG_STYLES = {
+    "b": {"bold": True}, "strong": {"bold": True}, "i": {"italic": True}, "em": {"italic": True},
+    "u": {"underline": True}, "ins": {"underline": True}, "s": {"strike": True},
+    "strike": {"strike": True}, "del": {"strike": True}, "sup": {"vertical": "super"},
+    "sub": {"vertical": "sub"}, "code": {"font": "monospace", "code": True},
+}
+CLASS_RULE_RE = re.compile(r"\.(wz-\d+)\s*\{([^}]*)\}")
+# Code block languages, as markdown_to_html writes them
+WALK_LANGUAGE_RE = re.compile(r"(?:^|\s)language-([^\s`~]+)")
+# Whitespace that HTML collapses; no-break spaces are kept
+WALK_SPACE_RE = re.compile(r"[ \t\n\r\f]+")
+CSS_FONT_SIZES = {
+    "xx-small": 7, "x-small": 7.5, "small": 10, "medium": 12, "large": 13.5, "x-large": 18,
+    "xx-large": 24, "xxx-large": 36,
+}
+CSS_COLOR_NAMES = {
+    "black": "000000", "white": "FFFFFF", "red": "FF0000", "green": "008000", "blue": "0000FF",
+    "yellow": "FFFF00", "orange": "FFA500", "purple": "800080", "gray": "808080", "grey": "808080",
+}
+
+def parse_style(value):
+    declarations = {}
+    for declaration in value.split(";"):
+        name, sep, val = declaration.partition(":")
+        if sep:
+            declarations[name.strip().lower()] = val.replace("!important", "").strip()
+    return declarations
+
+def css_color(value):
+    """Returns an RRGGBB hex string for a CSS color, or None."""
+    value = value.strip().lower()
+    match = re.fullmatch(r"#([0-9a-f]{3}|[0-9a-f]{6})", value)
+    if match:
+        digits = match.group(1)
+        return (digits if len(digits) == 6 else "".join(c * 2 for c in digits)).upper()
+    match = re.fullmatch(r"rgba?\(\s*(\d+)\s*,\s*(\d+)\s*,\s*(\d+)\s*(?:,\s*([\d.]+)\s*)?\)", value)
+    if match:
+        if match.group(4) is not None and float(match.group(4)) == 0:
+            return None  # transparent
+        return "".join(f"{min(255, int(c)):02X}" for c in match.group(1, 2, 3))
+    return CSS_COLOR_NAMES.get(value)
+
+def css_points(value):
+    value = value.strip().lower()
+    if value in CSS_FONT_SIZES:
+        return CSS_FONT_SIZES[value]
+    match = re.fullmatch(r"([\d.]+)\s*(pt|px)?", value)
+    if not match:
+        return None
+    try:
+        size = float(match.group(1))
+    except ValueError:
+        return None
+    return size if match.group(2) == "pt" else size * 0.75
+
+class DocumentWalker(HTMLParser):
+    """Reduces editor HTML to paragraphs, styled runs and lists.
+
+    Events go to a sink as they are parsed, so documents of any size are
+    converted in one pass: list_start(ordered), item_start(), item_end(),
+    list_end(), paragraph_start(block), text(text, style), image(attrs,
+    style), line_break(), paragraph_end() and rule(). block has heading (0
+    for body text), align, indent, pre and language, from a language-*
+    class on a <pre> or its <code>; style holds only the properties that
+    are set."""
+
+    def __init__(self, sink):
+        super().__init__(convert_charrefs=True)
+        self.sink = sink
+        # (tag, style, align) for every open element
+        self.stack = [("", {}, None)]
+        self.skip = 0
+        self.capture = None
+        self.classes = {}
+        self.in_paragraph = False
+        # Open <pre> elements and the language of the outermost one
+        self.pre = 0
+        self.language = None
+        self.breaks = 0
+        # Whether the innermost open block held a line break but no text
+        self.block_breaks = []
+        self.trailing_space = False
+
+    def handle_starttag(self, tag, attrs):
+        if self.skip:
+            if tag in DROP_CONTENT_TAGS:
+                self.skip += 1
+                if tag == "style":
+                    self.capture = []
+            return
+        if tag in DROP_CONTENT_TAGS:
+            self.skip = 1
+            return
+        if tag == "br":
+            self.breaks += 1
+            if self.block_breaks and not self.in_paragraph:
+                self.block_breaks[-1] = True
+            return
+        if tag in WALK_VOID_TAGS:
+            if tag == "hr":
+                self.end_paragraph()
+                self.sink.rule()
+            elif tag == "img":
+                self.open_inline()
+                self.sink.image(dict(attrs), self.stack[-1][1])
+                self.trailing_space = False
+            return
+        attrs = dict(attrs)
+        style, align = self.element_style(tag, attrs)
+        if tag in WALK_BLOCK_TAGS:
+            self.end_paragraph()
+            self.block_breaks.append(False)
+            if tag in ("ul", "ol"):
+                self.sink.list_start(tag == "ol")
+            elif tag == "li":
+                self.sink.item_start()
+        if tag == "pre":
+            self.pre += 1
+        if self.pre and tag in ("pre", "code") and not self.in_paragraph and not self.language:
+            match = WALK_LANGUAGE_RE.search(attrs.get("class") or "")
+            self.language = match.group(1) if match else None
+        self.stack.append((tag, style, align if tag in WALK_BLOCK_TAGS else None))
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in WALK_VOID_TAGS:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if self.skip:
+            if tag in DROP_CONTENT_TAGS:
+                self.skip -= 1
+                if tag == "style" and self.capture is not None:
+                    for name, body in CLASS_RULE_RE.findall("".join(self.capture)):
+                        self.classes[name] = parse_style(body)
+                    self.capture = None
+            return
+        if tag in WALK_VOID_TAGS or not any(entry[0] == tag for entry in self.stack):
+            return
+        while True:
+            open_tag = self.stack.pop()[0]
+            if open_tag == "pre":
+                self.pre -= 1
+                if not self.pre:
+                    self.language = None
+            if open_tag in WALK_BLOCK_TAGS:
+                self.end_block(open_tag)
+            if open_tag == tag:
+                break
+
+    def end_block(self, tag):
+        self.end_paragraph()
+        if self.block_breaks.pop():
+            # An otherwise empty block, <p><br></p>, is a blank line
+            self.start_paragraph()
+            self.end_paragraph()
+        if tag == "li":
+            self.sink.item_end()
+        elif tag in ("ul", "ol"):
+            self.sink.list_end()
+
+    def handle_data(self, data):
+        if self.skip:
+            if self.capture is not None:
+                self.capture.append(data)
+            return
+        if self.pre:
+            lines = data.split("\n")
+            for i, line in enumerate(lines):
+                if i:
+                    self.breaks += 1
+                if line:
+                    self.emit(line)
+            if len(lines) > 1 and self.block_breaks and not self.in_paragraph:
+                self.block_breaks[-1] = True
+            return
+        text = WALK_SPACE_RE.sub(" ", data)
+        if (not self.in_paragraph or self.trailing_space or self.breaks) and text.startswith(" "):
+            text = text[1:]
+        if text:
+            self.emit(text)
+
+    def open_inline(self):
+        if not self.in_paragraph:
+            self.start_paragraph()
+        for _ in range(self.breaks):
+            self.sink.line_break()
+        self.breaks = 0
+        if self.block_breaks:
+            self.block_breaks[-1] = False
+
+    def emit(self, text):
+        self.open_inline()
+        self.sink.text(text, self.stack[-1][1])
+        self.trailing_space = text.endswith(" ")
+
+    def start_paragraph(self):
+        heading = 0
+        align = None
+        indent = 0
+        for tag, style, tag_align in reversed(self.stack):
+            if not heading and len(tag) == 2 and tag[0] == "h" and tag[1] in "123456":
+                heading = int(tag[1])
+            if align is None:
+                align = tag_align
+            if tag == "blockquote":
+                indent += 1
+        self.in_paragraph = True
+        self.trailing_space = False
+        self.breaks = 0
+        self.sink.paragraph_start({"heading": heading, "align": align, "indent": indent,
+                                   "pre": self.pre > 0, "language": self.language})
+
+    def end_paragraph(self):
+        # A final <br> ends the line it is on; any before it are blank lines
+        if self.in_paragraph:
+            for _ in range(self.breaks - 1):
+                self.sink.line_break()
+            self.sink.paragraph_end()
+            self.in_paragraph = False
+        self.breaks = 0
+
+    def element_style(self, tag, attrs):
+        if not attrs and tag not in WALK_TAG_STYLES:
+            # Shared with the parent, so runs on either side stay one run
+            return self.stack[-1][1], None
+        declarations = {}
+        for name in (attrs.get("class") or "").split():
+            declarations.update(self.classes.get(name, {}))
+        declarations.update(parse_style(attrs.get("style") or ""))
+        style = dict(self.stack[-1][1])
+        style.update(WALK_TAG_STYLES.get(tag, {}))
+        if tag == "a" and attrs.get("href"):
+            style["href"] = attrs["href"]
+        if tag == "font":
+            if attrs.get("color"):
+                declarations.setdefault("color", attrs["color"])
+            if attrs.get("face"):
+                declarations.setdefault("font-family", attrs["face"])
+        weight = declarations.get("font-weight")
+        if weight:
+            style["bold"] = weight in ("bold", "bolder") or (weight.isdigit() and int(weight) >= 600)
+        if "font-style" in declarations:
+            style["italic"] = declarations["font-style"] in ("italic", "oblique")
+        decoration = declarations.get("text-decoration-line", declarations.get("text-decoration"))
+        if decoration:
+            style["underline"] = "underline" in decoration or style.get("underline", False)
+            style["strike"] = "line-through" in decoration or style.get("strike", False)
+            if decoration.startswith("none"):
+                style["underline"] = style["strike"] = False
+        if declarations.get("vertical-align") in ("super", "sub"):
+            style["vertical"] = declarations["vertical-align"]
+        if declarations.get("font-family"):
+            style["font"] = declarations["font-family"].split(",")[0].strip().strip("'\"")
+        if declarations.get("font-size"):
+            size = css_points(declarations["font-size"])
+            if size:
+                style["size"] = size
+        for name, key in (("color", "color"), ("background-color", "background")):
+            if declarations.get(name):
+                color = css_color(declarations[name])
+                if color:
+                    style[key] = color
+        style = {key: value for key, value in style.items() if value}
+        align = declarations.get("text-align") or attrs.get("align")
+        return style, align.lower() if align else None
+
+ODT_NAMESPACES = (
+    'xmlns:office="urn:oasis:names:tc:opendocument:xmlns:office:1.0" '
+    'xmlns:style="urn:oasis:names:tc:opendocument:xmlns:style:1.0" '
+    'xmlns:text="urn:oasis:names:tc:opendocument:xmlns:text:1.0" '
+    'xmlns:fo="urn:oasis:names:tc:opendocument:xmlns:xsl-fo-compatible:1.0" '
+    'xmlns:xlink="http://www.w3.org/1999/xlink" office:version="1.3"'
+)
+ODT_ALIGN = {"left": "start", "start": "start", "center": "center", "right": "end", "end": "end",
+             "justify": "justify"}
+ODT_HEADING_SIZES = {1: "200%", 2: "150%", 3: "117%", 4: "100%", 5: "83%", 6: "67%"}
+
+def odt_text(text):
+    # Runs of spaces and tabs collapse in ODF unless spelled out
+    text = escape(text, quote=False).replace("\t", "<text:tab/>")
+    return re.sub(r"  +", lambda m: f' <text:s text:c="{len(m.group()) - 1}"/>', text)
+
+class OdtWriter:
+    """DocumentWalker sink writing an OpenDocument text file into a zip.
+
+    content.xml declares its automatic styles before the body, so the body
+    is spooled to a temporary file and copied in once every style is known."""
+
+    def __init__(self, archive):
+        self.archive = archive
+        self.body = tempfile.TemporaryFile("w+", encoding="utf-8")
+        self.parts = []
+        self.text_styles = {}
+        self.paragraph_styles = {}
+        # One entry per open text:list, whether it has an open list item
+        # and whether that item was opened implicitly
+        self.lists = []
+        self.tag = None
+
+    def write(self, text):
+        self.parts.append(text)
+
+    def drain(self):
+        self.body.write("".join(self.parts))
+        self.parts = []
+
+    def ensure_item(self):
+        if self.lists and not self.lists[-1]["item"]:
+            self.write("<text:list-item>")
+            self.lists[-1].update(item=True, implicit=True)
+
+    def list_start(self, ordered):
+        self.ensure_item()
+        self.write(f'<text:list text:style-name="{"L2" if ordered else "L1"}">')
+        self.lists.append({"item": False, "implicit": False})
+
+    def item_start(self):
+        if not self.lists:
+            return
+        self.item_end()
+        self.write("<text:list-item>")
+        self.lists[-1]["item"] = True
+
+    def item_end(self):
+        if self.lists and self.lists[-1]["item"]:
+            self.write("</text:list-item>")
+            self.lists[-1].update(item=False, implicit=False)
+
+    def list_end(self):
+        if not self.lists:
+            return
+        self.item_end()
+        self.write("</text:list>")
+        self.lists.pop()
+        if self.lists and self.lists[-1]["implicit"]:
+            self.item_end()
+
+    def paragraph_start(self, block):
+        self.ensure_item()
+        heading = block["heading"]
+        parent = (f"Heading_20_{heading}" if heading else
+                  "Preformatted_20_Text" if block["pre"] else "Standard")
+        name = parent
+        align = ODT_ALIGN.get(block["align"])
+        if align or block["indent"]:
+            key = (parent, align, block["indent"])
+            name = self.paragraph_styles.setdefault(key, f"P{len(self.paragraph_styles) + 1}")
+        if heading:
+            self.tag = "text:h"
+            self.write(f'<text:h text:style-name="{name}" text:outline-level="{heading}">')
+        else:
+            self.tag = "text:p"
+            self.write(f'<text:p text:style-name="{name}">')
+
+    def text(self, text, style):
+        content = odt_text(text)
+        key = tuple(sorted((k, v) for k, v in style.items() if k != "href"))
+        if key:
+            name = self.text_styles.setdefault(key, f"T{len(self.text_styles) + 1}")
+            content = f'<text:span text:style-name="{name}">{content}</text:span>'
+        if "href" in style:
+            content = f'<text:a xlink:type="simple" xlink:href="{escape(style["href"])}">{content}</text:a>'
+        self.write(content)
+
+    def image(self, attrs, style):
+        pass  # images are not exported
+
+    def rule(self):
+        pass
+
+    def line_break(self):
+        self.write("<text:line-break/>")
+
+    def paragraph_end(self):
+        self.write(f"</{self.tag}>")
+
+    def automatic_styles(self):
+        styles = []
+        for (parent, align, indent), name in self.paragraph_styles.items():
+            properties = f' fo:text-align="{align}"' if align else ""
+            if indent:
+                properties += f' fo:margin-left="{indent * 0.5}in"'
+            styles.append(f'<style:style style:name="{name}" style:family="paragraph" '
+                          f'style:parent-style-name="{parent}">'
+                          f'<style:paragraph-properties{properties}/></style:style>')
+        for key, name in self.text_styles.items():
+            style = dict(key)
+            properties = []
+            if style.get("bold"):
+                properties.append('fo:font-weight="bold"')
+            if style.get("italic"):
+                properties.append('fo:font-style="italic"')
+            if style.get("underline"):
+                properties.append('style:text-underline-style="solid" style:text-underline-width="auto" '
+                                  'style:text-underline-color="font-color"')
+            if style.get("strike"):
+                properties.append('style:text-line-through-style="solid"')
+            if style.get("vertical"):
+                properties.append(f'style:text-position="{style["vertical"]} 58%"')
+            if style.get("font"):
+                properties.append(f'fo:font-family="{escape(style["font"])}"')
+            if style.get("size"):
+                properties.append(f'fo:font-size="{style["size"]:g}pt"')
+            if style.get("color"):
+                properties.append(f'fo:color="#{style["color"]}"')
+            if style.get("background"):
+                properties.append(f'fo:background-color="#{style["background"]}"')
+            styles.append(f'<style:style style:name="{name}" style:family="text">'
+                          f'<style:text-properties {" ".join(properties)}/></style:style>')
+        for name, ordered in (("L1", False), ("L2", True)):
+            levels = []
+            for level in range(1, 11):
+                alignment = (f'<style:list-level-properties text:list-level-position-and-space-mode="label-alignment">'
+                             f'<style:list-level-label-alignment text:label-followed-by="listtab" '
+                             f'fo:text-indent="-0.25in" fo:margin-left="{level * 0.5}in"/>'
+                             f'</style:list-level-properties>')
+                if ordered:
+                    levels.append(f'<text:list-level-style-number text:level="{level}" style:num-suffix="." '
+                                  f'style:num-format="1">{alignment}</text:list-level-style-number>')
+                else:
+                    levels.append(f'<text:list-level-style-bullet text:level="{level}" text:bullet-char="•">'
+                                  f'{alignment}</text:list-level-style-bullet>')
+            styles.append(f'<text:list-style style:name="{name}">{"".join(levels)}</text:list-style>')
+        return "".join(styles)
+
+    def finish(self):
+        while self.lists:
+            self.list_end()
+        self.drain()
+        self.archive.writestr(zipfile.ZipInfo("mimetype"), EXPORT_FORMATS["odt"][1], zipfile.ZIP_STORED)
+        self.archive.writestr("META-INF/manifest.xml",
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<manifest:manifest xmlns:manifest="urn:oasis:names:tc:opendocument:xmlns:manifest:1.0" '
+            'manifest:version="1.3">'
+            f'<manifest:file-entry manifest:full-path="/" manifest:media-type="{EXPORT_FORMATS["odt"][1]}"/>'
+            '<manifest:file-entry manifest:full-path="content.xml" manifest:media-type="text/xml"/>'
+            '<manifest:file-entry manifest:full-path="styles.xml" manifest:media-type="text/xml"/>'
+            '</manifest:manifest>')
+        headings = "".join(
+            f'<style:style style:name="Heading_20_{level}" style:display-name="Heading {level}" '
+            f'style:family="paragraph" style:parent-style-name="Standard" style:default-outline-level="{level}">'
+            f'<style:paragraph-properties fo:margin-top="0.17in" fo:margin-bottom="0.08in"/>'
+            f'<style:text-properties fo:font-size="{size}" fo:font-weight="bold"/></style:style>'
+            for level, size in ODT_HEADING_SIZES.items())
+        self.archive.writestr("styles.xml",
+            f'<?xml version="1.0" encoding="UTF-8"?><office:document-styles {ODT_NAMESPACES}>'
+            '<office:styles><style:style style:name="Standard" style:family="paragraph">'
+            '<style:paragraph-properties fo:margin-bottom="0.08in"/></style:style>'
+            '<style:style style:name="Preformatted_20_Text" style:display-name="Preformatted Text" '
+            'style:family="paragraph" style:parent-style-name="Standard">'
+            '<style:text-properties fo:font-family="monospace"/></style:style>'
+            f'{headings}</office:styles></office:document-styles>')
+        with self.archive.open("content.xml", "w") as content:
+            content.write(f'<?xml version="1.0" encoding="UTF-8"?><office:document-content {ODT_NAMESPACES}>'
+                          f'<office:automatic-styles>{self.automatic_styles()}</office:automatic-styles>'
+                          '<office:body><office:text>'.encode())
+            self.body.seek(0)
+            for chunk in iter(lambda: self.body.read(EXPORT_READ_BYTES), ""):
+                content.write(chunk.encode())
+            content.write(b"</office:text></office:body></office:document-content>")
+        self.body.close()
+
+    def abort(self):
+        self.body.close()
+
+DOCX_NAMESPACES = (
+    'xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships"'
+)
+DOCX_RELATIONSHIPS = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+DOCX_ALIGN = {"left": "left", "start": "left", "center": "center", "right": "right", "end": "right",
+              "justify": "both"}
+DOCX_HEADING_SIZES = {1: 32, 2: 26, 3: 24, 4: 22, 5: 20, 6: 18}
+
+class DocxWriter:
+    """DocumentWalker sink writing a Word document into a zip.
+
+    Run formatting is inline in WordprocessingML, so word/document.xml is
+    streamed straight into the archive; numbering and hyperlink targets
+    collected on the way are written after it."""
+
+    def __init__(self, archive):
+        self.archive = archive
+        self.stream = archive.open("word/document.xml", "w")
+        self.parts = [f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?><w:document {DOCX_NAMESPACES}>'
+                      '<w:body>']
+        # ordered flag for each list, numbered from 1 in w:numId order
+        self.numbers = []
+        self.lists = []
+        self.links = {}
+
+    def write(self, text):
+        self.parts.append(text)
+
+    def drain(self):
+        self.stream.write("".join(self.parts).encode())
+        self.parts = []
+
+    def list_start(self, ordered):
+        self.numbers.append(ordered)
+        self.lists.append({"id": len(self.numbers), "fresh": False})
+
+    def item_start(self):
+        if self.lists:
+            self.lists[-1]["fresh"] = True
+
+    def item_end(self):
+        pass
+
+    def list_end(self):
+        if self.lists:
+            self.lists.pop()
+
+    def paragraph_start(self, block):
+        properties = []
+        heading = block["heading"]
+        if heading:
+            properties.append(f'<w:pStyle w:val="Heading{heading}"/>')
+        elif block["pre"]:
+            properties.append('<w:pStyle w:val="HTMLPreformatted"/>')
+        elif self.lists:
+            properties.append('<w:pStyle w:val="ListParagraph"/>')
+        indent = block["indent"] * 720
+        if self.lists:
+            entry = self.lists[-1]
+            level = len(self.lists) - 1
+            if entry["fresh"]:
+                properties.append(f'<w:numPr><w:ilvl w:val="{level}"/><w:numId w:val="{entry["id"]}"/></w:numPr>')
+                entry["fresh"] = False
+            else:
+                # Later paragraphs of an item line up with its text
+                indent += 720 * (level + 1)
+        if indent:
+            properties.append(f'<w:ind w:left="{indent}"/>')
+        if block["align"] in DOCX_ALIGN:
+            properties.append(f'<w:jc w:val="{DOCX_ALIGN[block["align"]]}"/>')
+        self.write(f'<w:p><w:pPr>{"".join(properties)}</w:pPr>' if properties else "<w:p>")
+
+    def text(self, text, style):
+        properties = []
+        if "href" in style:
+            properties.append('<w:rStyle w:val="Hyperlink"/>')
+        if style.get("font"):
+            font = escape(style["font"])
+            properties.append(f'<w:rFonts w:ascii="{font}" w:hAnsi="{font}" w:cs="{font}"/>')
+        if style.get("bold"):
+            properties.append("<w:b/>")
+        if style.get("italic"):
+            properties.append("<w:i/>")
+        if style.get("strike"):
+            properties.append("<w:strike/>")
+        if style.get("color"):
+            properties.append(f'<w:color w:val="{style["color"]}"/>')
+        if style.get("size"):
+            properties.append(f'<w:sz w:val="{round(style["size"] * 2)}"/>')
+        if style.get("underline"):
+            properties.append('<w:u w:val="single"/>')
+        if style.get("background"):
+            properties.append(f'<w:shd w:val="clear" w:color="auto" w:fill="{style["background"]}"/>')
+        if style.get("vertical"):
+            properties.append(f'<w:vertAlign w:val="{style["vertical"]}script"/>')
+        content = "<w:tab/>".join(f'<w:t xml:space="preserve">{escape(part, quote=False)}</w:t>'
+                                  for part in text.split("\t"))
+        run = f'<w:r><w:rPr>{"".join(properties)}</w:rPr>{content}</w:r>' if properties else f"<w:r>{content}</w:r>"
+        if "href" in style:
+            link = self.links.setdefault(style["href"], f"rIdLink{len(self.links) + 1}")
+            run = f'<w:hyperlink r:id="{link}">{run}</w:hyperlink>'
+        self.write(run)
+
+    def image(self, attrs, style):
+        pass  # images are not exported
+
+    def rule(self):
+        pass
+
+    def line_break(self):
+        self.write("<w:r><w:br/></w:r>")
+
+    def paragraph_end(self):
+        self.write("</w:p>")
+
+    def numbering(self):
+        abstract = []
+        for number, ordered in enumerate((False, True)):
+            levels = "".join(
+                f'<w:lvl w:ilvl="{level}"><w:start w:val="1"/>'
+                + (f'<w:numFmt w:val="decimal"/><w:lvlText w:val="%{level + 1}."/>' if ordered else
+                   '<w:numFmt w:val="bullet"/><w:lvlText w:val="•"/>')
+                + f'<w:lvlJc w:val="left"/><w:pPr><w:ind w:left="{720 * (level + 1)}" w:hanging="360"/></w:pPr></w:lvl>'
+                for level in range(9))
+            abstract.append(f'<w:abstractNum w:abstractNumId="{number}">{levels}</w:abstractNum>')
+        # Every list gets its own w:num so numbered lists restart at 1
+        nums = "".join(
+            f'<w:num w:numId="{i}"><w:abstractNumId w:val="{1 if ordered else 0}"/>'
+            + "".join(f'<w:lvlOverride w:ilvl="{level}"><w:startOverride w:val="1"/></w:lvlOverride>'
+                      for level in range(9))
+            + "</w:num>"
+            for i, ordered in enumerate(self.numbers, 1))
+        return (f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?><w:numbering {DOCX_NAMESPACES}>'
+                f'{"".join(abstract)}{nums}</w:numbering>')
+
+    def styles(self):
+        headings = "".join(
+            f'<w:style w:type="paragraph" w:styleId="Heading{level}"><w:name w:val="heading {level}"/>'
+            f'<w:basedOn w:val="Normal"/><w:next w:val="Normal"/><w:qFormat/>'
+            f'<w:pPr><w:keepNext/><w:spacing w:before="240" w:after="120"/><w:outlineLvl w:val="{level - 1}"/></w:pPr>'
+            f'<w:rPr><w:b/><w:sz w:val="{size * 2}"/></w:rPr></w:style>'
+            for level, size in DOCX_HEADING_SIZES.items())
+        return (f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?><w:styles {DOCX_NAMESPACES}>'
+                '<w:style w:type="paragraph" w:default="1" w:styleId="Normal"><w:name w:val="Normal"/>'
+                '<w:qFormat/><w:pPr><w:spacing w:after="120"/></w:pPr><w:rPr><w:sz w:val="24"/></w:rPr></w:style>'
+                f'{headings}'
+                '<w:style w:type="paragraph" w:styleId="ListParagraph"><w:name w:val="List Paragraph"/>'
+                '<w:basedOn w:val="Normal"/><w:pPr><w:spacing w:after="0"/></w:pPr></w:style>'
+                '<w:style w:type="paragraph" w:styleId="HTMLPreformatted"><w:name w:val="HTML Preformatted"/>'
+                '<w:basedOn w:val="Normal"/><w:pPr><w:spacing w:after="0"/></w:pPr>'
+                '<w:rPr><w:rFonts w:ascii="Courier New" w:hAnsi="Courier New" w:cs="Courier New"/></w:rPr></w:style>'
+                '<w:style w:type="character" w:styleId="Hyperlink"><w:name w:val="Hyperlink"/>'
+                '<w:rPr><w:color w:val="0563C1"/><w:u w:val="single"/></w:rPr></w:style>'
+                '</w:styles>')
+
+    def finish(self):
+        self.write('<w:sectPr><w:pgSz w:w="12240" w:h="15840"/>'
+                   '<w:pgMar w:top="1440" w:right="1440" w:bottom="1440" w:left="1440" '
+                   'w:header="720" w:footer="720" w:gutter="0"/></w:sectPr></w:body></w:document>')
+        self.drain()
+        self.stream.close()
+        header = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        self.archive.writestr("[Content_Types].xml",
+            f'{header}<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/word/document.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+            '<Override PartName="/word/styles.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.styles+xml"/>'
+            '<Override PartName="/word/numbering.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.numbering+xml"/>'
+            '</Types>')
+        self.archive.writestr("_rels/.rels",
+            f'{header}<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            f'<Relationship Id="rId1" Type="{DOCX_RELATIONSHIPS}/officeDocument" Target="word/document.xml"/>'
+            '</Relationships>')
+        links = "".join(f'<Relationship Id="{link}" Type="{DOCX_RELATIONSHIPS}/hyperlink" '
+                        f'Target="{escape(href)}" TargetMode="External"/>'
+                        for href, link in self.links.items())
+        self.archive.writestr("word/_rels/document.xml.rels",
+            f'{header}<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            f'<Relationship Id="rId1" Type="{DOCX_RELATIONSHIPS}/styles" Target="styles.xml"/>'
+            f'<Relationship Id="rId2" Type="{DOCX_RELATIONSHIPS}/numbering" Target="numbering.xml"/>'
+            f'{links}</Relationships>')
+        self.archive.writestr("word/styles.xml", self.styles())
+        self.archive.writestr("word/numbering.xml", self.numbering())
+
+    def abort(self):
+        self.stream.close()
+
+EXPORT_WRITERS = {"odt": OdtWriter, "docx": DocxWriter}
+
+def export_office_document(source, target, kind, on_progress=None, cancelled=None):
+    """Converts the HTML file source to an ODT or DOCX file at target.
+
+    The source is read, parsed and written in EXPORT_READ_BYTES pieces, so
+    memory use does not grow with the document. The archive is built next
+    to target and renamed over it when complete. Returns False if cancelled
+    (a threading.Event) was set on the way."""
+    total = max(1, os.path.getsize(source))
+    partial = target + ".part"
+    done = 0
+    try:
+        with zipfile.ZipFile(partial, "w", zipfile.ZIP_DEFLATED) as archive:
+            writer = EXPORT_WRITERS[kind](archive)
+            walker = DocumentWalker(writer)
+            decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+            try:
+                with open(source, "rb") as f:
+                    for data in iter(lambda: f.read(EXPORT_READ_BYTES), b""):
+                        if cancelled is not None and cancelled.is_set():
+                            writer.abort()
+                            break
+                        walker.feed(decoder.decode(data))
+                        writer.drain()
+                        done += len(data)
+                        if on_progress:
+                            on_progress(done / total)
+                    else:
+                        walker.feed(decoder.decode(b"", final=True))
+                        walker.close()
+                        writer.finish()
+            except BaseException:
+                # The zip cannot be closed while an entry is open for writing
+                writer.abort()
+                raise
+    except BaseException:
+        try:
+            os.remove(partial)
+        except OSError:
+            pass
+        raise
+    if cancelled is not None and cancelled.is_set():
+        os.remove(partial)
+        return False
+    os.replace(partial, target)
+    return True
+
+# Markdown documents are converted on the fly: opening pipes the HTML from a
+# worker thread into the document scheme, saving converts the serialized
+# blocks as they are written. Both directions are single-pass, so neither
+# ever holds the whole document.
+MARKDOWN_EXTENSIONS = (".md", ".markdown")
+MARKDOWN_READ_CHARS = 256 * 1024
+# Block quotes and list items nested deeper than this are read as text
+MARKDOWN_MAX_NESTING = 100
+
+MARKDOWN_FENCE_RE = re.compile(r" {0,3}(`{3,}|~{3,})([^`]*)$")
+MARKDOWN_HEADING_RE = re.compile(r" {0,3}(#{1,6})(?:[ \t]+(.*?))?(?:[ \t]+#+)?[ \t]*$")
+MARKDOWN_SETEXT_RE = re.compile(r" {0,3}(=+|-+)[ \t]*$")
+MARKDOWN_RULE_RE = re.compile(r" {0,3}([-*_])(?:[ \t]*\1){2,}[ \t]*$")
+MARKDOWN_QUOTE_RE = re.compile(r" {0,3}> ?(.*)$")
+MARKDOWN_LIST_RE = re.compile(r"( {0,3})([-+*]|(\d{1,9})[.)])( +|$)(.*)$")
+MARKDOWN_HTML_BLOCK_RE = re.compile(
+    r" {0,3}<(?:/?(?:address|article|aside|blockquote|center|dd|details|div|dl|dt|figure|footer|"
+    r"h[1-6]|header|hr|li|ol|p|pre|section|table|tbody|td|tfoot|th|thead|tr|ul)(?:[\s/>]|$)|!--)",
+    re.IGNORECASE)
+MARKDOWN_SPECIAL_RE = re.compile(r"[\\`*_~\[\]!<>&\n]")
+MARKDOWN_ENTITY_RE = re.compile(r"&(?:#[0-9]{1,7}|#[xX][0-9a-fA-F]{1,6}|[A-Za-z][A-Za-z0-9]{1,31});")
+# No part of a tag may contain "<", so each match attempt stops at the next
+# one and inline HTML is found in linear time.
+MARKDOWN_TAG_RE = re.compile(
+    r"</?[A-Za-z][A-Za-z0-9-]*(?:\s+[A-Za-z_:][\w.:-]*(?:\s*=\s*(?:\"[^\"<]*\"|'[^'<]*'|[^\s\"'=<>`]+))?)*\s*/?>")
+MARKDOWN_AUTOLINK_RE = re.compile(r"<([A-Za-z][A-Za-z0-9+.-]{1,31}:[^\s<>]*)>")
+MARKDOWN_DESTINATION_RE = re.compile(r"\s*(?:<([^<>\n]*)>|(\S*))(?:\s+\"[^\"]*\")?\s*")
+MARKDOWN_ESCAPABLE = set("!\"#$%&'()*+,-./:;<=>?@[\\]^_`{|}~")
+MARKDOWN_ESCAPE_NEEDED_RE = re.compile(r"[\\`*_~\[\]<>&\xa0]")
+MARKDOWN_ESCAPE_RE = re.compile(r"[\\`*_~\[\]<>]")
+MARKDOWN_ENTITY_LIKE_RE = re.compile(r"&(?=#?\w+;)")
+# Text that would start a heading, list, quote or setext underline
+MARKDOWN_LINE_START_RE = re.compile(r"^(\d*)([#+=>-]|(?<=\d)[.)])")
+MARKDOWN_EMPHASIS = {("*", 1): "i", ("_", 1): "i", ("*", 2): "b", ("_", 2): "b", ("~", 2): "strike"}
+
+def is_markdown(name):
+    return name.lower().endswith(MARKDOWN_EXTENSIONS)
+
+def markdown_inline(text):
+    """Converts the inline Markdown of one block to HTML in a single pass.
+
+    Delimiters are kept on a stack as indexes into the output; an opener
+    turns into a tag when its closer arrives and otherwise stays literal."""
+    out = []
+    stack = []
+    # Positions in stack of the open [ and ![
+    brackets = []
+    length = len(text)
+    # Failed lookups are remembered so that nothing is scanned twice
+    paren = -1
+    no_code_closer = set()
+    no_comment_closer = False
+    i = 0
+    while i < length:
+        match = MARKDOWN_SPECIAL_RE.search(text, i)
+        if not match:
+            out.append(escape(text[i:], quote=False))
+            break
+        start = match.start()
+        if start > i:
+            out.append(escape(text[i:start], quote=False))
+        c = text[start]
+        i = start + 1
+        if c == "\\":
+            if i < length and text[i] == "\n":
+                out.append("<br>")
+                i += 1
+            elif i < length and text[i] in MARKDOWN_ESCAPABLE:
+                out.append(escape(text[i], quote=False))
+                i += 1
+            else:
+                out.append("\\")
+        elif c == "\n":
+            if out and out[-1].endswith("  "):
+                out[-1] = out[-1].rstrip(" ")
+                out.append("<br>")
+            else:
+                out.append("\n")
+        elif c == "`":
+            end = i
+            while end < length and text[end] == "`":
+                end += 1
+            run = end - start
+            close = -1 if run in no_code_closer else text.find("`" * run, end)
+            if close < 0:
+                no_code_closer.add(run)
+                out.append("`" * run)
+                i = end
+            else:
+                code = text[end:close]
+                if code[:1] == code[-1:] == " " and code.strip(" "):
+                    code = code[1:-1]
+                out.append(f"<code>{escape(code, quote=False)}</code>")
+                i = close + run
+        elif c in "*_~":
+            end = i
+            while end < length and text[end] == c:
+                end += 1
+            run = end - start
+            before = text[start - 1] if start else " "
+            after = text[end] if end < length else " "
+            can_open = not after.isspace()
+            can_close = not before.isspace()
+            if c == "_":
+                can_open = can_open and not before.isalnum()
+                can_close = can_close and not after.isalnum()
+            remaining = run
+            if can_close:
+                while remaining and stack and stack[-1][0] == c and stack[-1][1] <= remaining:
+                    _, size, index = stack.pop()
+                    tag = MARKDOWN_EMPHASIS.get((c, size))
+                    if tag:
+                        out[index] = f"<{tag}>"
+                        out.append(f"</{tag}>")
+                    remaining -= size
+            while remaining and can_open:
+                # An odd run opens emphasis outside strong: ***a** b*
+                size = 1 if remaining % 2 and c != "~" else min(remaining, 2)
+                if (c, size) not in MARKDOWN_EMPHASIS:
+                    break
+                stack.append((c, size, len(out)))
+                out.append(c * size)
+                remaining -= size
+            if remaining:
+                out.append(c * remaining)
+            i = end
+        elif c == "!" and i < length and text[i] == "[":
+            brackets.append(len(stack))
+            stack.append(("![", start, len(out)))
+            out.append("![")
+            i += 1
+        elif c == "[":
+            brackets.append(len(stack))
+            stack.append(("[", start, len(out)))
+            out.append("[")
+        elif c == "]":
+            close = -1
+            if brackets and i < length and text[i] == "(":
+                if paren < i and paren != length:
+                    paren = text.find(")", i)
+                    if paren < 0:
+                        paren = length
+                close = paren if paren < length else -1
+            destination = None
+            if close > i:
+                found = MARKDOWN_DESTINATION_RE.fullmatch(text, i + 1, close)
+                if found:
+                    destination = found.group(1) if found.group(1) is not None else found.group(2)
+            if destination is None:
+                out.append("]")
+                continue
+            opener = brackets.pop()
+            kind, source_start, index = stack[opener]
+            del stack[opener:]
+            href = escape(destination)
+            if kind == "![":
+                alt = escape(text[source_start + 2:start])
+                del out[index:]
+                out.append(f'<img src="{href}" alt="{alt}">')
+            else:
+                out[index] = f'<a href="{href}">'
+                out.append("</a>")
+            i = close + 1
+        elif c == "<":
+            if text.startswith("<!--", start):
+                close = -1 if no_comment_closer else text.find("-->", start + 4)
+                if close < 0:
+                    no_comment_closer = True
+                    out.append("&lt;")
+                else:
+                    out.append(text[start:close + 3])
+                    i = close + 3
+                continue
+            autolink = MARKDOWN_AUTOLINK_RE.match(text, start)
+            tag = None if autolink else MARKDOWN_TAG_RE.match(text, start)
+            if autolink:
+                out.append(f'<a href="{escape(autolink.group(1))}">{escape(autolink.group(1), quote=False)}</a>')
+                i = autolink.end()
+            elif tag:
+                out.append(tag.group())
+                i = tag.end()
+            else:
+                out.append("&lt;")
+        elif c == "&":
+            entity = MARKDOWN_ENTITY_RE.match(text, start)
+            if entity:
+                out.append(entity.group())
+                i = entity.end()
+            else:
+                out.append("&amp;")
+        else:
+            out.append(escape(c, quote=False))
+    return "".join(out)
+
+class MarkdownBlocks:
+    """Block structure of one Markdown container: the document, a block
+    quote or a list item. Lines are fed one at a time and each block's HTML
+    is written as soon as it ends."""
+
+    def __init__(self, write, item=False, depth=0):
+        self.write = write
+        # Containers recurse, so their nesting is capped
+        self.depth = depth
+        # The first paragraph of a list item is written without <p>, as the
+        # editor's own lists have it
+        self.item = item
+        self.blocks = 0
+        self.paragraph = []
+        self.fence = None
+        self.fence_lines = 0
+        self.code_blanks = None
+        self.html = False
+        self.child = None
+        self.container = None
+
+    def lazy(self):
+        # Whether a paragraph is open, which unprefixed lines may continue
+        return bool(self.paragraph) or (self.child is not None and self.child.lazy())
+
+    def starts_block(self, line):
+        return bool(MARKDOWN_FENCE_RE.match(line) or MARKDOWN_HEADING_RE.match(line)
+                    or MARKDOWN_RULE_RE.match(line) or MARKDOWN_QUOTE_RE.match(line)
+                    or MARKDOWN_LIST_RE.match(line) or MARKDOWN_HTML_BLOCK_RE.match(line))
+
+    def line(self, line):
+        if self.fence:
+            closing = MARKDOWN_FENCE_RE.match(line)
+            if closing and closing.group(1)[0] == self.fence[0] and len(closing.group(1)) >= len(self.fence) \
+                    and not closing.group(2).strip(" \t"):
+                self.write("</pre>")
+                self.fence = None
+                self.blocks += 1
+            else:
+                self.write(("\n" if self.fence_lines else "") + escape(line, quote=False))
+                self.fence_lines += 1
+            return
+        if self.html:
+            if line.strip(" \t"):
+                self.write(line + "\n")
+                return
+            self.html = False
+        if self.child is not None and self.continue_container(line):
+            return
+        if not line.strip(" \t"):
+            self.end_paragraph()
+            if self.code_blanks is not None:
+                self.code_blanks += 1
+            return
+        if self.code_blanks is not None:
+            if line.startswith("    "):
+                self.write("\n" * (self.code_blanks + 1) + escape(line[4:], quote=False))
+                self.code_blanks = 0
+                return
+            self.end_code()
+        if self.paragraph:
+            setext = MARKDOWN_SETEXT_RE.match(line)
+            if setext:
+                level = 1 if setext.group(1)[0] == "=" else 2
+                content = markdown_inline("\n".join(self.paragraph).strip(" \t"))
+                self.paragraph = []
+                self.write(f"<h{level}>{content}</h{level}>")
+                self.blocks += 1
+                return
+        match = MARKDOWN_FENCE_RE.match(line)
+        if match and not (match.group(1)[0] == "`" and "`" in match.group(2)):
+            self.end_paragraph()
+            self.fence = match.group(1)
+            self.fence_lines = 0
+            info = match.group(2).split()
+            self.write(f'<pre class="language-{escape(info[0])}">' if info else "<pre>")
+            return
+        match = MARKDOWN_HEADING_RE.match(line)
+        if match:
+            self.end_paragraph()
+            level = len(match.group(1))
+            self.write(f"<h{level}>{markdown_inline(match.group(2) or '')}</h{level}>")
+            self.blocks += 1
+            return
+        if MARKDOWN_RULE_RE.match(line):
+            self.end_paragraph()
+            self.write("<hr>")
+            self.blocks += 1
+            return
+        if MARKDOWN_HTML_BLOCK_RE.match(line):
+            self.end_paragraph()
+            self.html = True
+            self.write(line + "\n")
+            self.blocks += 1
+            return
+        nest = self.depth < MARKDOWN_MAX_NESTING
+        match = nest and MARKDOWN_QUOTE_RE.match(line)
+        if match:
+            self.end_paragraph()
+            self.write("<blockquote>")
+            self.container = ("quote",)
+            self.child = MarkdownBlocks(self.write, depth=self.depth + 1)
+            self.child.line(match.group(1))
+            return
+        match = nest and MARKDOWN_LIST_RE.match(line)
+        if match:
+            self.end_paragraph()
+            self.open_list(match)
+            return
+        if not self.paragraph and line.startswith("    "):
+            self.write("<pre>" + escape(line[4:], quote=False))
+            self.code_blanks = 0
+            return
+        self.paragraph.append(line.lstrip(" \t"))
+
+    def open_list(self, match):
+        number = match.group(3)
+        if number is None:
+            self.write("<ul>")
+        else:
+            self.write("<ol>" if int(number) == 1 else f'<ol start="{int(number)}">')
+        self.open_item(match)
+
+    def open_item(self, match):
+        spaces = len(match.group(4))
+        if not match.group(5) or spaces > 4:
+            spaces = 1
+        self.container = ("list", match.group(2)[-1], len(match.group(1)) + len(match.group(2)) + spaces)
+        self.write("<li>")
+        self.child = MarkdownBlocks(self.write, item=True, depth=self.depth + 1)
+        if match.group(5):
+            self.child.line(match.group(5))
+
+    def continue_container(self, line):
+        if self.container[0] == "quote":
+            match = MARKDOWN_QUOTE_RE.match(line)
+            if match:
+                self.child.line(match.group(1))
+                return True
+        else:
+            _, delimiter, indent = self.container
+            if not line.strip(" \t"):
+                self.child.line("")
+                return True
+            if len(line) - len(line.lstrip(" ")) >= indent:
+                self.child.line(line[indent:])
+                return True
+            match = MARKDOWN_LIST_RE.match(line)
+            if match and match.group(2)[-1] == delimiter and not MARKDOWN_RULE_RE.match(line):
+                self.child.close()
+                self.write("</li>")
+                self.open_item(match)
+                return True
+        if line.strip(" \t") and self.child.lazy() and not self.starts_block(line):
+            self.child.line(line)
+            return True
+        self.close_container()
+        return False
+
+    def close_container(self):
+        self.child.close()
+        if self.container[0] == "quote":
+            self.write("</blockquote>")
+        else:
+            self.write("</li></ol>" if self.container[1] in ".)" else "</li></ul>")
+        self.child = None
+        self.container = None
+        self.blocks += 1
+
+    def end_paragraph(self):
+        if not self.paragraph:
+            return
+        content = markdown_inline("\n".join(self.paragraph).rstrip(" \t"))
+        self.paragraph = []
+        self.write(content if self.item and not self.blocks else f"<p>{content}</p>")
+        self.blocks += 1
+
+    def end_code(self):
+        self.write("</pre>")
+        self.code_blanks = None
+        self.blocks += 1
+
+    def close(self):
+        self.end_paragraph()
+        if self.fence:
+            self.write("</pre>")
+            self.fence = None
+        if self.code_blanks is not None:
+            self.end_code()
+        if self.child is not None:
+            self.close_container()
+
+def markdown_to_html(chunks, title=""):
+    """Yields an editor page for the Markdown text arriving in chunks."""
+    yield ("<!DOCTYPE html>\n<html>\n<head>\n<meta charset=\"utf-8\">\n"
+           f"<title>{escape(title)}</title>\n<style>{DOCUMENT_CSS}</style>\n</head>\n<body>")
+    out = []
+    blocks = MarkdownBlocks(out.append)
+    written = False
+    tail = ""
+    for chunk in chunks:
+        if not written and not tail and chunk.startswith("\ufeff"):
+            chunk = chunk[1:]
+        lines = (tail + chunk).split("\n")
+        tail = lines.pop()
+        for line in lines:
+            blocks.line(line.rstrip("\r").expandtabs(4) if "\t" in line else line.rstrip("\r"))
+        if out:
+            written = True
+            yield "".join(out)
+            out.clear()
+    if tail:
+        blocks.line(tail.rstrip("\r"))
+    blocks.close()
+    if out or written:
+        yield "".join(out)
+    else:
+        yield "<p><br></p>"
+    yield "</body>\n</html>\n"
+
+def markdown_escape(text, line_start=False, heading=False):
+    if MARKDOWN_ESCAPE_NEEDED_RE.search(text):
+        text = MARKDOWN_ESCAPE_RE.sub(r"\\\g<0>", text)
+        text = MARKDOWN_ENTITY_LIKE_RE.sub(r"\\&", text).replace("\xa0", "&nbsp;")
+    if heading:
+        text = text.replace("#", "\\#")
+    elif line_start:
+        text = MARKDOWN_LINE_START_RE.sub(r"\1\\\2", text)
+    return text
+
+def markdown_destination(url):
+    if re.search(r"[\s()<>]", url):
+        return "<" + url.replace("<", "%3C").replace(">", "%3E").replace("\n", "%0A") + ">"
+    return url
+
+class MarkdownWriter:
+    """DocumentWalker sink writing Markdown.
+
+    Formatting Markdown has no syntax for, such as underline, fonts, colours,
+    alignment and blank paragraphs, is written as inline or block HTML, which
+    Markdown passes through, so markdown_to_html gives the document back."""
 
-class Wiziwig(Adw.Application):
     def __init__(self):
-        super().__init__(application_id="io.github.fastrizwaan.wiziwig")
-        self.connect("activate", self.on_activate)
+        self.parts = []
+        self.lists = []
+        # Whether the list that ended last was ordered
+        self.ended_ordered = None
+        self.started = False
+        self.last_event = None
+        self.mode = None
+        # Markers around the text written so far, outermost first
+        self.open = []
+        # Whitespace held back so markers close before it and open after it
+        self.space = ""
+        self.opener = None
+        self.closer = ""
+        self.prefix = ""
+        self.empty = ""
+        self.style = {}
+        self.line_start = False
+        # Text of the code span being written, which is fenced once it ends
+        self.code = None
 
-    def on_activate(self, app):
-        win = EditorWindow(application=self)
-        win.present()
+    def take(self):
+        text = "".join(self.parts)
+        self.parts = []
+        return text
+
+    def markers(self, style):
+        html = self.mode == "html"
+        markers = []
+        if "href" in style:
+            href = style["href"]
+            markers.append((("href", href), f'<a href="{escape(href)}">' if html else "[",
+                            "</a>" if html else f"]({markdown_destination(href)})"))
+        for key, tag, marker in (("bold", "b", "**"), ("italic", "i", "*"), ("strike", "strike", "~~")):
+            if style.get(key):
+                markers.append(((key,), f"<{tag}>" if html else marker, f"</{tag}>" if html else marker))
+        if style.get("underline"):
+            markers.append((("underline",), "<u>", "</u>"))
+        if style.get("vertical"):
+            tag = "sup" if style["vertical"] == "super" else "sub"
+            markers.append((("vertical", tag), f"<{tag}>", f"</{tag}>"))
+        declarations = []
+        if style.get("font") and not (style.get("code") and style["font"] == "monospace"):
+            declarations.append(f"font-family: {style['font']}")
+        if style.get("size"):
+            declarations.append(f"font-size: {style['size']:g}pt")
+        if style.get("color"):
+            declarations.append(f"color: #{style['color']}")
+        if style.get("background"):
+            declarations.append(f"background-color: #{style['background']}")
+        if declarations:
+            css = "; ".join(declarations)
+            markers.append((("span", css), f'<span style="{escape(css)}">', "</span>"))
+        if html and style.get("code"):
+            markers.append((("code",), "<code>", "</code>"))
+        return markers
+
+    def begin(self):
+        if self.opener is not None:
+            self.parts.append(self.opener)
+            self.opener = None
+
+    def end_code(self):
+        if self.code is None:
+            return
+        text = "".join(self.code)
+        self.code = None
+        # The fence is longer than any backtick run inside, and a space
+        # keeps a backtick at either end from joining it
+        fence = "`" * (max(map(len, re.findall("`+", text)), default=0) + 1)
+        if text[:1] == "`" or text[-1:] == "`" or (text[:1] == text[-1:] == " " and text.strip(" ")):
+            text = f" {text} "
+        self.parts.append(fence + text + fence)
+
+    def restyle(self, style, lead):
+        self.end_code()
+        if style is self.style:
+            # Another run of the same element
+            self.parts.append(self.space + lead)
+            self.space = ""
+            return
+        self.style = style
+        markers = self.markers(style)
+        common = 0
+        while (common < len(self.open) and common < len(markers)
+               and self.open[common][0] == markers[common][0]):
+            common += 1
+        for marker in reversed(self.open[common:]):
+            self.parts.append(marker[2])
+        self.parts.append(self.space + lead)
+        self.space = ""
+        for marker in markers[common:]:
+            self.parts.append(marker[1])
+        self.open = self.open[:common] + markers[common:]
+
+    def list_start(self, ordered):
+        if self.last_event == "list_end" and not self.lists and self.ended_ordered == ordered:
+            # Keeps two lists of the same kind in a row from merging into one
+            self.separate()
+            self.parts.append("<!-- -->")
+        self.lists.append({"ordered": ordered, "n": 0, "width": 0, "fresh": False})
+        self.last_event = "list_start"
+
+    def item_start(self):
+        if self.lists:
+            self.lists[-1]["n"] += 1
+            self.lists[-1]["fresh"] = True
+        self.last_event = "item_start"
+
+    def item_end(self):
+        self.last_event = "item_end"
+
+    def list_end(self):
+        if self.lists:
+            self.ended_ordered = self.lists.pop()["ordered"]
+        self.last_event = "list_end"
+
+    def separate(self):
+        if not self.started:
+            self.started = True
+            return
+        # Items follow each other directly, the first one after a blank line
+        # unless it starts a nested list
+        entry = self.lists[-1] if self.lists else None
+        tight = entry and entry["fresh"] and (entry["n"] > 1 or len(self.lists) > 1)
+        self.parts.append("\n" if tight else "\n\n")
+
+    def paragraph_start(self, block):
+        self.separate()
+        quote = "> " * block["indent"]
+        first = self.prefix = quote
+        if self.lists:
+            indent = sum(entry["width"] for entry in self.lists[:-1])
+            entry = self.lists[-1]
+            if entry["fresh"]:
+                marker = f"{entry['n']}. " if entry["ordered"] else "- "
+                entry["width"] = len(marker)
+                entry["fresh"] = False
+                first = quote + " " * indent + marker
+            else:
+                first = quote + " " * (indent + entry["width"])
+            self.prefix = quote + " " * (indent + entry["width"])
+        align = block["align"] if block["align"] not in (None, "left", "start") else None
+        heading = block["heading"]
+        tag = f"h{heading}" if heading else "p"
+        if block["pre"]:
+            self.mode = "pre"
+            self.opener = f"{first}```{block['language'] or ''}\n{self.prefix}"
+            self.closer = f"\n{self.prefix}```"
+            self.empty = f"{first}<pre><br></pre>"
+        elif align:
+            self.mode = "html"
+            self.opener = f'{first}<{tag} style="text-align: {escape(align)};">'
+            self.closer = f"</{tag}>"
+            self.empty = f"{self.opener}<br>{self.closer}"
+        else:
+            self.mode = "heading" if heading else "markdown"
+            self.opener = first + ("#" * heading + " " if heading else "")
+            self.closer = ""
+            self.empty = f"{first}<{tag}><br></{tag}>"
+        self.line_start = True
+        self.last_event = "paragraph"
+
+    def text(self, text, style):
+        self.begin()
+        if self.mode == "pre":
+            self.parts.append(text)
+            return
+        if style.get("code") and self.mode != "html":
+            # Code spans keep their text as it is, spaces included
+            if self.code is None or style is not self.style:
+                self.restyle(style, "")
+                self.code = []
+            self.code.append(text)
+            self.line_start = False
+            return
+        core = text.strip(" ")
+        if not core:
+            self.space += text
+            return
+        lead = text[:len(text) - len(text.lstrip(" "))]
+        trail = text[len(text.rstrip(" ")):]
+        self.restyle(style, lead)
+        if self.mode == "html":
+            self.parts.append(escape(core, quote=False))
+        else:
+            self.parts.append(markdown_escape(core, self.line_start and not lead, self.mode == "heading"))
+        self.space = trail
+        self.line_start = False
+
+    def image(self, attrs, style):
+        self.begin()
+        self.restyle(style, "")
+        markup = "".join(f' {name}="{escape(value)}"' for name, value in attrs.items()
+                         if value is not None and name in ("src", "alt", "width", "height", "style",
+                                                           "loading", "decoding", "title"))
+        self.parts.append(f"<img{markup}>")
+        self.line_start = False
+
+    def rule(self):
+        self.separate()
+        self.parts.append("---")
+        self.last_event = "rule"
+
+    def line_break(self):
+        self.begin()
+        self.end_code()
+        self.space = ""
+        if self.mode == "pre":
+            self.parts.append("\n" + self.prefix)
+        elif self.mode == "markdown":
+            self.parts.append("\\\n" + self.prefix)
+            self.line_start = True
+        else:
+            self.parts.append("<br>")
+
+    def paragraph_end(self):
+        if self.opener is not None:
+            # No content: Markdown has no blank paragraphs
+            self.parts.append(self.empty)
+            self.opener = None
+        else:
+            self.space = ""
+            self.restyle({}, "")
+            self.parts.append(self.closer)
+        self.mode = None
+        self.last_event = "paragraph"
+
+    def finish(self):
+        if self.started:
+            self.parts.append("\n")
+
+def html_to_markdown(chunks):
+    """Yields the Markdown for the editor HTML arriving in chunks."""
+    writer = MarkdownWriter()
+    walker = DocumentWalker(writer)
+    for chunk in chunks:
+        walker.feed(chunk)
+        yield writer.take()
+    walker.close()
+    writer.finish()
+    yield writer.take()
+
+# Library mode: a folder of documents indexed into SQLite FTS5
+LIBRARY_EXTENSIONS = (".html", ".htm")
+LIBRARY_RESULTS = 50
+LIBRARY_READ_CHARS = 64 * 1024
+# Scans commit and report progress every this many indexed documents
+LIBRARY_BATCH = 200
+
+class TextExtractor(HTMLParser):
+    """Collects the title and visible text of a document fed in pieces."""
+
+    BREAK_TAGS = PASTE_BLOCK_TAGS | {"br", "td", "th", "tr"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.title = []
+        self.heading = None
+        self.in_title = False
+        self.in_heading = False
+        self.skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ("script", "style", "template", "noscript"):
+            self.skipping += 1
+        elif tag == "title":
+            self.in_title = True
+        elif tag == "h1" and self.heading is None:
+            self.in_heading = True
+            self.heading = []
+        if tag in self.BREAK_TAGS:
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in ("script", "style", "template", "noscript"):
+            self.skipping = max(0, self.skipping - 1)
+        elif tag == "title":
+            self.in_title = False
+        elif tag == "h1":
+            self.in_heading = False
+        if tag in self.BREAK_TAGS:
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        if self.skipping:
+            return
+        if self.in_title:
+            self.title.append(data)
+            return
+        if self.in_heading:
+            self.heading.append(data)
+        self.parts.append(data)
+
+    def result(self, fallback):
+        self.close()
+        title = " ".join("".join(self.title or self.heading or []).split()) or fallback
+        body = re.sub(r"[ \t\r\f\v]+", " ", "".join(self.parts))
+        return title, re.sub(r"\s*\n\s*", "\n", body).strip()
+
+def extract_text(path):
+    extractor = TextExtractor()
+    with open(path, encoding="utf-8", errors="replace") as f:
+        for piece in iter(lambda: f.read(LIBRARY_READ_CHARS), ""):
+            extractor.feed(piece)
+    return extractor.result(os.path.basename(path))
+
+def library_query(text):
+    # User input becomes a prefix match on every word, so typing never
+    # produces an FTS5 syntax error.
+    words = re.findall(r"\w+", text)
+    return " ".join(f'"{word}"*' for word in words)
+
+class Library:
+    """Full-text index of one folder of documents.
+
+    A writer thread owns the connection that scans, indexes and prunes.
+    Searches run on the main thread over a second connection, which WAL
+    mode lets read while the writer works. Directory monitors send changed
+    paths to the writer, so the index stays fresh after the first scan."""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.folder = None
+        self.monitors = {}
+        self.indexed = 0
+        self.scanning = False
+        # Called on the main thread whenever indexing progresses
+        self.on_progress = None
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.reader = self.connect()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.writer_thread, daemon=True)
+        self.thread.start()
+
+    def connect(self):
+        db = sqlite3.connect(self.db_path)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("CREATE TABLE IF NOT EXISTS documents (id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL,"
+                   " mtime REAL NOT NULL, size INTEGER NOT NULL, title TEXT NOT NULL)")
+        db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS content USING fts5(title, body,"
+                   " tokenize='unicode61 remove_diacritics 2')")
+        db.commit()
+        return db
+
+    def open_folder(self, folder):
+        for monitor in self.monitors.values():
+            monitor.cancel()
+        self.monitors = {}
+        self.folder = folder
+        self.queue.put(("scan", folder, True))
+
+    def search(self, text, limit=LIBRARY_RESULTS):
+        # [(path, title, snippet)] best first; the snippet marks hits with
+        # \x02 and \x03.
+        query = library_query(text)
+        if not query:
+            return []
+        try:
+            return self.reader.execute(
+                "SELECT d.path, d.title, snippet(content, 1, char(2), char(3), '…', 12) FROM content"
+                " JOIN documents d ON d.id = content.rowid WHERE content MATCH ?"
+                " ORDER BY bm25(content, 5.0, 1.0) LIMIT ?", (query, limit)).fetchall()
+        except sqlite3.Error as e:
+            print("Library error:", e)
+            return []
+
+    def count(self):
+        return self.reader.execute("SELECT count(*) FROM documents").fetchone()[0]
+
+    def report(self, indexed, scanning):
+        self.indexed = indexed
+        self.scanning = scanning
+        if self.on_progress:
+            self.on_progress()
+        return False
+
+    def watch(self, path):
+        if path in self.monitors or not self.folder or not (path + "/").startswith(self.folder + "/"):
+            return False
+        try:
+            monitor = Gio.File.new_for_path(path).monitor_directory(Gio.FileMonitorFlags.WATCH_MOVES, None)
+        except GLib.Error as e:
+            print("Library error:", e.message)
+            return False
+        monitor.connect("changed", self.on_changed)
+        self.monitors[path] = monitor
+        return False
+
+    def on_changed(self, monitor, file, other, event):
+        path = file.get_path()
+        if event in (Gio.FileMonitorEvent.CHANGES_DONE_HINT, Gio.FileMonitorEvent.CREATED,
+                     Gio.FileMonitorEvent.MOVED_IN):
+            if os.path.isdir(path):
+                self.queue.put(("scan", path, False))
+            else:
+                self.queue.put(("update", path, None))
+        elif event in (Gio.FileMonitorEvent.DELETED, Gio.FileMonitorEvent.MOVED_OUT):
+            self.forget(path)
+        elif event == Gio.FileMonitorEvent.RENAMED:
+            self.forget(path)
+            target = other.get_path()
+            self.queue.put(("scan" if os.path.isdir(target) else "update", target, False))
+
+    def forget(self, path):
+        for watched in [p for p in self.monitors if p == path or p.startswith(path + "/")]:
+            self.monitors.pop(watched).cancel()
+        self.queue.put(("remove", path, None))
+
+    def writer_thread(self):
+        db = self.connect()
+        while True:
+            op, path, prune = self.queue.get()
+            try:
+                if op == "scan":
+                    self.scan(db, path, prune)
+                elif op == "update":
+                    self.update(db, path)
+                    db.commit()
+                elif op == "remove":
+                    for (doc_id,) in db.execute("SELECT id FROM documents WHERE path = ? OR path LIKE ?",
+                                                (path, path + "/%")).fetchall():
+                        self.delete(db, doc_id)
+                    db.commit()
+            except (OSError, sqlite3.Error) as e:
+                print("Library error:", e)
+                db.rollback()
+
+    def scan(self, db, root, prune):
+        # Reindexes what changed since the last scan. prune drops documents
+        # no longer found, which only a scan of the whole folder can tell.
+        known = {path: (mtime, size) for path, mtime, size in
+                 db.execute("SELECT path, mtime, size FROM documents")}
+        seen = set()
+        indexed = 0
+        GLib.idle_add(self.report, self.indexed, True)
+        for directory, dirs, files in os.walk(root):
+            if self.folder is None or not (directory + "/").startswith(self.folder + "/"):
+                # Another folder was chosen meanwhile
+                return
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            GLib.idle_add(self.watch, directory)
+            for name in files:
+                if not name.lower().endswith(LIBRARY_EXTENSIONS):
+                    continue
+                path = os.path.join(directory, name)
+                seen.add(path)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if known.get(path) != (stat.st_mtime, stat.st_size):
+                    self.update(db, path, stat)
+                    indexed += 1
+                    if indexed % LIBRARY_BATCH == 0:
+                        db.commit()
+                        GLib.idle_add(self.report, indexed, True)
+        if prune:
+            for path in known.keys() - seen:
+                for (doc_id,) in db.execute("SELECT id FROM documents WHERE path = ?", (path,)).fetchall():
+                    self.delete(db, doc_id)
+        db.commit()
+        GLib.idle_add(self.report, indexed, False)
+
+    def update(self, db, path, stat=None):
+        if not path.lower().endswith(LIBRARY_EXTENSIONS):
+            return
+        try:
+            stat = stat or os.stat(path)
+            title, body = extract_text(path)
+        except OSError:
+            for (doc_id,) in db.execute("SELECT id FROM documents WHERE path = ?", (path,)).fetchall():
+                self.delete(db, doc_id)
+            return
+        except Exception as e:
+            # html.parser raises on some malformed markup (AssertionError for
+            # "<![foo bar]>"). The file is indexed by name only, so it is not
+            # parsed again until it changes and the writer keeps running.
+            print(f"Library error: {path}: {e!r}")
+            title, body = os.path.basename(path), ""
+        row = db.execute("SELECT id FROM documents WHERE path = ?", (path,)).fetchone()
+        if row:
+            doc_id = row[0]
+            db.execute("UPDATE documents SET mtime = ?, size = ?, title = ? WHERE id = ?",
+                       (stat.st_mtime, stat.st_size, title, doc_id))
+            db.execute("DELETE FROM content WHERE rowid = ?", (doc_id,))
+        else:
+            doc_id = db.execute("INSERT INTO documents (path, mtime, size, title) VALUES (?, ?, ?, ?)",
+                                (path, stat.st_mtime, stat.st_size, title)).lastrowid
+        db.execute("INSERT INTO content (rowid, title, body) VALUES (?, ?, ?)", (doc_id, title, body))
+
+    def delete(self, db, doc_id):
+        db.execute("DELETE FROM content WHERE rowid = ?", (doc_id,))
+        db.execute("DELETE FROM documents WHERE id = ?", (doc_id,))
+
+RECENT_FONTS_LIMIT = 8
+
+class FontPicker(Gtk.MenuButton):
+    """Font family button with a searchable list.
+
+    Only the rows on screen are bound, so each family is previewed in its own
+    face without laying out thousands of labels up front.
+    """
+
+    def __init__(self, on_chosen):
+        super().__init__(label="Sans", always_show_arrow=True)
+        self.add_css_class("flat")
+        self.on_chosen = on_chosen
+        self.names = {}
+        self.families = Gtk.StringList()
+        self.recent = Gtk.StringList()
+        self.recent_path = os.path.join(GLib.get_user_data_dir(), "wiziwig", "recent-fonts.json")
+        try:
+            with open(self.recent_path) as f:
+                self.recent.splice(0, 0, json.load(f)[:RECENT_FONTS_LIMIT])
+        except (OSError, ValueError, TypeError):
+            pass
+
+        self.filter = Gtk.StringFilter(
+            expression=Gtk.PropertyExpression.new(Gtk.StringObject, None, "string"),
+            ignore_case=True,
+            match_mode=Gtk.StringFilterMatchMode.SUBSTRING)
+        self.filtered = Gtk.FilterListModel(model=self.families, filter=self.filter, incremental=True)
+
+        self.search_entry = Gtk.SearchEntry(placeholder_text="Search fonts")
+        self.search_entry.connect("search-changed", self.on_search_changed)
+        self.search_entry.connect("activate", self.on_search_activate)
+
+        box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=6)
+        box.append(self.search_entry)
+        self.recent_label = Gtk.Label(label="Recently Used", xalign=0)
+        self.recent_label.add_css_class("dim-label")
+        self.recent_label.add_css_class("caption-heading")
+        box.append(self.recent_label)
+        self.recent_view = self.create_list_view(self.recent)
+        box.append(self.recent_view)
+        self.recent_separator = Gtk.Separator()
+        box.append(self.recent_separator)
+        scrolled = Gtk.ScrolledWindow(hscrollbar_policy=Gtk.PolicyType.NEVER,
+                                      min_content_height=320, min_content_width=260)
+        scrolled.set_child(self.create_list_view(self.filtered))
+        box.append(scrolled)
+        self.update_recent_visibility()
+
+        popover = Gtk.Popover(child=box)
+        popover.connect("show", self.on_popover_show)
+        self.set_popover(popover)
+
+    def create_list_view(self, model):
+        factory = Gtk.SignalListItemFactory()
+        factory.connect("setup", self.on_row_setup)
+        factory.connect("bind", self.on_row_bind)
+        view = Gtk.ListView(model=Gtk.NoSelection(model=model), factory=factory, single_click_activate=True)
+        view.connect("activate", self.on_row_activate)
+        return view
+
+    def on_row_setup(self, factory, list_item):
+        list_item.set_child(Gtk.Label(xalign=0, ellipsize=Pango.EllipsizeMode.END))
+
+    def on_row_bind(self, factory, list_item):
+        name = list_item.get_item().get_string()
+        label = list_item.get_child()
+        label.set_text(name)
+        attributes = Pango.AttrList()
+        attributes.insert(Pango.attr_family_new(name))
+        label.set_attributes(attributes)
+
+    def on_row_activate(self, view, position):
+        self.choose(view.get_model().get_item(position).get_string())
+
+    def on_search_changed(self, entry):
+        text = entry.get_text()
+        self.filter.set_search(text)
+        # Recents stay on top only while browsing the full list
+        self.update_recent_visibility()
+
+    def on_search_activate(self, entry):
+        if self.filtered.get_n_items() > 0:
+            self.choose(self.filtered.get_item(0).get_string())
+
+    def on_popover_show(self, popover):
+        self.search_entry.set_text("")
+        self.search_entry.grab_focus()
+
+    def update_recent_visibility(self):
+        visible = self.recent.get_n_items() > 0 and not self.search_entry.get_text()
+        for widget in (self.recent_label, self.recent_view, self.recent_separator):
+            widget.set_visible(visible)
+
+    def set_families(self, names):
+        self.names = {name.lower(): name for name in names}
+        self.families.splice(0, self.families.get_n_items(), names)
+
+    def set_current(self, family):
+        generic = {"sans-serif": "sans", "serif": "serif", "monospace": "monospace"}
+        key = family.lower()
+        self.set_label(self.names.get(generic.get(key, key), family))
+
+    def choose(self, name):
+        self.get_popover().popdown()
+        self.set_label(name)
+        self.remember(name)
+        self.on_chosen(name)
+
+    def remember(self, name):
+        names = [name] + [self.recent.get_string(i) for i in range(self.recent.get_n_items())
+                          if self.recent.get_string(i) != name]
+        names = names[:RECENT_FONTS_LIMIT]
+        self.recent.splice(0, self.recent.get_n_items(), names)
+        self.update_recent_visibility()
+        try:
+            os.makedirs(os.path.dirname(self.recent_path), exist_ok=True)
+            with open(self.recent_path, "w") as f:
+                json.dump(names, f)
+        except OSError as e:
+            print("Recent fonts error:", e)
+
+class LibraryPalette(Adw.Window):
+    """Quick open by content over the library index.
+
+    Every keystroke runs a ranked FTS5 query; activating a result calls
+    on_open(path, term) with the word that matched."""
+
+    def __init__(self, library, on_open, on_choose_folder, **kwargs):
+        super().__init__(modal=True, default_width=640, default_height=480, title="Library", **kwargs)
+        self.library = library
+        self.on_open = on_open
+
+        header = Adw.HeaderBar()
+        folder_btn = Gtk.Button(icon_name="folder-open-symbolic", tooltip_text="Choose Library Folder")
+        folder_btn.connect("clicked", lambda btn: on_choose_folder(self))
+        header.pack_start(folder_btn)
+
+        self.entry = Gtk.SearchEntry(placeholder_text="Search documents", hexpand=True)
+        self.entry.connect("search-changed", self.on_search_changed)
+        self.entry.connect("activate", self.on_entry_activate)
+        self.entry.connect("stop-search", lambda entry: self.close())
+        key_controller = Gtk.EventControllerKey()
+        key_controller.connect("key-pressed", self.on_entry_key_pressed)
+        self.entry.add_controller(key_controller)
+
+        self.results = Gtk.ListBox()
+        self.results.add_css_class("navigation-sidebar")
+        self.results.connect("row-activated", self.on_row_activated)
+        scrolled = Gtk.ScrolledWindow(vexpand=True, hscrollbar_policy=Gtk.PolicyType.NEVER)
+        scrolled.set_child(self.results)
+        self.status = Gtk.Label(xalign=0)
+        self.status.add_css_class("dim-label")
+        self.status.add_css_class("caption")
+
+        box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=6, margin_start=12, margin_end=12,
+                      margin_bottom=12)
+        box.append(self.entry)
+        box.append(scrolled)
+        box.append(self.status)
+        toolbar_view = Adw.ToolbarView()
+        toolbar_view.add_top_bar(header)
+        toolbar_view.set_content(box)
+        self.set_content(toolbar_view)
+
+        library.on_progress = self.update_status
+        self.connect("close-request", self.on_close_request)
+        self.update_status()
+
+    def on_close_request(self, window):
+        if self.library.on_progress == self.update_status:
+            self.library.on_progress = None
+        return False
+
+    def update_status(self, found=None, elapsed=None):
+        if self.library.folder is None:
+            text = "Choose a folder to index"
+        elif found is not None:
+            text = f"{found} matches in {elapsed:.1f} ms"
+        elif self.library.scanning:
+            text = f"Indexing {self.library.folder}… {self.library.indexed} updated"
+        else:
+            text = f"{self.library.count()} documents in {self.library.folder}"
+        self.status.set_text(text)
+
+    def on_search_changed(self, entry):
+        started = time.monotonic()
+        hits = self.library.search(entry.get_text())
+        elapsed = (time.monotonic() - started) * 1000
+        self.results.remove_all()
+        for path, title, snippet in hits:
+            self.results.append(self.create_row(path, title, snippet))
+        if hits:
+            self.results.select_row(self.results.get_row_at_index(0))
+            self.update_status(len(hits), elapsed)
+        else:
+            self.update_status()
+
+    def create_row(self, path, title, snippet):
+        # The snippet marks hits with \x02 and \x03, which alternate
+        pieces = re.split("[\\x02\\x03]", " ".join(snippet.split()))
+        markup = "".join(f"<b>{GLib.markup_escape_text(piece)}</b>" if i % 2 else GLib.markup_escape_text(piece)
+                         for i, piece in enumerate(pieces))
+        row = Gtk.ListBoxRow()
+        row.path = path
+        row.term = pieces[1] if len(pieces) > 1 else self.entry.get_text()
+        box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=2)
+        title_label = Gtk.Label(label=title, xalign=0, ellipsize=Pango.EllipsizeMode.END)
+        title_label.add_css_class("heading")
+        box.append(title_label)
+        box.append(Gtk.Label(label=markup, use_markup=True, xalign=0, ellipsize=Pango.EllipsizeMode.END))
+        path_label = Gtk.Label(label=path, xalign=0, ellipsize=Pango.EllipsizeMode.START)
+        path_label.add_css_class("dim-label")
+        path_label.add_css_class("caption")
+        box.append(path_label)
+        row.set_child(box)
+        return row
+
+    def on_entry_key_pressed(self, controller, keyval, keycode, state):
+        if keyval not in (Gdk.KEY_Down, Gdk.KEY_Up):
+            return False
+        row = self.results.get_selected_row()
+        index = (row.get_index() if row else -1) + (1 if keyval == Gdk.KEY_Down else -1)
+        target = self.results.get_row_at_index(max(0, index))
+        if target:
+            self.results.select_row(target)
+        return True
+
+    def on_entry_activate(self, entry):
+        row = self.results.get_selected_row()
+        if row:
+            self.on_row_activated(self.results, row)
+
+    def on_row_activated(self, listbox, row):
+        self.close()
+        self.on_open(row.path, row.term)
 
 class EditorWindow(Adw.ApplicationWindow):
-    def __init__(self, **kwargs):
+    def __init__(self, files=None, **kwargs):
         super().__init__(**kwargs)
         self.set_title("Wiziwig")
         self.set_default_size(1000, 700)
@@ -99,12 +5667,7 @@ class EditorWindow(Adw.ApplicationWindow):
         self.initial_html = """<!DOCTYPE html>
 <html>
 <head>
-    <style>
-        body { font-family: sans-serif; font-size: 11pt; margin: 20px; line-height: 1.5; }
-        @media (prefers-color-scheme: dark) { body { background-color: #121212; color: #e0e0e0; } }
-        @media (prefers-color-scheme: light) { body { background-color: #ffffff; color: #000000; } }
-        img { max-width: 100%; resize: both; }
-    </style>
+    <style>""" + DOCUMENT_CSS + """    </style>
 </head>
 <body><p><br></p></body>
 </html>"""
@@ -122,6 +5685,19 @@ class EditorWindow(Adw.ApplicationWindow):
         header.set_centering_policy(Adw.CenteringPolicy.STRICT)
         toolbar_view.add_top_bar(header)
 
+        # Progress indicator for long running operations (large file loads)
+        self.progress_box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=6)
+        self.progress_box.set_visible(False)
+        self.progress_bar = Gtk.ProgressBar(valign=Gtk.Align.CENTER)
+        self.progress_bar.set_show_text(True)
+        self.progress_box.append(self.progress_bar)
+        progress_cancel_btn = Gtk.Button(icon_name="process-stop")
+        progress_cancel_btn.add_css_class("flat")
+        progress_cancel_btn.connect("clicked", self.on_progress_cancel_clicked)
+        self.progress_box.append(progress_cancel_btn)
+        header.pack_end(self.progress_box)
+        self.progress_cancel_handler = None
+
         # Toolbar groups
         file_group = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=2)
         file_group.add_css_class("toolbar-group")
@@ -172,19 +5748,106 @@ class EditorWindow(Adw.ApplicationWindow):
         toolbars_flowbox.insert(file_toolbar_group, -1)
         toolbars_flowbox.insert(formatting_toolbar_group, -1)
 
-        # Content area
-        scroll = Gtk.ScrolledWindow(vexpand=True)
-        self.webview = WebKit.WebView(editable=True)
-        self.webview.connect('load-changed', self.on_webview_load)
-        scroll.set_child(self.webview)
+        # Content area: one tab per document
+        self.config = load_config()
+        # Numbers windows in the order they open; untitled journals are
+        # recovered into the window with the same number.
+        app = self.get_application()
+        app.window_count += 1
+        self.window_index = app.window_count
+        self.documents = {}
+        self.pool = []
+        self.pool_fill_id = 0
+        # Set while closing the window waits on the unsaved-changes check
+        self.close_checking = False
+        self.close_confirmed = False
+        self.editable_stats = {}
+        self.zoom_level = 1.0
+        self.loading_doc = None
+        self.tab_view = Adw.TabView(vexpand=True)
+        self.tab_view.connect("notify::selected-page", self.on_tab_selected)
+        self.tab_view.connect("close-page", self.on_tab_close)
+        tab_bar = Adw.TabBar(view=self.tab_view)
+        tab_bar.set_autohide(True)
+        self.active_doc = None
+        GLib.timeout_add_seconds(30, self.on_hibernate_timer)
+
+        # Find bar
+        self.find_bar = Gtk.SearchBar()
+        find_box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=6)
+        self.find_entry = Gtk.SearchEntry(placeholder_text="Find")
+        self.find_entry.set_hexpand(True)
+        self.find_entry.connect("search-changed", self.on_find_changed)
+        self.find_entry.connect("activate", lambda entry: self.on_find_step(1))
+        self.find_entry.connect("next-match", lambda entry: self.on_find_step(1))
+        self.find_entry.connect("previous-match", lambda entry: self.on_find_step(-1))
+        self.find_entry.connect("stop-search", lambda entry: self.close_find_bar())
+        find_box.append(self.find_entry)
+        self.find_case_btn = Gtk.ToggleButton(label="Aa", tooltip_text="Match case")
+        self.find_case_btn.add_css_class("flat")
+        self.find_case_btn.connect("toggled", self.on_find_changed)
+        find_box.append(self.find_case_btn)
+        self.find_regex_btn = Gtk.ToggleButton(label=".*", tooltip_text="Regular expression")
+        self.find_regex_btn.add_css_class("flat")
+        self.find_regex_btn.connect("toggled", self.on_find_changed)
+        find_box.append(self.find_regex_btn)
+        self.find_count_label = Gtk.Label(width_chars=12)
+        self.find_count_label.add_css_class("dim-label")
+        find_box.append(self.find_count_label)
+        for icon, delta in [("go-up", -1), ("go-down", 1)]:
+            btn = Gtk.Button(icon_name=icon)
+            btn.add_css_class("flat")
+            btn.connect("clicked", lambda btn, delta=delta: self.on_find_step(delta))
+            find_box.append(btn)
+        self.replace_box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=6)
+        self.replace_box.set_visible(False)
+        self.replace_entry = Gtk.Entry(placeholder_text="Replace with")
+        self.replace_entry.set_hexpand(True)
+        self.replace_entry.connect("activate", self.on_replace_all_clicked)
+        self.replace_box.append(self.replace_entry)
+        replace_all_btn = Gtk.Button(label="Replace All")
+        replace_all_btn.connect("clicked", self.on_replace_all_clicked)
+        self.replace_box.append(replace_all_btn)
+        find_bar_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=6)
+        find_bar_box.append(find_box)
+        find_bar_box.append(self.replace_box)
+        self.find_bar.set_child(find_bar_box)
+        self.find_bar.connect_entry(self.find_entry)
+        self.find_seq = 0
+        self.find_fallback = False
+        self.message_handlers = {
+            "find": self.on_find_message,
+            "replace": self.on_replace_message,
+            "selection": self.on_selection_state,
+            "paste": self.paste_clipboard,
+        }
+        self.paste_job = None
+
+        # Shown while the active document has a disk change it could not apply
+        self.external_bar = Gtk.Revealer()
+        external_box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=6)
+        external_box.add_css_class("toolbar")
+        self.external_label = Gtk.Label(xalign=0, hexpand=True, wrap=True)
+        external_box.append(self.external_label)
+        self.external_use_disk_btn = Gtk.Button(label="Use Disk Version")
+        self.external_use_disk_btn.connect("clicked", self.on_external_resolve, True)
+        external_box.append(self.external_use_disk_btn)
+        self.external_keep_btn = Gtk.Button(label="Keep Mine")
+        self.external_keep_btn.connect("clicked", self.on_external_resolve, False)
+        external_box.append(self.external_keep_btn)
+        self.external_bar.set_child(external_box)
 
         content_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
         content_box.append(toolbars_flowbox)
-        content_box.append(scroll)
+        content_box.append(self.find_bar)
+        content_box.append(self.external_bar)
+        content_box.append(tab_bar)
+        if PROFILE:
+            content_box.append(self.build_profile_overlay())
+        else:
+            content_box.append(self.tab_view)
         toolbar_view.set_content(content_box)
 
-        self.webview.load_html(self.initial_html, "file:///")
-
         # Populate file group
         for icon, handler in [
             ("document-new", self.on_new_clicked),
@@ -197,12 +5860,25 @@ class EditorWindow(Adw.ApplicationWindow):
             btn.add_css_class("flat")
             btn.connect("clicked", handler)
             file_group.append(btn)
+        export_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=2)
+        export_popover = Gtk.Popover(child=export_box)
+        for kind, (label, _) in EXPORT_FORMATS.items():
+            btn = Gtk.Button(label=f"{label} (.{kind})…")
+            btn.add_css_class("flat")
+            btn.connect("clicked", self.on_export_clicked, kind, export_popover)
+            export_box.append(btn)
+        export_btn = Gtk.MenuButton(icon_name="document-send", tooltip_text="Export", popover=export_popover)
+        export_btn.add_css_class("flat")
+        file_group.append(export_btn)
+        # Set while an export runs, cancels it
+        self.export_cancel = None
 
         # Populate edit group
         for icon, handler in [
             ("edit-cut", self.on_cut_clicked),
             ("edit-copy", self.on_copy_clicked),
             ("edit-paste", self.on_paste_clicked),
+            ("insert-image", self.on_insert_image_clicked),
             ("edit-undo", self.on_undo_clicked),
             ("edit-redo", self.on_redo_clicked),
         ]:
@@ -214,7 +5890,8 @@ class EditorWindow(Adw.ApplicationWindow):
         # Populate view group
         for icon, handler in [
             ("edit-find", self.on_find_clicked),
-            ("edit-find-replace", self.on_replace_clicked)
+            ("edit-find-replace", self.on_replace_clicked),
+            ("folder-saved-search", self.on_library_clicked),
         ]:
             btn = Gtk.Button(icon_name=icon)
             btn.add_css_class("flat")
@@ -239,52 +5916,37 @@ class EditorWindow(Adw.ApplicationWindow):
         heading_store = Gtk.StringList()
         for h in ["Normal", "H1", "H2", "H3", "H4", "H5", "H6"]:
             heading_store.append(h)
-        heading_dropdown = Gtk.DropDown(model=heading_store)
-        heading_dropdown.connect("notify::selected", self.on_heading_changed)
-        heading_dropdown.add_css_class("flat")
-        text_style_group.append(heading_dropdown)
-
-        font_map = PangoCairo.FontMap.get_default()
-        families = font_map.list_families()
-        font_names = sorted([family.get_name() for family in families])
-        font_store = Gtk.StringList()
-        for name in font_names:
-            font_store.append(name)
-        self.font_dropdown = Gtk.DropDown(model=font_store)
-        default_index = font_names.index("Sans") if "Sans" in font_names else 0
-        self.font_dropdown.set_selected(default_index)
-        self.font_dropdown.connect("notify::selected", self.on_font_family_changed)
-        self.font_dropdown.add_css_class("flat")
-        text_style_group.append(self.font_dropdown)
+        self.heading_dropdown = Gtk.DropDown(model=heading_store)
+        self.heading_dropdown.add_css_class("flat")
+        text_style_group.append(self.heading_dropdown)
+
+        # The families are filled in by build_deferred_ui()
+        self.font_picker = FontPicker(self.on_font_family_chosen)
+        text_style_group.append(self.font_picker)
 
         size_store = Gtk.StringList()
         for size in ["8", "10", "11", "12", "14", "16", "18", "24", "36", "48"]:
             size_store.append(size)
         self.size_dropdown = Gtk.DropDown(model=size_store)
         self.size_dropdown.set_selected(2)
-        self.size_dropdown.connect("notify::selected", self.on_font_size_changed)
         self.size_dropdown.add_css_class("flat")
         text_style_group.append(self.size_dropdown)
 
         # Populate text format group
         self.bold_btn = Gtk.ToggleButton(icon_name="format-text-bold")
         self.bold_btn.add_css_class("flat")
-        self.bold_btn.connect("toggled", self.on_bold_toggled)
         text_format_group.append(self.bold_btn)
 
         self.italic_btn = Gtk.ToggleButton(icon_name="format-text-italic")
         self.italic_btn.add_css_class("flat")
-        self.italic_btn.connect("toggled", self.on_italic_toggled)
         text_format_group.append(self.italic_btn)
 
         self.underline_btn = Gtk.ToggleButton(icon_name="format-text-underline")
         self.underline_btn.add_css_class("flat")
-        self.underline_btn.connect("toggled", self.on_underline_toggled)
         text_format_group.append(self.underline_btn)
 
         self.strikethrough_btn = Gtk.ToggleButton(icon_name="format-text-strikethrough")
         self.strikethrough_btn.add_css_class("flat")
-        self.strikethrough_btn.connect("toggled", self.on_strikethrough_toggled)
         text_format_group.append(self.strikethrough_btn)
 
         # Populate align group
@@ -294,20 +5956,20 @@ class EditorWindow(Adw.ApplicationWindow):
             ("format-justify-right", self.on_align_right),
             ("format-justify-fill", self.on_align_justify)
         ]
-        for icon, handler in align_buttons:
+        self.align_buttons = {}
+        for (icon, handler), align in zip(align_buttons, ["left", "center", "right", "justify"]):
             btn = Gtk.Button(icon_name=icon)
             btn.add_css_class("flat")
             btn.connect("clicked", handler)
             align_group.append(btn)
+            self.align_buttons[align] = btn
 
         # Populate list group
         self.bullet_btn = Gtk.ToggleButton(icon_name="view-list-bullet")
-        self.bullet_btn.connect("toggled", self.on_bullet_list_toggled)
         self.bullet_btn.add_css_class("flat")
         list_group.append(self.bullet_btn)
 
         self.number_btn = Gtk.ToggleButton(icon_name="view-list-ordered")
-        self.number_btn.connect("toggled", self.on_number_list_toggled)
         self.number_btn.add_css_class("flat")
         list_group.append(self.number_btn)
 
@@ -320,7 +5982,70 @@ class EditorWindow(Adw.ApplicationWindow):
             btn.add_css_class("flat")
             list_group.append(btn)
 
-        # Populate color group with color indicators
+        # The color group is populated by build_deferred_ui()
+        self.color_group = color_group
+        self.text_color_indicator = None
+        self.bg_color_indicator = None
+
+        # Initialize colors (default to black)
+        self.current_text_color = Gdk.RGBA()  # Default black
+        self.current_bg_color = Gdk.RGBA()    # Default black
+
+        # Handlers are kept so that syncing the toolbar to the caret can set
+        # widget state without re-running the formatting commands.
+        self.toolbar_handlers = {}
+        for widget, signal, handler in [
+            (self.heading_dropdown, "notify::selected", self.on_heading_changed),
+            (self.size_dropdown, "notify::selected", self.on_font_size_changed),
+            (self.bold_btn, "toggled", self.on_bold_toggled),
+            (self.italic_btn, "toggled", self.on_italic_toggled),
+            (self.underline_btn, "toggled", self.on_underline_toggled),
+            (self.strikethrough_btn, "toggled", self.on_strikethrough_toggled),
+            (self.bullet_btn, "toggled", self.on_bullet_list_toggled),
+            (self.number_btn, "toggled", self.on_number_list_toggled),
+        ]:
+            self.toolbar_handlers[widget] = widget.connect(signal, handler)
+
+        # Files to open go straight into the first tabs, without loading
+        # the blank page first.
+        for file in files or []:
+            self.open_file(file)
+        if not self.documents:
+            self.new_document()
+        GLib.idle_add(self.build_deferred_ui, priority=GLib.PRIORITY_LOW)
+        self.schedule_pool_fill()
+
+        # Ctrl+P opens the library palette, even while the page has focus
+        shortcuts = Gtk.ShortcutController(propagation_phase=Gtk.PropagationPhase.CAPTURE)
+        shortcuts.add_shortcut(Gtk.Shortcut(trigger=Gtk.ShortcutTrigger.parse_string("<Control>p"),
+                                            action=Gtk.CallbackAction.new(self.on_library_shortcut)))
+        self.add_controller(shortcuts)
+
+        if STARTUP_TRACE:
+            self.connect("realize", self.on_trace_realize)
+            key_controller = Gtk.EventControllerKey()
+            key_controller.set_propagation_phase(Gtk.PropagationPhase.CAPTURE)
+            key_controller.connect("key-pressed", self.on_trace_key_pressed)
+            self.add_controller(key_controller)
+        trace_startup("window constructed")
+
+    def on_trace_realize(self, window):
+        frame_clock = self.get_frame_clock()
+        def on_after_paint(clock):
+            trace_startup("first frame")
+            clock.disconnect(handler_id)
+        handler_id = frame_clock.connect("after-paint", on_after_paint)
+
+    def on_trace_key_pressed(self, controller, keyval, keycode, state):
+        doc = self.active_doc
+        if doc and doc.webview and doc.webview.has_focus() and not doc.webview.is_loading():
+            trace_startup("first editable keystroke")
+            self.remove_controller(controller)
+        return False
+
+    def build_deferred_ui(self):
+        # Widgets that are not needed for the first frame
+        color_group = self.color_group
         # Text color button
         text_color_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=0)
         text_color_icon = Gtk.Image.new_from_icon_name("format-text-rich-symbolic")
@@ -349,9 +6074,60 @@ class EditorWindow(Adw.ApplicationWindow):
         bg_color_btn.connect("clicked", self.on_bg_color_clicked)
         color_group.append(bg_color_btn)
 
-        # Initialize colors (default to black)
-        self.current_text_color = Gdk.RGBA()  # Default black
-        self.current_bg_color = Gdk.RGBA()    # Default black
+        self.font_picker.set_families(load_font_families())
+        trace_startup("deferred widgets built")
+        return GLib.SOURCE_REMOVE
+
+    def set_quietly(self, widget, setter, value):
+        handler_id = self.toolbar_handlers[widget]
+        widget.handler_block(handler_id)
+        try:
+            setter(value)
+        finally:
+            widget.handler_unblock(handler_id)
+
+    def on_selection_state(self, changed):
+        if "block" in changed:
+            headings = ["normal", "h1", "h2", "h3", "h4", "h5", "h6"]
+            if changed["block"] in headings:
+                self.set_quietly(self.heading_dropdown, self.heading_dropdown.set_selected,
+                                 headings.index(changed["block"]))
+        if "font" in changed:
+            self.font_picker.set_current(changed["font"])
+        if "size" in changed:
+            size = changed["size"]
+            label = str(int(size)) if size == int(size) else str(size)
+            model = self.size_dropdown.get_model()
+            for i in range(model.get_n_items()):
+                if model.get_string(i) == label:
+                    self.set_quietly(self.size_dropdown, self.size_dropdown.set_selected, i)
+                    break
+        for key, btn in [("bold", self.bold_btn), ("italic", self.italic_btn),
+                         ("underline", self.underline_btn), ("strikethrough", self.strikethrough_btn)]:
+            if key in changed:
+                self.set_quietly(btn, btn.set_active, changed[key])
+        if "list" in changed:
+            self.set_quietly(self.bullet_btn, self.bullet_btn.set_active, changed["list"] == "ul")
+            self.set_quietly(self.number_btn, self.number_btn.set_active, changed["list"] == "ol")
+        if "align" in changed:
+            for align, btn in self.align_buttons.items():
+                if align == changed["align"]:
+                    btn.add_css_class("highlighted")
+                else:
+                    btn.remove_css_class("highlighted")
+        if "color" in changed:
+            rgba = Gdk.RGBA()
+            if rgba.parse(changed["color"]):
+                self.current_text_color = rgba
+                if self.text_color_indicator:
+                    self.text_color_indicator.queue_draw()
+        if "background" in changed:
+            rgba = Gdk.RGBA()
+            # Transparent means no highlight; keep the last picked color.
+            if rgba.parse(changed["background"]) and rgba.alpha > 0:
+                self.current_bg_color = rgba
+                if self.bg_color_indicator:
+                    self.bg_color_indicator.queue_draw()
 
     def draw_color_indicator(self, area, cr, width, height, data):
         # Draw the color based on the area (text or bg indicator)
@@ -379,7 +6155,7 @@ class EditorWindow(Adw.ApplicationWindow):
                 self.current_text_color = rgba
                 self.text_color_indicator.queue_draw()  # Update the indicator
                 color = rgba.to_string()
-                self.exec_js(f"document.execCommand('foreColor', false, '{color}')")
+                self.run_command("exec", "foreColor", color)
         except GLib.Error as e:
             print("Text color selection error:", e.message)
 
@@ -396,7 +6172,7 @@ class EditorWindow(Adw.ApplicationWindow):
                 self.current_bg_color = rgba
                 self.bg_color_indicator.queue_draw()  # Update the indicator
                 color = rgba.to_string()
-                self.exec_js(f"document.execCommand('backColor', false, '{color}')")
+                self.run_command("exec", "backColor", color)
         except GLib.Error as e:
             print("Background color selection error:", e.message)
 
@@ -408,433 +6184,1247 @@ class EditorWindow(Adw.ApplicationWindow):
         box.append(label)
         list_item.set_child(box)
 
-    def bind_align_dropdown_item(self, factory, list_item, align_options):
-        box = list_item.get_child()
-        icon = box.get_first_child()
-        label = icon.get_next_sibling()
-        pos = list_item.get_position()
-        label_text, icon_name, _ = align_options[pos]
-        label.set_text(label_text)
-        icon.set_from_icon_name(icon_name)
+    def bind_align_dropdown_item(self, factory, list_item, align_options):
+        box = list_item.get_child()
+        icon = box.get_first_child()
+        label = icon.get_next_sibling()
+        pos = list_item.get_position()
+        label_text, icon_name, _ = align_options[pos]
+        label.set_text(label_text)
+        icon.set_from_icon_name(icon_name)
+
+    def on_align_changed(self, dropdown, *args):
+        align_options = [
+            ("Left", "format-justify-left", self.on_align_left),
+            ("Center", "format-justify-center", self.on_align_center),
+            ("Right", "format-justify-right", self.on_align_right),
+            ("Justify", "format-justify-fill", self.on_align_justify)
+        ]
+        selected = dropdown.get_selected()
+        if 0 <= selected < len(align_options):
+            _, _, handler = align_options[selected]
+            handler()
+
+    def on_dark_mode_toggled(self, btn):
+        if btn.get_active():
+            btn.set_icon_name("weather-clear-night")
+        else:
+            btn.set_icon_name("display-brightness")
+        for doc in self.live_documents():
+            doc.bridge.send("darkMode", btn.get_active())
+
+    @property
+    def document(self):
+        return self.active_doc
+
+    @property
+    def webview(self):
+        return self.active_doc.webview
+
+    def create_webview(self, doc):
+        # Every tab shares the default web context and network session; new
+        # views join the web process of an existing one.
+        related = next((d.webview for d in self.live_documents()), None)
+        user_content = WebKit.UserContentManager()
+        if related:
+            webview = WebKit.WebView(editable=True, related_view=related, user_content_manager=user_content)
+        else:
+            webview = WebKit.WebView(editable=True, user_content_manager=user_content,
+                                     web_context=WebKit.WebContext.get_default(),
+                                     network_session=WebKit.NetworkSession.get_default())
+        for source in (EDITOR_SCRIPTS + [PROFILE_JS]) if PROFILE else EDITOR_SCRIPTS:
+            user_content.add_script(WebKit.UserScript.new(
+                source, WebKit.UserContentInjectedFrames.TOP_FRAME,
+                WebKit.UserScriptInjectionTime.END, None, None))
+        user_content.add_style_sheet(WebKit.UserStyleSheet.new(
+            FIND_HIGHLIGHT_CSS, WebKit.UserContentInjectedFrames.TOP_FRAME,
+            WebKit.UserStyleLevel.USER, None, None))
+        user_content.register_script_message_handler("wiziwig", None)
+        user_content.connect("script-message-received::wiziwig", self.on_script_message, doc)
+        find_controller = webview.get_find_controller()
+        find_controller.connect("counted-matches", self.on_find_counted_matches)
+        find_controller.connect("failed-to-find-text", self.on_find_failed)
+        webview.connect('load-changed', self.on_webview_load, doc)
+        webview.connect('load-failed', self.on_webview_load_failed, doc)
+        webview.connect('notify::estimated-load-progress', self.on_webview_load_progress, doc)
+        webview.set_zoom_level(self.zoom_level)
+        if profiler:
+            profiler.instrument(webview)
+        doc.attach(webview)
+        return webview
+
+    def live_documents(self):
+        return [doc for doc in [*self.documents.values(), *self.pool] if doc.webview]
+
+    def schedule_pool_fill(self):
+        if not self.pool_fill_id:
+            self.pool_fill_id = GLib.idle_add(self.fill_pool, priority=GLib.PRIORITY_LOW)
+
+    def fill_pool(self):
+        # One view per idle callback so the main loop stays responsive
+        if len(self.pool) >= self.config["webview_pool_size"]:
+            self.pool_fill_id = 0
+            return GLib.SOURCE_REMOVE
+        doc = EditorDocument()
+        doc.pooled = True
+        self.create_webview(doc)
+        doc.webview.load_html(self.initial_html, "file:///")
+        self.pool.append(doc)
+        return GLib.SOURCE_CONTINUE
+
+    def take_warm_document(self):
+        doc = next((doc for doc in self.pool if doc.warm), None)
+        if doc:
+            self.pool.remove(doc)
+            doc.pooled = False
+            self.schedule_pool_fill()
+        return doc
+
+    def build_profile_overlay(self):
+        # F12 shows the profiler's histograms over the document
+        overlay = Gtk.Overlay(child=self.tab_view)
+        self.profile_panel = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=6,
+                                     halign=Gtk.Align.END, valign=Gtk.Align.START,
+                                     margin_top=12, margin_end=12, visible=False)
+        self.profile_panel.add_css_class("osd")
+        self.profile_panel.add_css_class("toolbar")
+        self.profile_label = Gtk.Label(xalign=0, selectable=True)
+        self.profile_label.add_css_class("monospace")
+        self.profile_panel.append(self.profile_label)
+        dump_btn = Gtk.Button(label="Save Trace", halign=Gtk.Align.END)
+        dump_btn.connect("clicked", lambda btn: profiler.dump())
+        self.profile_panel.append(dump_btn)
+        overlay.add_overlay(self.profile_panel)
+
+        self.profile_keys = deque(maxlen=64)
+        key_controller = Gtk.EventControllerKey()
+        key_controller.set_propagation_phase(Gtk.PropagationPhase.CAPTURE)
+        key_controller.connect("key-pressed", self.on_profile_key_pressed)
+        self.add_controller(key_controller)
+        GLib.timeout_add_seconds(1, self.on_profile_sample)
+        return overlay
+
+    def on_profile_key_pressed(self, controller, keyval, keycode, state):
+        if keyval == Gdk.KEY_F12:
+            self.profile_panel.set_visible(not self.profile_panel.get_visible())
+            self.refresh_profile_overlay()
+            return True
+        doc = self.active_doc
+        if doc and doc.webview and doc.webview.has_focus():
+            self.profile_keys.append(time.monotonic())
+        return False
+
+    def on_profile_input(self, data):
+        now = time.monotonic()
+        profiler.span("input in page", now - data["input_ms"] / 1000, now, category="input")
+        if self.profile_keys:
+            profiler.span("input key to paint", self.profile_keys.popleft(), now, category="input")
+
+    def on_profile_sample(self):
+        for name, mib in child_process_memory().items():
+            profiler.counter(f"rss {name} MiB", round(mib, 1))
+        doc = self.active_doc
+        if doc and doc.webview and not doc.webview.is_loading():
+            def on_counted(webview, result, user_data):
+                try:
+                    profiler.counter("dom elements", webview.evaluate_javascript_finish(result).to_int32())
+                except GLib.Error:
+                    pass
+                self.refresh_profile_overlay()
+            doc.webview.evaluate_javascript("document.getElementsByTagName('*').length", -1, None, None, None,
+                                            on_counted, None)
+        else:
+            self.refresh_profile_overlay()
+        return GLib.SOURCE_CONTINUE
+
+    def refresh_profile_overlay(self):
+        if not self.profile_panel.get_visible():
+            return
+        def rounded(value):
+            if isinstance(value, dict):
+                return {key: rounded(item) for key, item in value.items()}
+            return round(value, 1) if isinstance(value, float) else value
+        lines = [profiler.report()]
+        doc = self.active_doc
+        if doc:
+            for title, stats in [("history", doc.history_stats), ("normalize", doc.normalize_stats),
+                                 ("editable", self.editable_stats),
+                                 ("bridge", doc.bridge.latency if doc.bridge else {})]:
+                if stats:
+                    lines.append(f"{title}: " + json.dumps(rounded(stats), default=str)[:400])
+        self.profile_label.set_text("\n".join(lines))
+
+    def measure_editable(self, doc):
+        # Time from New/Open until the page answers as editable
+        started, kind = doc.editable_started
+        doc.editable_started = None
+        def on_editable(webview, result, user_data):
+            try:
+                if not webview.evaluate_javascript_finish(result).to_boolean():
+                    return
+            except GLib.Error:
+                return
+            elapsed = (time.monotonic() - started) * 1000
+            stats = self.editable_stats.setdefault(kind, {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+            stats["count"] += 1
+            stats["total_ms"] += elapsed
+            stats["max_ms"] = max(stats["max_ms"], elapsed)
+            stats["last_ms"] = elapsed
+            if profiler:
+                profiler.span(f"editable ({kind})", started, category="load")
+        doc.webview.evaluate_javascript("document.body.isContentEditable", -1, None, None, None, on_editable, None)
+
+    def add_document(self, doc=None):
+        if doc is None:
+            doc = EditorDocument()
+            self.create_webview(doc)
+        doc.page = self.tab_view.append(doc.container)
+        doc.page.set_title(doc.title())
+        self.documents[doc.page] = doc
+        if self.tab_view.get_selected_page() is doc.page:
+            # The first page is selected by append() before it is registered
+            self.on_tab_selected(self.tab_view, None)
+        else:
+            self.tab_view.set_selected_page(doc.page)
+        return doc
+
+    def new_document(self):
+        started = time.monotonic()
+        doc = self.take_warm_document()
+        if doc:
+            doc.editable_started = (started, "warm")
+            self.add_document(doc)
+            self.on_document_ready(doc)
+            return doc
+        doc = self.add_document()
+        doc.editable_started = (started, "cold")
+        doc.webview.load_html(self.initial_html, "file:///")
+        return doc
+
+    def document_for_open(self):
+        # An untouched blank tab is reused instead of opening another one.
+        started = time.monotonic()
+        doc = self.active_doc
+        if doc and doc.pristine and doc.current_file is None and doc.webview:
+            doc.editable_started = (started, "reused")
+            return doc
+        doc = self.take_warm_document()
+        if doc:
+            # The web process and editor scripts are already up; only the
+            # document itself still has to load.
+            doc.editable_started = (started, "warm")
+            return self.add_document(doc)
+        doc = self.add_document()
+        doc.editable_started = (started, "cold")
+        return doc
+
+    def on_tab_selected(self, tab_view, pspec):
+        previous = self.active_doc
+        if previous:
+            previous.last_active = time.monotonic()
+            if previous.bridge:
+                previous.bridge.send("findClear")
+        page = tab_view.get_selected_page()
+        self.active_doc = self.documents.get(page) if page else None
+        self.find_count_label.set_text("")
+        self.update_external_bar()
+        doc = self.active_doc
+        if doc is None:
+            return
+        if doc.webview is None:
+            self.restore_document(doc)
+        else:
+            doc.bridge.send("refreshSelection")
+            if self.find_bar.get_search_mode() and self.find_entry.get_text():
+                self.on_find_changed()
+        GLib.idle_add(doc.webview.grab_focus)
+
+    def on_tab_close(self, tab_view, page):
+        doc = self.documents.get(page)
+        if doc is None:
+            tab_view.close_page_finish(page, True)
+            return True
+        def on_checked(modified):
+            if modified:
+                self.ask_close_document(doc)
+            else:
+                self.finish_tab_close(doc, True)
+        self.check_modified(doc, on_checked)
+        return True
+
+    def check_modified(self, doc, callback):
+        # Calls callback(True) when doc has changes that are not saved
+        if doc.webview is None:
+            callback(not doc.load_is_clean)
+            return
+        def on_result(webview, result, user_data):
+            try:
+                modified = webview.evaluate_javascript_finish(result).to_boolean()
+            except GLib.Error as e:
+                print("Close error:", e.message)
+                modified = False
+            callback(modified or not doc.loaded_clean)
+        doc.webview.evaluate_javascript("wiziwig.journal.modified()", -1, None, None, None, on_result, None)
+
+    def ask_close_document(self, doc):
+        dialog = Adw.MessageDialog(
+            transient_for=self,
+            heading="Save Changes?",
+            body=f"“{doc.title()}” has unsaved changes. Changes which are not saved will be permanently lost.",
+            close_response="cancel",
+            modal=True
+        )
+        dialog.add_response("cancel", "Cancel")
+        dialog.add_response("discard", "Discard")
+        dialog.add_response("save", "Save")
+        dialog.set_default_response("save")
+        dialog.set_response_appearance("discard", Adw.ResponseAppearance.DESTRUCTIVE)
+        dialog.set_response_appearance("save", Adw.ResponseAppearance.SUGGESTED)
+
+        def on_response(dialog, response):
+            dialog.destroy()
+            if doc.page not in self.documents:
+                return
+            self.finish_tab_close(doc, response == "discard")
+            if response == "save":
+                self.save_and_close(doc)
+        dialog.connect("response", on_response)
+        dialog.present()
+
+    def save_and_close(self, doc):
+        # The tab is closed again from final_save_callback once written
+        doc.close_after_save = True
+        if doc.webview is None:
+            # A hibernated tab is loaded back first and saved when ready
+            doc.save_when_ready = True
+            self.tab_view.set_selected_page(doc.page)
+        elif doc.current_file:
+            self.save_document(doc, doc.current_file)
+        else:
+            self.on_save_as_clicked(None, doc)
+
+    def finish_tab_close(self, doc, confirm):
+        page = doc.page
+        if confirm:
+            self.documents.pop(page, None)
+            self.unwatch_file(doc)
+            doc.journal.discard()
+            doc.remove_hibernation_file()
+            doc.remove_pdf_cache()
+        self.tab_view.close_page_finish(page, confirm)
+        if confirm and self.tab_view.get_n_pages() == 0:
+            self.close()
+
+    def on_hibernate_timer(self):
+        limit = self.config["tab_hibernate_after"]
+        now = time.monotonic()
+        for doc in list(self.documents.values()):
+            if (doc is not self.active_doc and doc.webview and not doc.hibernating
+                    and now - doc.last_active > limit):
+                self.hibernate_document(doc)
+        return GLib.SOURCE_CONTINUE
+
+    def hibernate_document(self, doc):
+        # Serialize the page and its scroll position to the cache dir, then
+        # drop the web view. restore_document() brings it back on focus.
+        if doc.saver.busy or doc.webview.is_loading():
+            return
+        doc.hibernating = True
+        if doc.hibernation_file is None:
+            directory = os.path.join(GLib.get_user_cache_dir(), "wiziwig", "hibernate")
+            os.makedirs(directory, exist_ok=True)
+            doc.hibernation_file = Gio.File.new_for_path(
+                os.path.join(directory, f"{os.getpid()}-{id(doc)}.html"))
+
+        def on_scroll(webview, result, user_data):
+            try:
+                doc.scroll_position = json.loads(webview.evaluate_javascript_finish(result).to_string())
+            except (GLib.Error, ValueError):
+                doc.scroll_position = None
+            if not doc.saver.snapshot(doc.hibernation_file, self.on_hibernation_written, doc):
+                doc.hibernating = False
+        doc.webview.evaluate_javascript("wiziwig.journal.flush(); JSON.stringify([scrollX, scrollY])",
+                                        -1, None, None, None, on_scroll, None)
+
+    def on_hibernation_written(self, file, error, doc, clean):
+        doc.hibernating = False
+        if error:
+            print("Hibernation error:", error)
+            return
+        if doc is self.active_doc or doc.page not in self.documents:
+            return
+        doc.load_is_clean = clean
+        doc.journal_base = file
+        doc.journal.discard()
+        doc.detach()
+
+    def restore_document(self, doc):
+        self.create_webview(doc)
+        self.load_copy(doc, doc.hibernation_file.get_path())
+
+    def load_copy(self, doc, source):
+        # A copy of the page, such as a hibernated one, is served under the
+        # document's own URI so its relative images and stylesheets resolve
+        # beside the original file.
+        path = doc.current_file.get_path() if doc.current_file else None
+        if path and path != source:
+            self.get_application().load_document(doc.webview, path, source)
+        else:
+            self.get_application().load_document(doc.webview, source)
+
+    def on_webview_load(self, webview, load_event, doc):
+        if profiler:
+            if load_event == WebKit.LoadEvent.STARTED:
+                doc.load_started = time.monotonic()
+            elif load_event == WebKit.LoadEvent.COMMITTED and doc.load_started:
+                profiler.span("load committed", doc.load_started, category="load")
+            elif load_event == WebKit.LoadEvent.FINISHED and doc.load_started:
+                profiler.span("load finished", doc.load_started, category="load")
+        if load_event == WebKit.LoadEvent.STARTED and doc.page:
+            doc.page.set_loading(True)
+        if load_event == WebKit.LoadEvent.COMMITTED:
+            doc.saver.reset(doc.current_file if doc.load_is_clean else None)
+            doc.loaded_clean = doc.load_is_clean
+            doc.load_is_clean = True
+            doc.journal.discard()
+            doc.bridge.reset()
+        if load_event == WebKit.LoadEvent.FINISHED:
+            if doc.pooled:
+                # Apply the view settings now so that swapping it in is instant
+                doc.warm = True
+                doc.bridge.send("darkMode", self.dark_mode_btn.get_active())
+                return
+            doc.page.set_loading(False)
+            if self.loading_doc is doc:
+                self.loading_doc = None
+                self.hide_progress()
+            self.on_document_ready(doc)
+
+    def on_document_ready(self, doc):
+        trace_startup("web view load finished")
+        if doc.pending_restore:
+            self.restore_journal(doc, *doc.pending_restore)
+            doc.pending_restore = None
+        else:
+            self.check_recovery(doc)
+        if doc.scroll_position:
+            doc.bridge.send("scrollTo", *doc.scroll_position)
+            doc.scroll_position = None
+        else:
+            doc.bridge.send("focusStart")
+        doc.bridge.send("historyLimit", self.config["history_memory_limit"])
+        doc.bridge.send("externalBaseline", doc.loaded_clean)
+        doc.bridge.send("virtualize", self.config["virtualize_above_blocks"])
+        self.watch_file(doc)
+        if doc.external_pending:
+            self.schedule_external_check(doc)
+        if doc is self.active_doc:
+            GLib.idle_add(doc.webview.grab_focus)
+        doc.bridge.send("darkMode", self.dark_mode_btn.get_active())
+        if doc.editable_started:
+            self.measure_editable(doc)
+        if doc.pending_find and doc is self.active_doc:
+            self.find_text(doc.pending_find)
+            doc.pending_find = None
+        if doc.save_when_ready:
+            doc.save_when_ready = False
+            self.save_and_close(doc)
+
+    def on_webview_load_failed(self, webview, load_event, uri, error, doc):
+        if doc.pooled:
+            self.pool.remove(doc)
+            return False
+        doc.page.set_loading(False)
+        if self.loading_doc is doc:
+            self.loading_doc = None
+            self.hide_progress()
+        if not error.matches(WebKit.network_error_quark(), WebKit.NetworkError.CANCELLED):
+            print("Load error:", error.message)
+        return False
+
+    def on_webview_load_progress(self, webview, pspec, doc):
+        if self.loading_doc is doc:
+            self.update_progress(webview.get_estimated_load_progress())
+
+    def show_progress(self, text, cancel_handler):
+        self.progress_cancel_handler = cancel_handler
+        self.progress_bar.set_text(text)
+        self.progress_bar.set_fraction(0.0)
+        self.progress_box.set_visible(True)
+
+    def update_progress(self, fraction):
+        self.progress_bar.set_fraction(max(0.0, min(1.0, fraction)))
+
+    def hide_progress(self):
+        self.progress_cancel_handler = None
+        self.progress_box.set_visible(False)
+
+    def on_progress_cancel_clicked(self, btn):
+        handler = self.progress_cancel_handler
+        self.hide_progress()
+        if handler:
+            handler()
+
+    def on_script_message(self, manager, value, doc):
+        message = json.loads(value.to_string())
+        kind = message["type"]
+        data = message["data"]
+        if kind == "ack":
+            if doc.bridge:
+                doc.bridge.on_ack(data)
+        elif kind == "journal":
+            doc.pristine = False
+            doc.revision += 1
+            doc.journal.append(data)
+        elif kind == "history":
+            doc.history_stats = data
+        elif kind == "profile":
+            self.on_profile_input(data)
+        elif kind == "normalize":
+            stats = doc.normalize_stats
+            stats["blocks"] += data["blocks"]
+            stats["nodes_before"] += data["before"]
+            stats["nodes_after"] += data["after"]
+            if profiler:
+                profiler.counter("normalized nodes removed", stats["nodes_before"] - stats["nodes_after"])
+        elif doc is self.active_doc:
+            handler = self.message_handlers.get(kind)
+            if handler:
+                handler(data)
+
+    def start_journal(self, doc, full=False):
+        base = doc.journal_base
+        key = doc.journal_key
+        doc.journal.on_reset = lambda key: self.on_journal_reset(doc, key)
+        def on_started(webview, result, user_data):
+            try:
+                n = webview.evaluate_javascript_finish(result).to_int32()
+                doc.journal.start(base, n, key, self.window_index, full)
+            except GLib.Error as e:
+                print("Journal error:", e.message)
+            if not full:
+                self.apply_formatting_mode(doc)
+        doc.webview.evaluate_javascript(f"wiziwig.journal.start({json.dumps(full)})", -1, None, None, None, on_started, None)
+
+    def on_journal_reset(self, doc, key):
+        # The journal was dropped because it went out of step with the page;
+        # the page may differ from its file, so the new one records it whole.
+        if doc.webview and doc.journal.key == key:
+            self.start_journal(doc, full=True)
+        return False
+
+    def apply_formatting_mode(self, doc):
+        # Runs once the journal is recording, so converting a legacy document
+        # to classes is journaled like any other edit.
+        if self.config["formatting_mode"] == "classes" and doc.bridge:
+            doc.bridge.send("styleClasses")
+
+    def check_recovery(self, doc):
+        file = doc.current_file
+        key = doc.journal.find_orphan(file, self.window_index)
+        if key is None:
+            self.start_journal(doc)
+            return
+        def load_thread():
+            try:
+                model = doc.journal.load(key)
+            except (OSError, ValueError, KeyError) as e:
+                print("Journal recovery error:", e)
+                model = None
+            GLib.idle_add(self.on_recovery_loaded, doc, file, key, model)
+        threading.Thread(target=load_thread, daemon=True).start()
+
+    def on_recovery_loaded(self, doc, file, key, model):
+        if file is not doc.current_file or doc.webview is None:
+            return False
+        header = model["header"] if model else None
+        base = doc.journal_base
+        if header and header["uri"] != (base.get_uri() if base else None):
+            # The journal was written against a hibernated copy of the page
+            base = Gio.File.new_for_uri(header["uri"])
+        if header and header["size"] is not None:
+            current = Journal.base_info(base)
+            if (current["size"], current["mtime"]) != (header["size"], header["mtime"]):
+                model = None  # the file changed on disk since the journal was written
+        if model is None:
+            doc.journal.remove(key)
+            self.start_journal(doc)
+            return False
+        dialog = Adw.MessageDialog(
+            transient_for=self,
+            heading="Recover Unsaved Changes?",
+            body=f"Wiziwig did not shut down cleanly while “{doc.title()}” had unsaved changes.",
+            close_response="discard",
+            modal=True
+        )
+        dialog.add_response("discard", "Discard")
+        dialog.add_response("recover", "Recover")
+        dialog.set_response_appearance("recover", Adw.ResponseAppearance.SUGGESTED)
+        dialog.set_response_appearance("discard", Adw.ResponseAppearance.DESTRUCTIVE)
+
+        def on_response(dialog, response):
+            dialog.destroy()
+            if file is not doc.current_file or doc.webview is None:
+                return
+            if response != "recover":
+                doc.journal.remove(key)
+                self.start_journal(doc)
+                return
+            if base is doc.journal_base:
+                self.restore_journal(doc, key, model)
+                return
+            # Load the journal's base first; restore_journal runs when done.
+            doc.pending_restore = (key, model)
+            doc.journal_base = base
+            doc.load_is_clean = False
+            self.load_copy(doc, base.get_path())
 
-    def on_align_changed(self, dropdown, *args):
-        align_options = [
-            ("Left", "format-justify-left", self.on_align_left),
-            ("Center", "format-justify-center", self.on_align_center),
-            ("Right", "format-justify-right", self.on_align_right),
-            ("Justify", "format-justify-fill", self.on_align_justify)
-        ]
-        selected = dropdown.get_selected()
-        if 0 <= selected < len(align_options):
-            _, _, handler = align_options[selected]
-            handler()
+        dialog.connect("response", on_response)
+        dialog.present()
+        return False
 
-    def on_dark_mode_toggled(self, btn):
-        if btn.get_active():
-            btn.set_icon_name("weather-clear-night")
-            script = """
-                (function() {
-                    let styleId = 'dynamic-theme-style';
-                    let existingStyle = document.getElementById(styleId);
-                    if (!existingStyle) {
-                        let style = document.createElement('style');
-                        style.id = styleId;
-                        style.textContent = `
-                            @media (prefers-color-scheme: dark) { 
-                                body { background-color: #242424 !important; color: #e0e0e0 !important; } 
-                            }
-                            @media (prefers-color-scheme: light) { 
-                                body { background-color: #ffffff !important; color: #000000 !important; } 
-                            }
-                        `;
-                        document.head.appendChild(style);
-                    }
-                })();
-            """
-        else:
-            btn.set_icon_name("display-brightness")
-            script = """
-                (function() {
-                    let styleId = 'dynamic-theme-style';
-                    let existingStyle = document.getElementById(styleId);
-                    if (existingStyle) {
-                        existingStyle.remove();
-                    }
-                })();
-            """
-        self.exec_js(script)
+    def restore_journal(self, doc, key, model):
+        header = model["header"]
+        state = {"n": header["n"], "order": model["order"], "html": list(model["html"].items()),
+                 "head": model["head"], "next_id": model["next_id"], "full": header.get("full", False)}
 
-    def on_webview_load(self, webview, load_event):
-        if load_event == WebKit.LoadEvent.FINISHED:
-            script = """
-                let p = document.querySelector('p');
-                if (p) {
-                    let range = document.createRange();
-                    range.setStart(p, 0);
-                    range.setEnd(p, 0);
-                    let sel = window.getSelection();
-                    sel.removeAllRanges();
-                    sel.addRange(range);
-                }
-            """
-            self.webview.evaluate_javascript(script, -1, None, None, None, None, None)
-            GLib.idle_add(self.webview.grab_focus)
-            if self.dark_mode_btn.get_active():
-                dark_mode_script = """
-                    (function() {
-                        let styleId = 'dynamic-theme-style';
-                        let existingStyle = document.getElementById(styleId);
-                        if (!existingStyle) {
-                            let style = document.createElement('style');
-                            style.id = styleId;
-                            style.textContent = `
-                                @media (prefers-color-scheme: dark) { 
-                                    body { background-color: #242424 !important; color: #e0e0e0 !important; } 
-                                }
-                                @media (prefers-color-scheme: light) { 
-                                    body { background-color: #ffffff !important; color: #000000 !important; } 
-                                }
-                            `;
-                            document.head.appendChild(style);
-                        }
-                    })();
-                """
-                self.exec_js(dark_mode_script)
-
-    def exec_js(self, script):
-        self.webview.evaluate_javascript(script, -1, None, None, None, None, None)
+        def on_restored(webview, result, user_data):
+            try:
+                restored = webview.evaluate_javascript_finish(result).to_boolean()
+            except GLib.Error as e:
+                print("Journal recovery error:", e.message)
+                restored = False
+            if restored:
+                doc.journal.resume(key, model, self.window_index)
+                doc.pristine = False
+                self.apply_formatting_mode(doc)
+            else:
+                print("Journal does not match the document, recovery skipped")
+                doc.journal.remove(key)
+                self.start_journal(doc)
+        doc.webview.evaluate_javascript(f"wiziwig.journal.restore({json.dumps(state)})", -1, None, None, None, on_restored, None)
+
+    def run_command(self, name, *args):
+        self.document.bridge.send(name, *args)
         self.webview.grab_focus()
 
     def on_new_clicked(self, btn): 
-        self.webview.load_html(self.initial_html, "file:///")
+        self.new_document()
     
     def on_open_clicked(self, btn): 
         self.open_file_dialog()
     
     def on_save_clicked(self, btn):
+        doc = self.document
+        if doc.current_file:
+            self.save_document(doc, doc.current_file)
+        else:
+            self.on_save_as_clicked(btn)
+
+    def save_document(self, doc, file, ask=False):
+        # Images from the blob store are rewritten while writing. With ask
+        # set, a document that has any is asked how to store them first.
+        def save(mode):
+            if doc.saver:
+                images = ImageExporter(self.get_application().blob_store, mode, file)
+                doc.saver.save(file, self.final_save_callback, doc, images)
+        def on_checked(webview, result, user_data):
+            try:
+                uses_blobs = webview.evaluate_javascript_finish(result).to_boolean()
+            except GLib.Error as e:
+                print("Save error:", e.message)
+                return
+            if uses_blobs and (ask or doc.image_mode is None):
+                self.ask_image_mode(doc, save)
+            else:
+                save(doc.image_mode or self.config["image_save_mode"])
+        doc.webview.evaluate_javascript("wiziwig.images.usesBlobs()", -1, None, None, None, on_checked, None)
+
+    def ask_image_mode(self, doc, save):
+        dialog = Adw.MessageDialog(
+            transient_for=self,
+            heading="Save Images",
+            body="Embed the images in the HTML file, or save them to a folder next to it?",
+            close_response="cancel",
+            modal=True
+        )
+        dialog.add_response("cancel", "Cancel")
+        dialog.add_response("folder", "Images Folder")
+        dialog.add_response("inline", "Embed")
+        default = doc.image_mode or self.config["image_save_mode"]
+        dialog.set_default_response(default if default in ("folder", "inline") else "inline")
+        dialog.set_response_appearance(dialog.get_default_response(), Adw.ResponseAppearance.SUGGESTED)
+
+        def on_response(dialog, response):
+            dialog.destroy()
+            if response != "cancel" and doc.webview:
+                doc.image_mode = response
+                save(response)
+            else:
+                doc.close_after_save = False
+        dialog.connect("response", on_response)
+        dialog.present()
+    
+    def on_save_as_clicked(self, btn, doc=None):
         dialog = Gtk.FileDialog()
         dialog.set_title("Save HTML File")
         dialog.set_initial_name("document.html")
         filter_html = Gtk.FileFilter()
         filter_html.set_name("HTML Files (*.html)")
         filter_html.add_pattern("*.html")
+        filter_markdown = Gtk.FileFilter()
+        filter_markdown.set_name("Markdown Files (*.md)")
+        filter_markdown.add_pattern("*.md")
+        filter_markdown.add_pattern("*.markdown")
         filter_store = Gio.ListStore.new(Gtk.FileFilter)
         filter_store.append(filter_html)
+        filter_store.append(filter_markdown)
         dialog.set_filters(filter_store)
-        dialog.save(self, None, self.save_callback)
-    
-    def on_save_as_clicked(self, btn): 
-        self.on_save_clicked(btn)
+        dialog.save(self, None, self.save_callback, doc or self.document)
     
     def on_print_clicked(self, btn):
-        print_operation = WebKit.PrintOperation.new(self.webview)
-        print_operation.run_dialog(self)
+        # A virtualized view holds only part of the document in the DOM, so
+        # every block is put back for printing and the view re-virtualized after.
+        doc = self.document
+        def on_materialized(webview, result, user_data):
+            try:
+                was_virtual = webview.evaluate_javascript_finish(result).to_boolean()
+            except GLib.Error as e:
+                print("Print error:", e.message)
+                return
+            def revirtualize(*args):
+                if was_virtual and doc.bridge:
+                    doc.bridge.send("virtualize", self.config["virtualize_above_blocks"])
+            print_operation = WebKit.PrintOperation.new(webview)
+            print_operation.connect("finished", revirtualize)
+            if print_operation.run_dialog(self) != WebKit.PrintOperationResponse.PRINT:
+                revirtualize()
+        doc.webview.evaluate_javascript("wiziwig.virtual.disable()", -1, None, None, None, on_materialized, None)
     
+    def on_export_clicked(self, btn, kind, popover):
+        popover.popdown()
+        doc = self.document
+        if doc is None or doc.saver is None:
+            return
+        label, mime_type = EXPORT_FORMATS[kind]
+        dialog = Gtk.FileDialog()
+        dialog.set_title(f"Export {label}")
+        stem = os.path.splitext(doc.title())[0] if doc.current_file else "document"
+        dialog.set_initial_name(f"{stem}.{kind}")
+        file_filter = Gtk.FileFilter()
+        file_filter.set_name(f"{label} (*.{kind})")
+        file_filter.add_mime_type(mime_type)
+        file_filter.add_pattern(f"*.{kind}")
+        filter_store = Gio.ListStore.new(Gtk.FileFilter)
+        filter_store.append(file_filter)
+        dialog.set_filters(filter_store)
+        dialog.save(self, None, self.on_export_target_chosen, (doc, kind))
+
+    def on_export_target_chosen(self, dialog, result, target):
+        doc, kind = target
+        try:
+            file = dialog.save_finish(result)
+        except GLib.Error as e:
+            print("Export error:", e.message)
+            return
+        path = file.get_path()
+        if path is None:
+            print("Export error: exports can only be written to local files")
+            return
+        if self.export_cancel or doc.saver is None:
+            print("Export already in progress")
+            return
+        self.export_cancel = threading.Event()
+        cancel = self.export_cancel
+        self.show_progress(f"Exporting {file.get_basename()}", cancel.set)
+        if kind == "pdf":
+            self.export_pdf(doc, path, cancel)
+        else:
+            self.export_office(doc, kind, path, cancel)
+
+    def export_directory(self):
+        directory = os.path.join(GLib.get_user_cache_dir(), "wiziwig", "export")
+        os.makedirs(directory, exist_ok=True)
+        return directory
+
+    def export_pdf(self, doc, path, cancel):
+        # WebKit paginates the whole document for every print, so the result
+        # is kept and copied again until the next edit.
+        def on_flushed(webview, result, user_data):
+            try:
+                webview.evaluate_javascript_finish(result)
+            except GLib.Error as e:
+                self.finish_export(cancel, f"could not read the document: {e.message}")
+                return
+            cached = doc.pdf_cache
+            if cached and cached[0] == doc.revision and os.path.exists(cached[1]):
+                self.copy_export(cached[1], path, cancel)
+                return
+            revision = doc.revision
+            cache_path = os.path.join(self.export_directory(), f"{os.getpid()}-{id(doc)}.pdf")
+            webview.evaluate_javascript("wiziwig.virtual.disable()", -1, None, None, None,
+                                        on_materialized, (revision, cache_path))
+
+        def on_materialized(webview, result, target):
+            revision, cache_path = target
+            try:
+                was_virtual = webview.evaluate_javascript_finish(result).to_boolean()
+            except GLib.Error as e:
+                self.finish_export(cancel, f"could not lay out the document: {e.message}")
+                return
+            failure = []
+            def on_failed(operation, error):
+                failure.append(error.message)
+            def on_finished(operation):
+                if was_virtual and doc.bridge:
+                    doc.bridge.send("virtualize", self.config["virtualize_above_blocks"])
+                if failure:
+                    self.finish_export(cancel, f"printing failed: {failure[0]}")
+                    return
+                doc.remove_pdf_cache()
+                doc.pdf_cache = (revision, cache_path)
+                self.copy_export(cache_path, path, cancel)
+            settings = Gtk.PrintSettings()
+            settings.set_printer("Print to File")
+            settings.set(Gtk.PRINT_SETTINGS_OUTPUT_FILE_FORMAT, "pdf")
+            settings.set(Gtk.PRINT_SETTINGS_OUTPUT_URI, Gio.File.new_for_path(cache_path).get_uri())
+            operation = WebKit.PrintOperation.new(webview)
+            operation.set_print_settings(settings)
+            operation.connect("failed", on_failed)
+            operation.connect("finished", on_finished)
+            operation.print()
+        doc.webview.evaluate_javascript("wiziwig.journal.flush()", -1, None, None, None, on_flushed, None)
+
+    def copy_export(self, source, path, cancel):
+        def copy_thread():
+            error = None
+            try:
+                if not cancel.is_set():
+                    shutil.copyfile(source, path + ".part")
+                    os.replace(path + ".part", path)
+            except OSError as e:
+                error = str(e)
+            GLib.idle_add(self.finish_export, cancel, error)
+        threading.Thread(target=copy_thread, daemon=True).start()
+
+    def export_office(self, doc, kind, path, cancel):
+        # The page is snapshotted through the save engine, which reuses its
+        # serialized blocks, then converted off the main thread.
+        source = Gio.File.new_for_path(os.path.join(self.export_directory(),
+                                                    f"{os.getpid()}-{id(doc)}.html"))
+        def on_snapshot(file, error, user_data, clean):
+            if error:
+                self.finish_export(cancel, error)
+                return
+            threading.Thread(target=convert_thread, daemon=True).start()
+
+        def on_progress(fraction):
+            GLib.idle_add(self.on_export_progress, cancel, fraction)
+
+        def convert_thread():
+            error = None
+            try:
+                export_office_document(source.get_path(), path, kind, on_progress, cancel)
+            except (OSError, ValueError, zipfile.BadZipFile) as e:
+                error = str(e)
+            except Exception as e:
+                # html.parser raises AssertionError on some malformed markup;
+                # finish_export must still run to take the progress bar down
+                error = repr(e)
+            try:
+                os.remove(source.get_path())
+            except OSError:
+                pass
+            GLib.idle_add(self.finish_export, cancel, error)
+
+        if not doc.saver.snapshot(source, on_snapshot):
+            self.finish_export(cancel, "the document is being saved, please try again")
+
+    def on_export_progress(self, cancel, fraction):
+        if cancel is self.export_cancel and not cancel.is_set():
+            self.update_progress(fraction)
+        return False
+
+    def finish_export(self, cancel, error):
+        if cancel is self.export_cancel:
+            self.export_cancel = None
+            if not cancel.is_set():
+                self.hide_progress()
+        if error:
+            print("Export error:", error)
+        return False
+
     def on_cut_clicked(self, btn): 
-        self.exec_js("document.execCommand('cut')")
+        self.run_command("exec", "cut")
     
     def on_copy_clicked(self, btn): 
-        self.exec_js("document.execCommand('copy')")
+        self.run_command("exec", "copy")
     
     def on_paste_clicked(self, btn):
+        self.paste_clipboard()
+
+    def paste_clipboard(self, data=None):
+        # Both the button and native pastes in the page end up here. The
+        # clipboard is read asynchronously, HTML is sanitized in a thread
+        # and the result is inserted in chunks by a PasteJob.
+        doc = self.active_doc
+        if doc is None or doc.webview is None or self.paste_job is not None:
+            return
         clipboard = Gdk.Display.get_default().get_clipboard()
-        clipboard.read_text_async(None, self.on_text_received, None)
-    
-    def on_text_received(self, clipboard, result, user_data):
+        formats = clipboard.get_formats()
+        if formats.contain_mime_type("text/html"):
+            clipboard.read_async(["text/html"], GLib.PRIORITY_DEFAULT, None, self.on_html_received, doc)
+        elif formats.contain_gtype(Gdk.Texture):
+            clipboard.read_texture_async(None, self.on_texture_received, doc)
+        else:
+            clipboard.read_text_async(None, self.on_text_received, doc)
+
+    def on_html_received(self, clipboard, result, doc):
+        try:
+            stream, mime_type = clipboard.read_finish(result)
+        except GLib.Error as e:
+            print("Paste error:", e.message)
+            return
+        output = Gio.MemoryOutputStream.new_resizable()
+        def on_spliced(output, result, user_data):
+            try:
+                output.splice_finish(result)
+            except GLib.Error as e:
+                print("Paste error:", e.message)
+                return
+            data = output.steal_as_bytes().get_data()
+            self.prepare_paste(doc, lambda: sanitize_clipboard_html(decode_clipboard_html(data)))
+        output.splice_async(stream, Gio.OutputStreamSpliceFlags.CLOSE_SOURCE | Gio.OutputStreamSpliceFlags.CLOSE_TARGET,
+                            GLib.PRIORITY_DEFAULT, None, on_spliced, None)
+
+    def on_texture_received(self, clipboard, result, doc):
+        try:
+            texture = clipboard.read_texture_finish(result)
+        except GLib.Error as e:
+            print("Paste error:", e.message)
+            return
+        if texture:
+            data = texture.save_to_png_bytes().get_data()
+            self.insert_image(doc, lambda store: store.put_bytes(data, ".png"))
+
+    def on_text_received(self, clipboard, result, doc):
         try:
             text = clipboard.read_text_finish(result)
-            if text:
-                text_json = json.dumps(text)
-                self.exec_js(f"document.execCommand('insertText', false, {text_json})")
         except GLib.Error as e:
             print("Paste error:", e.message)
+            return
+        if text:
+            self.prepare_paste(doc, lambda: clipboard_text_to_html(text))
+
+    def prepare_paste(self, doc, convert):
+        def convert_thread():
+            inline, chunks = convert()
+            GLib.idle_add(self.start_paste, doc, inline, chunks)
+        threading.Thread(target=convert_thread, daemon=True).start()
+
+    def start_paste(self, doc, inline, chunks):
+        if not chunks or doc.webview is None or self.paste_job is not None:
+            return False
+        total = sum(len(chunk) for chunk in chunks)
+        show = total > PASTE_PROGRESS_THRESHOLD and self.loading_doc is None
+        def on_done(job):
+            self.paste_job = None
+            if show:
+                self.hide_progress()
+        job = PasteJob(doc.webview, inline, chunks, self.update_progress if show else None, on_done)
+        self.paste_job = job
+        if show:
+            self.show_progress("Pasting", job.cancel)
+        job.start()
+        return False
     
+    def on_insert_image_clicked(self, btn):
+        dialog = Gtk.FileDialog()
+        dialog.set_title("Insert Image")
+        image_filter = Gtk.FileFilter()
+        image_filter.set_name("Images")
+        image_filter.add_pixbuf_formats()
+        filters = Gio.ListStore.new(Gtk.FileFilter)
+        filters.append(image_filter)
+        dialog.set_filters(filters)
+        dialog.open(self, None, self.on_image_chosen, self.active_doc)
+
+    def on_image_chosen(self, dialog, result, doc):
+        try:
+            file = dialog.open_finish(result)
+        except GLib.Error as e:
+            print("Image error:", e.message)
+            return
+        path = file.get_path() if file else None
+        if path:
+            self.insert_image(doc, lambda store: store.put_file(path))
+
+    def insert_image(self, doc, put):
+        # Hashing and copying into the store happens off the main thread
+        store = self.get_application().blob_store
+        def store_thread():
+            try:
+                name = put(store)
+                width, height = store.size(store.path(name))
+            except (OSError, GLib.Error) as e:
+                print("Image error:", e)
+                return
+            GLib.idle_add(finish, name, width, height)
+        def finish(name, width, height):
+            if doc.bridge:
+                doc.bridge.send("insertImage", store.uri(name), width, height)
+            return False
+        threading.Thread(target=store_thread, daemon=True).start()
+
     def on_undo_clicked(self, btn): 
-        self.exec_js("document.execCommand('undo')")
+        self.run_command("undo")
     
     def on_redo_clicked(self, btn): 
-        self.exec_js("document.execCommand('redo')")
+        self.run_command("redo")
     
+    def on_library_shortcut(self, widget, args):
+        self.on_library_clicked()
+        return True
+
+    def on_library_clicked(self, btn=None):
+        app = self.get_application()
+        palette = LibraryPalette(app.get_library(), self.open_library_hit, self.choose_library_folder,
+                                 transient_for=self)
+        palette.present()
+
+    def choose_library_folder(self, palette):
+        def on_chosen(dialog, result):
+            try:
+                folder = dialog.select_folder_finish(result)
+            except GLib.Error:
+                return
+            if folder and folder.get_path():
+                self.get_application().set_library_folder(folder.get_path())
+                palette.update_status()
+        dialog = Gtk.FileDialog(title="Choose Library Folder")
+        dialog.select_folder(palette, None, on_chosen)
+
+    def open_library_hit(self, path, term):
+        # The document opens, or comes to the front, with the hit found
+        file = Gio.File.new_for_path(path)
+        doc = next((doc for doc in self.documents.values()
+                    if doc.current_file and doc.current_file.equal(file)), None)
+        if doc is None:
+            doc = self.open_file(file)
+            if doc:
+                doc.pending_find = term
+        elif doc.webview and not doc.webview.is_loading():
+            self.tab_view.set_selected_page(doc.page)
+            self.find_text(term)
+        else:
+            doc.pending_find = term
+            self.tab_view.set_selected_page(doc.page)
+
+    def find_text(self, text):
+        self.on_find_clicked(None)
+        self.find_entry.set_text(text)
+
     def on_find_clicked(self, btn):
-        dialog = Adw.MessageDialog(
-            transient_for=self,
-            heading="Find",
-            body="Enter search term",
-            close_response="cancel",
-            modal=True
-        )
-        entry = Gtk.Entry()
-        dialog.set_extra_child(entry)
-        dialog.add_response("cancel", "Cancel")
-        dialog.add_response("find", "Find")
-        dialog.set_response_appearance("find", Adw.ResponseAppearance.SUGGESTED)
-        
-        def on_response(dialog, response):
-            if response == "find":
-                search_term = entry.get_text()
-                if search_term:
-                    script = f"""
-                        (function() {{
-                            console.log('Find script running with term: ' + {json.dumps(search_term)});
-                            const highlights = document.querySelectorAll('span.wiziwig-highlight');
-                            highlights.forEach(span => {{
-                                const parent = span.parentNode;
-                                while (span.firstChild) {{
-                                    parent.insertBefore(span.firstChild, span);
-                                }}
-                                parent.removeChild(span);
-                                parent.normalize();
-                            }});
-                            const walker = document.createTreeWalker(
-                                document.body,
-                                NodeFilter.SHOW_TEXT,
-                                {{ acceptNode: node => 
-                                    (node.parentNode.tagName !== 'SCRIPT' && 
-                                     node.parentNode.tagName !== 'STYLE' && 
-                                     node.nodeValue.trim()) 
-                                    ? NodeFilter.FILTER_ACCEPT 
-                                    : NodeFilter.FILTER_REJECT 
-                                }}
-                            );
-                            const textNodes = [];
-                            let node;
-                            while ((node = walker.nextNode())) {{
-                                textNodes.push(node);
-                            }}
-                            const regex = new RegExp({json.dumps(search_term)}, 'gi');
-                            textNodes.forEach(node => {{
-                                const text = node.nodeValue;
-                                const matches = [...text.matchAll(regex)];
-                                if (matches.length === 0) return;
-                                const fragment = document.createDocumentFragment();
-                                let lastIndex = 0;
-                                matches.forEach(match => {{
-                                    const start = match.index;
-                                    const matchText = match[0];
-                                    if (start > lastIndex) {{
-                                        fragment.appendChild(document.createTextNode(
-                                            text.slice(lastIndex, start)
-                                        ));
-                                    }}
-                                    const span = document.createElement('span');
-                                    span.className = 'wiziwig-highlight';
-                                    span.style.backgroundColor = 'yellow';
-                                    span.textContent = matchText;
-                                    fragment.appendChild(span);
-                                    lastIndex = start + matchText.length;
-                                }});
-                                if (lastIndex < text.length) {{
-                                    fragment.appendChild(document.createTextNode(
-                                        text.slice(lastIndex)
-                                    ));
-                                }}
-                                node.parentNode.replaceChild(fragment, node);
-                            }});
-                            console.log('Find script completed');
-                        }})();
-                    """
-                    print(f"Executing find script for term: '{search_term}'")
-                    self.exec_js(script)
-            dialog.destroy()
-        
-        dialog.connect("response", on_response)
-        dialog.present()
+        self.replace_box.set_visible(False)
+        self.find_bar.set_search_mode(True)
+        self.find_entry.grab_focus()
+        self.find_entry.select_region(0, -1)
+
+    def close_find_bar(self):
+        self.find_bar.set_search_mode(False)
+        self.clear_find()
+        self.webview.grab_focus()
+
+    def clear_find(self):
+        self.find_count_label.set_text("")
+        if self.find_fallback:
+            self.webview.get_find_controller().search_finish()
+        self.document.bridge.send("findClear")
+
+    def on_find_changed(self, *args):
+        text = self.find_entry.get_text()
+        if not text:
+            self.clear_find()
+            return
+        self.find_seq += 1
+        options = {
+            "seq": self.find_seq,
+            "text": text,
+            "regex": self.find_regex_btn.get_active(),
+            "caseSensitive": self.find_case_btn.get_active(),
+            "budget": FIND_REGEX_BUDGET_MS,
+        }
+        script = f"wiziwig.find.search({json.dumps(options)})"
+        self.webview.evaluate_javascript(script, -1, None, None, None, self.on_find_started, options)
+
+    def on_find_started(self, webview, result, options):
+        try:
+            supported = webview.evaluate_javascript_finish(result).to_boolean()
+        except GLib.Error as e:
+            print("Find error:", e.message)
+            return
+        self.find_fallback = not supported
+        if supported:
+            return
+        # No CSS Custom Highlight API in this WebKit: plain text only.
+        if options["regex"]:
+            self.find_count_label.set_text("Regex unsupported")
+            return
+        flags = WebKit.FindOptions.WRAP_AROUND
+        if not options["caseSensitive"]:
+            flags |= WebKit.FindOptions.CASE_INSENSITIVE
+        find_controller = webview.get_find_controller()
+        find_controller.count_matches(options["text"], flags, GLib.MAXUINT32)
+        find_controller.search(options["text"], flags, GLib.MAXUINT32)
+
+    def on_find_step(self, delta):
+        if self.find_fallback:
+            find_controller = self.webview.get_find_controller()
+            if delta > 0:
+                find_controller.search_next()
+            else:
+                find_controller.search_previous()
+            return
+        self.document.bridge.send("findStep", int(delta))
+
+    def on_find_message(self, state):
+        if state["seq"] != self.find_seq:
+            return
+        if state.get("error"):
+            self.find_count_label.set_text(state["error"])
+        elif state["count"] == 0:
+            self.find_count_label.set_text("No matches")
+        else:
+            more = "+" if state["limited"] else ""
+            self.find_count_label.set_text(f"{state['current'] + 1} of {state['count']}{more}")
+
+    def on_find_counted_matches(self, find_controller, count):
+        self.find_count_label.set_text(f"{count} matches" if count else "No matches")
+
+    def on_find_failed(self, find_controller):
+        self.find_count_label.set_text("No matches")
     
     def on_replace_clicked(self, btn):
-        dialog = Adw.MessageDialog(
-            transient_for=self,
-            heading="Replace",
-            body="Enter search and replacement terms",
-            close_response="cancel",
-            modal=True
-        )
-        search_entry = Gtk.Entry(placeholder_text="Search term")
-        replace_entry = Gtk.Entry(placeholder_text="Replace with")
-        content = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=10)
-        content.append(search_entry)
-        content.append(replace_entry)
-        dialog.set_extra_child(content)
-        dialog.add_response("cancel", "Cancel")
-        dialog.add_response("replace", "Replace All")
-        dialog.set_response_appearance("replace", Adw.ResponseAppearance.SUGGESTED)
-        
-        def on_response(dialog, response):
-            if response == "replace":
-                search = search_entry.get_text()
-                replacement = replace_entry.get_text()
-                if search and replacement:
-                    script = f"""
-                        (function() {{
-                            let search = {json.dumps(search)};
-                            let replace = {json.dumps(replacement)};
-                            let regex = new RegExp(search, 'gi');
-                            document.body.innerHTML = document.body.innerHTML.replace(regex, replace);
-                        }})();
-                    """
-                    self.exec_js(script)
-            dialog.destroy()
-        
-        dialog.connect("response", on_response)
-        dialog.present()
+        self.replace_box.set_visible(True)
+        self.find_bar.set_search_mode(True)
+        self.find_entry.grab_focus()
+        self.find_entry.select_region(0, -1)
+
+    def on_replace_all_clicked(self, *args):
+        search = self.find_entry.get_text()
+        if search:
+            self.replace_all(search, self.replace_entry.get_text(),
+                             self.find_regex_btn.get_active(), self.find_case_btn.get_active())
+
+    def replace_all(self, search, replacement, regex=False, case_sensitive=True):
+        self.find_seq += 1
+        options = {
+            "seq": self.find_seq,
+            "text": search,
+            "replacement": replacement,
+            "regex": regex,
+            "caseSensitive": case_sensitive,
+            "budget": FIND_REGEX_BUDGET_MS,
+        }
+        self.run_command("replaceAll", options)
+
+    def on_replace_message(self, state):
+        if state["seq"] != self.find_seq:
+            return
+        if state.get("error"):
+            self.find_count_label.set_text(state["error"])
+        elif state.get("finished"):
+            self.find_count_label.set_text(f"{state['count']} replaced")
+        else:
+            self.find_count_label.set_text(f"Replacing {state['done']}/{state['total']}")
     
     def replace_text(self, search, replacement):
-        script = f"""document.body.innerHTML = document.body.innerHTML.split({json.dumps(search)}).join({json.dumps(replacement)});"""
-        self.exec_js(script)
+        self.replace_all(search, replacement)
     
     def on_zoom_changed(self, dropdown, *args):
         selected_item = dropdown.get_selected_item()
         if selected_item:
             try:
-                zoom_level = int(selected_item.get_string().rstrip('%')) / 100.0
-                self.webview.set_zoom_level(zoom_level)
+                self.zoom_level = int(selected_item.get_string().rstrip('%')) / 100.0
+                for doc in self.live_documents():
+                    doc.webview.set_zoom_level(self.zoom_level)
             except ValueError:
                 pass
     
     def on_bold_toggled(self, btn):
-        self.exec_js("document.execCommand('bold')")
+        self.run_command("exec", "bold")
         self.webview.grab_focus()
 
     def on_italic_toggled(self, btn):
-        self.exec_js("document.execCommand('italic')")
+        self.run_command("exec", "italic")
         self.webview.grab_focus()
 
     def on_underline_toggled(self, btn):
-        self.exec_js("document.execCommand('underline')")
+        self.run_command("exec", "underline")
         self.webview.grab_focus()
 
     def on_strikethrough_toggled(self, btn):
-        self.exec_js("document.execCommand('strikethrough')")
+        self.run_command("exec", "strikethrough")
         self.webview.grab_focus()
 
     def on_bullet_list_toggled(self, btn):
         if btn.get_active():
             if self.number_btn.get_active():
-                self.exec_js("document.execCommand('insertOrderedList')")
+                self.run_command("exec", "insertOrderedList")
                 self.number_btn.set_active(False)
-            self.exec_js("document.execCommand('insertUnorderedList')")
+            self.run_command("exec", "insertUnorderedList")
         else:
-            self.exec_js("document.execCommand('insertUnorderedList')")
+            self.run_command("exec", "insertUnorderedList")
         self.webview.grab_focus()
 
     def on_number_list_toggled(self, btn):
         if btn.get_active():
             if self.bullet_btn.get_active():
-                self.exec_js("document.execCommand('insertUnorderedList')")
+                self.run_command("exec", "insertUnorderedList")
                 self.bullet_btn.set_active(False)
-            self.exec_js("document.execCommand('insertOrderedList')")
+            self.run_command("exec", "insertOrderedList")
         else:
-            self.exec_js("document.execCommand('insertOrderedList')")
+            self.run_command("exec", "insertOrderedList")
         self.webview.grab_focus()
 
     def on_heading_changed(self, dropdown, *args):
         headings = ["div", "h1", "h2", "h3", "h4", "h5", "h6"]
         selected = dropdown.get_selected()
         if 0 <= selected < len(headings):
-            self.exec_js(f"document.execCommand('formatBlock', false, '{headings[selected]}')")
+            self.run_command("exec", "formatBlock", headings[selected])
     
     def on_align_left(self, *args): 
-        self.exec_js("document.execCommand('justifyLeft')")
+        self.run_command("exec", "justifyLeft")
     
     def on_align_center(self, *args): 
-        self.exec_js("document.execCommand('justifyCenter')")
+        self.run_command("exec", "justifyCenter")
     
     def on_align_right(self, *args): 
-        self.exec_js("document.execCommand('justifyRight')")
+        self.run_command("exec", "justifyRight")
     
     def on_align_justify(self, *args): 
-        self.exec_js("document.execCommand('justifyFull')")
+        self.run_command("exec", "justifyFull")
     
     def on_indent_more(self, *args): 
-        self.exec_js("document.execCommand('indent')")
+        self.run_command("exec", "indent")
     
     def on_indent_less(self, *args): 
-        self.exec_js("document.execCommand('outdent')")
+        self.run_command("exec", "outdent")
     
-    def on_font_family_changed(self, dropdown, *args):
-        if item := dropdown.get_selected_item():
-            font_family = item.get_string()
-            script = """
-                (function() {
-                    let selection = window.getSelection();
-                    if (!selection.rangeCount) return;
-                    let range = selection.getRangeAt(0);
-                    let ancestor = range.commonAncestorContainer;
-                    let spans = (ancestor.nodeType === 1) 
-                        ? ancestor.querySelectorAll('span[style*="font-family"]') 
-                        : ancestor.parentElement.querySelectorAll('span[style*="font-family"]');
-                    if (spans.length > 0 && range.toString().length > 0) {
-                        let updated = false;
-                        spans.forEach(span => {
-                            if (range.intersectsNode(span)) {
-                                span.style.fontFamily = '""" + font_family + """';
-                                updated = true;
-                            }
-                        });
-                        if (updated) {
-                            let newRange = document.createRange();
-                            newRange.setStart(range.startContainer, range.startOffset);
-                            newRange.setEnd(range.endContainer, range.endOffset);
-                            selection.removeAllRanges();
-                            selection.addRange(newRange);
-                            return;
-                        }
-                    }
-                    let contents = range.extractContents();
-                    if (!contents.hasChildNodes()) {
-                        range.insertNode(contents);
-                        return;
-                    }
-                    let span = document.createElement('span');
-                    span.style.fontFamily = '""" + font_family + """';
-                    span.appendChild(contents);
-                    range.insertNode(span);
-                    let newRange = document.createRange();
-                    newRange.selectNodeContents(span);
-                    selection.removeAllRanges();
-                    selection.addRange(newRange);
-                })();
-            """
-            self.exec_js(script)
+    def on_font_family_chosen(self, family):
+        self.run_command("fontFamily", family)
     
     def on_font_size_changed(self, dropdown, *args):
         if item := dropdown.get_selected_item():
-            size_pt = item.get_string()
-            script = """
-                (function() {
-                    let selection = window.getSelection();
-                    if (!selection.rangeCount) return;
-                    let range = selection.getRangeAt(0);
-                    let content = range.extractContents();
-                    let span = document.createElement('span');
-                    span.style.fontSize = '""" + size_pt + """pt';
-                    let tempElement = document.createElement('div');
-                    tempElement.appendChild(content);
-                    let fontSizeSpans = tempElement.querySelectorAll('span[style*="font-size"]');
-                    for (let oldSpan of fontSizeSpans) {
-                        while (oldSpan.firstChild) {
-                            oldSpan.parentNode.insertBefore(oldSpan.firstChild, oldSpan);
-                        }
-                        oldSpan.parentNode.removeChild(oldSpan);
-                    }
-                    while (tempElement.firstChild) {
-                        span.appendChild(tempElement.firstChild);
-                    }
-                    range.insertNode(span);
-                    selection.removeAllRanges();
-                    let newRange = document.createRange();
-                    newRange.selectNodeContents(span);
-                    selection.addRange(newRange);
-                })();
-            """
-            self.exec_js(script)
+            self.run_command("fontSize", item.get_string())
     
     def on_text_color_set(self, btn):
         color = btn.get_rgba().to_string()
-        self.exec_js(f"document.execCommand('foreColor', false, '{color}')")
+        self.run_command("exec", "foreColor", color)
     
     def on_bg_color_set(self, btn):
         color = btn.get_rgba().to_string()
-        self.exec_js(f"document.execCommand('backColor', false, '{color}')")
+        self.run_command("exec", "backColor", color)
     
     def open_file_dialog(self):
         file_dialog = Gtk.FileDialog.new()
@@ -845,49 +7435,236 @@ class EditorWindow(Adw.ApplicationWindow):
     
     def create_file_filter(self):
         file_filter = Gtk.FileFilter()
-        file_filter.set_name("HTML Files (*.html, *.htm)")
+        file_filter.set_name("Documents (*.html, *.htm, *.md)")
         file_filter.add_pattern("*.html")
         file_filter.add_pattern("*.htm")
+        file_filter.add_pattern("*.md")
+        file_filter.add_pattern("*.markdown")
         return file_filter
     
     def on_open_file_dialog_response(self, dialog, result):
         try:
             file = dialog.open_finish(result)
             if file:
-                file.load_contents_async(None, self.load_callback)
+                self.open_file(file)
         except GLib.Error as e:
             print("Open error:", e.message)
     
-    def load_callback(self, file, result):
+    def open_file(self, file):
+        path = file.get_path()
+        if path is not None:
+            try:
+                size = os.path.getsize(path)
+            except OSError as e:
+                print("Open error:", e)
+                return None
+        doc = self.document_for_open()
+        doc.pristine = False
+        if path is None:
+            # Remote (gvfs) locations cannot be streamed through the scheme
+            file.load_contents_async(None, self.load_callback, doc)
+            return doc
+        doc.set_file(file)
+        doc.disk_stamp = file_stamp(path)
+        if size > LARGE_FILE_THRESHOLD:
+            self.loading_doc = doc
+            self.show_progress(f"Loading {file.get_basename()}", lambda: self.cancel_streaming_load(doc))
+        self.get_application().load_document(doc.webview, path)
+        return doc
+    
+    def cancel_streaming_load(self, doc):
+        # A partially loaded document must never be saved over the original.
+        self.loading_doc = None
+        if doc.webview is None:
+            return
+        doc.webview.stop_loading()
+        doc.set_file(None)
+        doc.webview.load_html(self.initial_html, "file:///")
+    
+    def load_callback(self, file, result, doc):
         try:
             ok, content, _ = file.load_contents_finish(result)
-            if ok:
-                self.webview.load_html(content.decode(), file.get_uri())
+            if ok and doc.webview:
+                doc.set_file(file)
+                html = content.decode(errors="replace")
+                if is_markdown(file.get_basename() or ""):
+                    html = "".join(markdown_to_html([html], os.path.splitext(file.get_basename())[0]))
+                doc.webview.load_html(html, file.get_uri())
         except GLib.Error as e:
             print("Load error:", e.message)
     
-    def save_callback(self, dialog, result):
+    def save_callback(self, dialog, result, doc):
         try:
             file = dialog.save_finish(result)
-            self.webview.evaluate_javascript("document.documentElement.outerHTML", -1, None, None, None, self.save_html_callback, file)
+            if doc.saver:
+                self.save_document(doc, file, ask=True)
         except GLib.Error as e:
+            doc.close_after_save = False
             print("Save error:", e.message)
     
-    def save_html_callback(self, webview, result, file):
-        try:
-            js_value = webview.evaluate_javascript_finish(result)
-            if js_value:
-                html = js_value.to_string()
-                file.replace_contents_bytes_async(GLib.Bytes.new(html.encode()), None, False, Gio.FileCreateFlags.REPLACE_DESTINATION, None, self.final_save_callback)
-        except GLib.Error as e:
-            print("HTML save error:", e.message)
-    
-    def final_save_callback(self, file, result):
+    def final_save_callback(self, file, error, doc):
+        if error:
+            doc.close_after_save = False
+            print("Final save error:", error)
+            return
+        doc.set_file(file)
+        doc.loaded_clean = True
+        print("File saved successfully to", file.get_path())
+        # The saved file becomes the new journal base
+        doc.journal.discard()
+        doc.remove_hibernation_file()
+        if file.get_path():
+            doc.disk_stamp = file_stamp(file.get_path())
+        self.set_external_state(doc, None)
+        if doc.webview:
+            self.start_journal(doc)
+            doc.bridge.send("externalBaseline", True)
+            self.watch_file(doc)
+        if doc.external_pending:
+            self.schedule_external_check(doc)
+        if doc.close_after_save:
+            doc.close_after_save = False
+            if doc.page in self.documents:
+                self.tab_view.close_page(doc.page)
+
+    def watch_file(self, doc):
+        path = doc.current_file.get_path() if doc.current_file else None
+        if path == doc.monitored_path:
+            return
+        self.unwatch_file(doc)
+        if path is None:
+            return
         try:
-            file.replace_contents_finish(result)
-            print("File saved successfully to", file.get_path())
+            doc.monitor = doc.current_file.monitor_file(Gio.FileMonitorFlags.NONE, None)
         except GLib.Error as e:
-            print("Final save error:", e.message)
+            print("Monitor error:", e.message)
+            return
+        doc.monitored_path = path
+        doc.monitor.connect("changed", self.on_file_changed, doc)
+
+    def unwatch_file(self, doc):
+        if doc.monitor:
+            doc.monitor.cancel()
+        doc.monitor = None
+        doc.monitored_path = None
+        if doc.external_check_id:
+            GLib.source_remove(doc.external_check_id)
+            doc.external_check_id = 0
+
+    def on_file_changed(self, monitor, file, other_file, event, doc):
+        if event in (Gio.FileMonitorEvent.CHANGES_DONE_HINT, Gio.FileMonitorEvent.CREATED,
+                     Gio.FileMonitorEvent.DELETED):
+            self.schedule_external_check(doc)
+
+    def schedule_external_check(self, doc):
+        if doc.external_check_id:
+            GLib.source_remove(doc.external_check_id)
+        doc.external_check_id = GLib.timeout_add(EXTERNAL_CHECK_DELAY_MS, self.check_external_change, doc)
+
+    def check_external_change(self, doc):
+        doc.external_check_id = 0
+        path = doc.monitored_path
+        if path is None or doc.page not in self.documents:
+            return False
+        stamp = file_stamp(path)
+        if stamp == doc.disk_stamp:
+            return False  # our own save, or a touch without new content
+        if doc.webview is None or doc.saver.busy or doc.webview.is_loading():
+            # Checked again once the page is ready or the save has finished
+            doc.external_pending = True
+            return False
+        doc.external_pending = False
+        if stamp is None:
+            doc.disk_stamp = None
+            self.set_external_state(doc, "deleted")
+            return False
+
+        def read_thread():
+            try:
+                with open(path, encoding="utf-8", errors="replace") as f:
+                    chunks = list(iter(lambda: f.read(PASTE_CHUNK_CHARS), ""))
+                if is_markdown(path):
+                    html = "".join(markdown_to_html(chunks))
+                    chunks = [html[i:i + PASTE_CHUNK_CHARS] for i in range(0, len(html), PASTE_CHUNK_CHARS)]
+            except OSError as e:
+                print("Reload error:", e)
+                chunks = None
+            except Exception as e:
+                print("Reload error:", repr(e))
+                chunks = None
+            GLib.idle_add(self.apply_external_change, doc, path, stamp, chunks)
+        threading.Thread(target=read_thread, daemon=True).start()
+        return False
+
+    def apply_external_change(self, doc, path, stamp, chunks):
+        # The file goes to the page in chunks; the page diffs it against its
+        # blocks and applies the changes that do not touch unsaved edits.
+        webview = doc.webview
+        if chunks is None or webview is None or path != doc.monitored_path:
+            return False
+
+        def on_received(webview, result, index):
+            try:
+                webview.evaluate_javascript_finish(result)
+            except GLib.Error as e:
+                print("Reload error:", e.message)
+                return
+            send(index + 1)
+
+        def on_applied(webview, result, user_data):
+            try:
+                outcome = json.loads(webview.evaluate_javascript_finish(result).to_string())
+            except (GLib.Error, ValueError) as e:
+                print("Reload error:", e)
+                return
+            if webview is not doc.webview:
+                return
+            doc.disk_stamp = stamp
+            doc.bridge.send("virtualize", self.config["virtualize_above_blocks"])
+            doc.external_conflicts = outcome["conflicts"]
+            self.set_external_state(doc, "conflict" if outcome["conflicts"] else None)
+
+        def send(index):
+            if webview is not doc.webview:
+                return
+            if index < len(chunks):
+                webview.evaluate_javascript(f"wiziwig.external.receive({json.dumps(chunks[index])})",
+                                            -1, None, None, None, on_received, index)
+            else:
+                webview.evaluate_javascript("JSON.stringify(wiziwig.external.apply())",
+                                            -1, None, None, None, on_applied, None)
+        send(0)
+        return False
+
+    def set_external_state(self, doc, state):
+        doc.external_state = state
+        if doc is self.active_doc:
+            self.update_external_bar()
+
+    def update_external_bar(self):
+        doc = self.active_doc
+        state = doc.external_state if doc else None
+        if state == "conflict":
+            n = doc.external_conflicts
+            places = "place" if n == 1 else "places"
+            self.external_label.set_text(f"“{doc.title()}” changed on disk. Changes in {n} {places} "
+                                         "touching your unsaved edits were held back.")
+        elif state == "deleted":
+            self.external_label.set_text(f"“{doc.title()}” was deleted or moved on disk. "
+                                         "Saving will write it again.")
+        self.external_use_disk_btn.set_visible(state == "conflict")
+        self.external_keep_btn.set_label("Keep Mine" if state == "conflict" else "Dismiss")
+        self.external_bar.set_reveal_child(state is not None)
+
+    def on_external_resolve(self, btn, use_disk):
+        doc = self.active_doc
+        if doc is None:
+            return
+        if doc.external_state == "conflict" and doc.bridge:
+            doc.bridge.send("externalResolve", use_disk)
+            if use_disk:
+                doc.bridge.send("virtualize", self.config["virtualize_above_blocks"])
+        self.set_external_state(doc, None)
     
     def add_css_styles(self):
         provider = Gtk.CssProvider()
@@ -895,9 +7672,306 @@ class EditorWindow(Adw.ApplicationWindow):
         Gtk.StyleContext.add_provider_for_display(self.get_display(), provider, Gtk.STYLE_PROVIDER_PRIORITY_APPLICATION)
     
     def on_close_request(self, *args):
+        # Every tab is asked whether it has unsaved changes first; the window
+        # closes from on_close_checked once the user has confirmed.
+        if not self.close_confirmed:
+            if not self.close_checking:
+                self.close_checking = True
+                docs = list(self.documents.values())
+                results = []
+                def on_checked(doc, modified):
+                    results.append((doc, modified))
+                    if len(results) == len(docs):
+                        self.on_close_checked([doc for doc, modified in results if modified])
+                for doc in docs:
+                    self.check_modified(doc, lambda modified, doc=doc: on_checked(doc, modified))
+                if not docs:
+                    self.on_close_checked([])
+            return True
+        for doc in self.documents.values():
+            doc.journal.discard()
+            doc.remove_hibernation_file()
+            doc.remove_pdf_cache()
+        Journal.writer.close()
+        if self.export_cancel:
+            self.export_cancel.set()
+        if profiler:
+            profiler.dump()
         self.get_application().quit()
         return False
 
+    def on_close_checked(self, modified):
+        self.close_checking = False
+        if not modified:
+            self.close_confirmed = True
+            self.close()
+            return
+        if len(modified) == 1:
+            body = f"“{modified[0].title()}” has unsaved changes."
+        else:
+            body = f"{len(modified)} documents have unsaved changes."
+        dialog = Adw.MessageDialog(
+            transient_for=self,
+            heading="Discard Unsaved Changes?",
+            body=body + " Changes which are not saved will be permanently lost.",
+            close_response="cancel",
+            modal=True
+        )
+        dialog.add_response("cancel", "Cancel")
+        dialog.add_response("discard", "Discard All")
+        dialog.set_default_response("cancel")
+        dialog.set_response_appearance("discard", Adw.ResponseAppearance.DESTRUCTIVE)
+
+        def on_response(dialog, response):
+            dialog.destroy()
+            if response == "discard":
+                self.close_confirmed = True
+                self.close()
+            elif modified[0].page in self.documents:
+                # Show the first one so it can be saved
+                self.tab_view.set_selected_page(modified[0].page)
+        dialog.connect("response", on_response)
+        dialog.present()
+
+# Headless conversion: `wiziwig --convert` feeds documents to worker
+# processes, each rendering them one after another in a single web view.
+CONVERT_VIEW_WIDTH = 1024
+CONVERT_VIEW_HEIGHT = 1366
+CONVERT_THUMBNAIL_WIDTH = 256
+CONVERT_TIMEOUT = 120
+
+class ConvertWorker:
+    """Renders documents to PDF and PNG in one reused web view.
+
+    Jobs arrive as JSON lines on stdin and one result line per job is
+    written back, so the parent can keep several workers busy. GTK 4 has no
+    offscreen windows; the view lives in an ordinary window, so workers
+    need a display, virtual or not."""
+
+    def __init__(self, loop, results):
+        self.loop = loop
+        self.results = results
+        self.exit_code = 0
+        self.webview = WebKit.WebView()
+        # Saved documents are static, nothing in them needs to run
+        self.webview.get_settings().set_enable_javascript(False)
+        self.webview.connect("load-changed", self.on_load_changed)
+        self.webview.connect("load-failed", self.on_load_failed)
+        self.window = Gtk.Window(default_width=CONVERT_VIEW_WIDTH, default_height=CONVERT_VIEW_HEIGHT)
+        self.window.set_child(self.webview)
+        self.window.present()
+        self.job = None
+        self.timeout_id = 0
+
+    def read_jobs(self):
+        for line in sys.stdin:
+            if line.strip():
+                GLib.idle_add(self.start, json.loads(line))
+        GLib.idle_add(self.loop.quit)
+
+    def start(self, job):
+        self.job = job
+        self.result = {"input": job["input"], "ok": False, "worker": os.getpid()}
+        self.started = self.phase_started = time.monotonic()
+        self.timeout_id = GLib.timeout_add_seconds(job.get("timeout", CONVERT_TIMEOUT), self.on_timeout)
+        self.webview.load_uri(Gio.File.new_for_path(job["input"]).get_uri())
+        return False
+
+    def phase_done(self, phase):
+        now = time.monotonic()
+        self.result[f"{phase}_ms"] = round((now - self.phase_started) * 1000, 1)
+        self.phase_started = now
+
+    def finish(self, error=None):
+        if self.timeout_id:
+            GLib.source_remove(self.timeout_id)
+            self.timeout_id = 0
+        self.result["total_ms"] = round((time.monotonic() - self.started) * 1000, 1)
+        self.result["ok"] = error is None
+        if error:
+            self.result["error"] = error
+        self.job = None
+        self.results.write(json.dumps(self.result) + "\n")
+        self.results.flush()
+
+    def on_timeout(self):
+        self.timeout_id = 0
+        # The view may still be busy with this document, so this worker
+        # stops and the parent starts a fresh one.
+        self.result["restart"] = True
+        self.finish("timed out")
+        self.exit_code = 1
+        self.loop.quit()
+        return False
+
+    def on_load_failed(self, webview, event, uri, error):
+        if self.job:
+            self.finish(f"load failed: {error.message}")
+        return True
+
+    def on_load_changed(self, webview, event):
+        if event == WebKit.LoadEvent.FINISHED and self.job:
+            self.phase_done("load")
+            self.print_pdf()
+
+    def print_pdf(self):
+        if not self.job.get("pdf"):
+            self.snapshot_png()
+            return
+        settings = Gtk.PrintSettings()
+        settings.set_printer("Print to File")
+        settings.set(Gtk.PRINT_SETTINGS_OUTPUT_FILE_FORMAT, "pdf")
+        settings.set(Gtk.PRINT_SETTINGS_OUTPUT_URI, Gio.File.new_for_path(self.job["pdf"]).get_uri())
+        self.print_error = None
+        operation = WebKit.PrintOperation.new(self.webview)
+        operation.set_print_settings(settings)
+        operation.connect("failed", self.on_print_failed)
+        operation.connect("finished", self.on_printed)
+        self.operation = operation
+        operation.print()
+
+    def on_print_failed(self, operation, error):
+        self.print_error = error.message
+
+    def on_printed(self, operation):
+        self.operation = None
+        if not self.job:
+            return
+        if self.print_error:
+            self.finish(f"print failed: {self.print_error}")
+            return
+        self.phase_done("pdf")
+        self.result["pdf"] = self.job["pdf"]
+        self.snapshot_png()
+
+    def snapshot_png(self):
+        if not self.job.get("png"):
+            self.finish()
+            return
+        self.webview.get_snapshot(WebKit.SnapshotRegion.VISIBLE, WebKit.SnapshotOptions.NONE, None,
+                                  self.on_snapshot, None)
+
+    def on_snapshot(self, webview, result, user_data):
+        if not self.job:
+            return
+        try:
+            texture = webview.get_snapshot_finish(result)
+            loader = GdkPixbuf.PixbufLoader()
+            loader.write_bytes(texture.save_to_png_bytes())
+            loader.close()
+            pixbuf = loader.get_pixbuf()
+            width = self.job.get("thumbnail_width", CONVERT_THUMBNAIL_WIDTH)
+            if pixbuf.get_width() > width:
+                height = max(1, round(pixbuf.get_height() * width / pixbuf.get_width()))
+                pixbuf = pixbuf.scale_simple(width, height, GdkPixbuf.InterpType.BILINEAR)
+            pixbuf.savev(self.job["png"], "png", [], [])
+        except GLib.Error as e:
+            self.finish(f"snapshot failed: {e.message}")
+            return
+        self.phase_done("png")
+        self.result["png"] = self.job["png"]
+        self.finish()
+
+def convert_worker_main():
+    # Results go out on a private copy of stdout; anything else printed by
+    # this process, or by libraries, lands on stderr instead.
+    results = os.fdopen(os.dup(1), "w")
+    os.dup2(2, 1)
+    if not Gtk.init_check():
+        print("Convert error: cannot open a display", file=sys.stderr)
+        return 2
+    loop = GLib.MainLoop()
+    worker = ConvertWorker(loop, results)
+    threading.Thread(target=worker.read_jobs, daemon=True).start()
+    loop.run()
+    return worker.exit_code
+
+def convert_main(argv):
+    parser = argparse.ArgumentParser(
+        prog="wiziwig --convert",
+        description="Render saved documents to PDF and PNG thumbnails without the editor. "
+                    "One JSON line is printed per document; the exit status is 1 if any failed.")
+    parser.add_argument("inputs", nargs="*", metavar="FILE", help="HTML documents to convert")
+    parser.add_argument("-i", "--input-list", metavar="LIST", help="file with one document path per line, - for stdin")
+    parser.add_argument("-o", "--output-dir", metavar="DIR", help="write output here instead of beside each input")
+    parser.add_argument("-j", "--jobs", type=int, default=min(os.cpu_count() or 1, 4),
+                        help="number of worker processes")
+    parser.add_argument("--no-pdf", dest="pdf", action="store_false", help="skip PDF output")
+    parser.add_argument("--png", action="store_true", help="also write a PNG thumbnail of the first screen")
+    parser.add_argument("--thumbnail-width", type=int, default=CONVERT_THUMBNAIL_WIDTH, metavar="PX")
+    parser.add_argument("--timeout", type=int, default=CONVERT_TIMEOUT, metavar="SECONDS",
+                        help="per document limit, after which its worker is restarted")
+    args = parser.parse_args(argv)
+
+    paths = list(args.inputs)
+    if args.input_list:
+        try:
+            with (sys.stdin if args.input_list == "-" else open(args.input_list)) as f:
+                paths.extend(line.strip() for line in f if line.strip())
+        except OSError as e:
+            parser.error(f"cannot read input list: {e}")
+    if not paths:
+        parser.error("no input documents")
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    lock = threading.Lock()
+    failed = []
+    def report(result):
+        with lock:
+            print(json.dumps(result), flush=True)
+            if not result["ok"]:
+                failed.append(result["input"])
+
+    jobs = queue.Queue()
+    for path in paths:
+        path = os.path.abspath(path)
+        if not os.path.isfile(path):
+            report({"input": path, "ok": False, "error": "no such file"})
+            continue
+        stem = os.path.join(args.output_dir or os.path.dirname(path), os.path.splitext(os.path.basename(path))[0])
+        jobs.put({"input": path, "pdf": stem + ".pdf" if args.pdf else None,
+                  "png": stem + ".png" if args.png else None,
+                  "thumbnail_width": args.thumbnail_width, "timeout": args.timeout})
+
+    command = [sys.executable, os.path.abspath(__file__), "--convert-worker"]
+    def run_worker():
+        process = None
+        while True:
+            try:
+                job = jobs.get_nowait()
+            except queue.Empty:
+                break
+            if process is None:
+                process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+            try:
+                process.stdin.write(json.dumps(job) + "\n")
+                process.stdin.flush()
+                line = process.stdout.readline()
+            except OSError:
+                line = ""
+            result = json.loads(line) if line else {"input": job["input"], "ok": False,
+                                                    "error": "worker exited", "restart": True}
+            if result.pop("restart", False):
+                process.kill()
+                process.wait()
+                process = None
+            report(result)
+        if process:
+            process.stdin.close()
+            process.wait()
+
+    workers = [threading.Thread(target=run_worker) for _ in range(max(1, min(args.jobs, jobs.qsize())))]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return 1 if failed else 0
+
 if __name__ == "__main__":
+    if "--convert-worker" in sys.argv:
+        sys.exit(convert_worker_main())
+    if "--convert" in sys.argv:
+        sys.exit(convert_main([arg for arg in sys.argv[1:] if arg not in ("--convert", "--trace-startup")]))
     app = Wiziwig()
-    app.run()
+    app.run([arg for arg in sys.argv if arg != "--trace-startup"])